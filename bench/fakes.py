@@ -0,0 +1,116 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Local stand-ins of the http services the scheduler calls: the solr DataImportHandler of each core,
+and the word cloud extractor
+"""
+import json
+import time
+import random
+import urlparse
+import threading
+import SocketServer
+import BaseHTTPServer
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+
+class _ThreadingServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Parse the GET and POST requests of a fake service. Subclasses answer them, in a handle_request(path, params)
+    method calling respond
+    """
+    protocol_version = 'HTTP/1.1'  # keep-alive, as the scheduler sessions
+
+    def do_GET(self):
+        parts = urlparse.urlsplit(self.path)
+        self.handle_request(parts.path, dict(urlparse.parse_qsl(parts.query)))
+
+    def do_POST(self):
+        parts = urlparse.urlsplit(self.path)
+        body = self.rfile.read(int(self.headers.getheader('content-length', 0)))
+        params = dict(urlparse.parse_qsl(parts.query))
+        params.update(urlparse.parse_qsl(body))
+        self.handle_request(parts.path, params)
+
+    def respond(self, status_code, content=None):
+        body = json.dumps(content) if content is not None else ""
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass  # the benchmark output is the report
+
+
+class FakeSolrHandler(_Handler):
+    """
+    The DataImportHandler of any core (/solr/<core>/dataimport): an import (command=full-import or
+    delta-import) keeps the core busy for import_latency seconds, and then reports documents_per_import
+    documents processed (command=status)
+    """
+    import_latency = 1.0
+    documents_per_import = 1000
+    imports = {}  # the end time of the latest import of each core
+    lock = threading.Lock()
+
+    def handle_request(self, path, params):
+        core = path.rstrip("/").split("/")[-2] if path.rstrip("/").endswith("dataimport") else None
+        if core is None:
+            return self.respond(404)
+        command = params.get("command", "status")
+        with self.lock:
+            if command in ("full-import", "delta-import"):
+                if self.imports.get(core, 0) > time.time():
+                    return self.respond(200, {"status": "busy", "statusMessages": {}})
+                self.imports[core] = time.time() + self.import_latency
+                return self.respond(200, {"status": "busy", "statusMessages": {}})
+            if self.imports.get(core, 0) > time.time():
+                return self.respond(200, {"status": "busy", "statusMessages": {}})
+        return self.respond(200, {"status": "idle", "statusMessages": {
+            "Total Documents Processed": str(self.documents_per_import if core in self.imports else 0)}})
+
+
+class FakeExtractorHandler(_Handler):
+    """
+    The word cloud extractor (?consultation_id=<id>): each request takes latency seconds (+- jitter),
+    and fails (500) with probability error_rate
+    """
+    latency = 0.05
+    jitter = 0.5  # the max deviation from the latency, as a fraction of it
+    error_rate = 0.0
+    random = random.Random(42)
+    lock = threading.Lock()
+
+    def handle_request(self, path, params):
+        if "consultation_id" not in params:
+            return self.respond(400)
+        with self.lock:
+            delay = self.latency * (1 + self.random.uniform(-self.jitter, self.jitter))
+            failed = self.random.random() < self.error_rate
+        time.sleep(max(delay, 0))
+        self.respond(500 if failed else 200, {"consultation_id": int(params["consultation_id"])})
+
+
+def start_server(handler, **knobs):
+    """
+    serve the handler (its knobs overridden by the ones passed) on a free local port, in the background
+    :return: the server, and its base url
+    """
+    class Configured(handler):
+        imports = {}  # the imports of this server only
+
+    for name, value in knobs.items():
+        setattr(Configured, name, value)
+    server = _ThreadingServer(('127.0.0.1', 0), Configured)
+    thread = threading.Thread(target=server.serve_forever, name=handler.__name__)
+    thread.daemon = True
+    thread.start()
+    return server, "http://127.0.0.1:%d" % server.server_port
@@ -0,0 +1,51 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+A seeded corpus in a (dedicated) postgres database: the tables the scheduler reads, with the indexes
+it relies on, and an empty state of the scheduler tables
+"""
+from models import CommentsHistory, WordCloudFingerprint, Job
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+ARTICLES_PER_CONSULTATION = 10
+SKEW = 2.0  # the comments per article follow random() ^ SKEW: a few articles get most of the comments
+
+SCHEMA = [
+    "DROP TABLE IF EXISTS comments, articles, consultation, %s, %s, %s;"
+    % (CommentsHistory.__tablename__, WordCloudFingerprint.__tablename__, Job.__tablename__),
+    "CREATE TABLE consultation (id integer PRIMARY KEY, title text NOT NULL);",
+    "CREATE TABLE articles (id integer PRIMARY KEY, consultation_id integer NOT NULL, title text NOT NULL);",
+    "CREATE TABLE comments (id serial PRIMARY KEY, article_id integer NOT NULL, comment text NOT NULL, "
+    "date_added timestamp NOT NULL);",
+    "CREATE INDEX ON comments (id, article_id);",
+    "CREATE INDEX ON comments (article_id);",
+    "CREATE INDEX ON articles (id, consultation_id);",
+    "CREATE INDEX ON articles (consultation_id);"
+]
+
+
+def seed(psql, consultations, comments, seed_value=0.42):
+    """
+    create the corpus from scratch: the same corpus for the same arguments
+    :param psql: the PSQLDBAccess of the benchmark database
+    :param consultations: the number of consultations
+    :param comments: the number of comments
+    :param seed_value: the seed of the random distribution of the comments, in [-1, 1]
+    """
+    articles = consultations * ARTICLES_PER_CONSULTATION
+    with psql.connection() as con:
+        cur = con.cursor()
+        for statement in SCHEMA:
+            cur.execute(statement)
+        cur.execute("SELECT setseed(%s);", (seed_value,))
+        cur.execute("INSERT INTO consultation (id, title) "
+                    "SELECT g, 'consultation ' || g FROM generate_series(1, %s) AS g;", (consultations,))
+        cur.execute("INSERT INTO articles (id, consultation_id, title) "
+                    "SELECT g, (g - 1) / %s + 1, 'article ' || g FROM generate_series(1, %s) AS g;",
+                    (ARTICLES_PER_CONSULTATION, articles))
+        cur.execute("INSERT INTO comments (article_id, comment, date_added) "
+                    "SELECT 1 + floor(power(random(), %s) * %s)::integer, md5(g::text), "
+                    "now() - (%s - g) * interval '1 second' FROM generate_series(1, %s) AS g;",
+                    (SKEW, articles, comments, comments))
+        cur.execute("ANALYZE consultation, articles, comments;")
@@ -0,0 +1,285 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+End-to-end benchmark of the scheduler, against local stand-ins of every external dependency:
+a fake solr DataImportHandler, a fake word cloud extractor, a stub java executable, and a seeded corpus
+in a dedicated postgres database (its tables are dropped and created again for each size).
+
+Each corpus size runs in a fresh process (so that its peak memory is its own), executing the whole pipeline
+(crawl, then index, word cloud and annotator) as a first run. The report (json) contains the wall time,
+the critical path of the steps and the scheduler overhead (the rest), the throughput, the cpu time and the
+peak memory of each run, and the metrics of each step.
+
+usage (from the bench directory):
+    democracit_db_host=localhost democracit_db_user=dit democracit_db_pw=... \\
+    python run_bench.py --db_name=democracit_bench --sizes=100:10000,1000:100000 --output=bench.json
+"""
+import os
+import sys
+import json
+import time
+import shutil
+import resource
+import tempfile
+import subprocess
+from datetime import datetime
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+SRC_DIR = os.path.join(os.path.dirname(BENCH_DIR), "src")
+sys.path.insert(0, SRC_DIR)
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+DEFAULT_DB_NAME = 'democracit_bench'
+DEFAULT_SIZES = '100:10000,1000:100000,5000:1000000'  # consultations:comments of each run
+SOLR_CORES = ('dit_consultations', 'dit_articles', 'dit_comments')
+
+
+def parse_sizes(sizes):
+    """
+    :param sizes: comma separated consultations:comments pairs, e.g. 100:10000,1000:100000
+    :return: a list of (consultations, comments) tuples
+    """
+    parsed = []
+    for size in sizes.split(","):
+        consultations, comments = size.split(":")
+        parsed.append((int(consultations), int(comments)))
+    return parsed
+
+
+def write_schedule(path, work_dir, solr_url, extractor_url, max_in_flight):
+    """
+    write the settings file of the benchmark pipeline (as json, which yaml loads as well)
+    """
+    for name in ("crawler", "annotator"):
+        os.makedirs(os.path.join(work_dir, name))
+        open(os.path.join(work_dir, name, "config.properties"), "w").close()
+    steps = [{
+        "package": "scheduler",
+        "class": "ControllerCrawl",
+        "outputs": {"consultations": "int"},
+        "params": {
+            "dir_name": os.path.join(work_dir, "crawler") + "/",
+            "java_exec": "OpenGovCrawler.jar",
+            "executable_class": "bench.Crawler",
+            "config_file": os.path.join(work_dir, "crawler", "config.properties"),
+            "progress": {"comments": "processed (\\d+) comments"}
+        }
+    }, {
+        "package": "scheduler",
+        "class": "ControllerIndex",
+        "stage": 2,
+        "inputs": "consultations",
+        "params": {
+            "urls": ["%s/solr/%s/dataimport?command=full-import&clean=true" % (solr_url, core)
+                     for core in SOLR_CORES],
+            "mode": "delta",
+            "poll_interval": 0.2
+        }
+    }, {
+        "package": "scheduler",
+        "class": "ControllerWordCloud",
+        "stage": 2,
+        "inputs": "consultations",
+        "params": {
+            "url": extractor_url + "/WordCloud/Extractor",
+            "max_in_flight": max_in_flight
+        }
+    }, {
+        "package": "scheduler",
+        "class": "ControllerFekAnnotator",
+        "stage": 2,
+        "params": {
+            "dir_name": os.path.join(work_dir, "annotator") + "/",
+            "java_exec": "FekAnnotatorModule.jar",
+            "executable_class": "bench.Annotator",
+            "config_file": os.path.join(work_dir, "annotator", "config.properties")
+        }
+    }]
+    with open(path, "w") as f:
+        json.dump(steps, f, indent=2)
+
+
+def write_java(bin_dir):
+    """
+    write the java of the benchmark to bin_dir: it runs the stub java with the interpreter of the benchmark
+    :return: bin_dir, to prepend to the PATH of the runs
+    """
+    path = os.path.join(bin_dir, "java")
+    with open(path, "w") as f:
+        f.write('#!/bin/sh\nexec "%s" "%s" "$@"\n' % (sys.executable, os.path.join(BENCH_DIR, "stub_java", "java")))
+    os.chmod(path, 0755)
+    return bin_dir
+
+
+def run_size(consultations, comments, work_dir, solr_url, extractor_url, max_workers, max_in_flight):
+    """
+    seed the corpus, and execute the pipeline on it (in this process)
+    :return: the report of the run
+    """
+    from psql_dbaccess import PSQLDBAccess
+    from scheduler import Scheduler
+    import fixture
+
+    started = time.time()
+    fixture.seed(PSQLDBAccess(), consultations, comments)
+    seed_time = time.time() - started
+    schedules = os.path.join(work_dir, "schedules.yaml")
+    write_schedule(schedules, work_dir, solr_url, extractor_url, max_in_flight)
+    scheduler = Scheduler(log_file=os.path.join(work_dir, "scheduler.log"), schedules=schedules,
+                          max_workers=max_workers, metrics_file=os.path.join(work_dir, "metrics.json"),
+                          history_db=os.path.join(work_dir, "history.db"),
+                          schedule_cache=os.path.join(work_dir, "schedules_cache.json"))
+    cpu_started = _cpu_time(resource.RUSAGE_SELF)
+    started = time.time()
+    scheduler.execute_pipeline(first=True)
+    wall_time = time.time() - started
+    PSQLDBAccess.close_all()
+    steps = scheduler.registry.as_dict()["steps"]
+    for step in steps:
+        step["items_per_sec"] = round(step["items"] / step["wall_time"], 1) if step["wall_time"] else None
+    critical_path = _critical_path(scheduler.schedule, dict((step["step"], step["wall_time"]) for step in steps))
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "consultations": consultations,
+        "comments": comments,
+        "seed_time": round(seed_time, 3),
+        "wall_time": round(wall_time, 3),
+        "critical_path_time": round(critical_path, 3),
+        "overhead_time": round(wall_time - critical_path, 3),
+        "comments_per_sec": round(comments / wall_time, 1),
+        "consultations_per_sec": round(consultations / wall_time, 1),
+        "cpu_time": round(_cpu_time(resource.RUSAGE_SELF) - cpu_started, 3),
+        "children_cpu_time": round(children.ru_utime + children.ru_stime, 3),
+        "peak_rss_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+        "children_peak_rss_kb": children.ru_maxrss,
+        "steps": steps
+    }
+
+
+def _cpu_time(who):
+    usage = resource.getrusage(who)
+    return usage.ru_utime + usage.ru_stime
+
+
+def _critical_path(schedule, wall_times):
+    """
+    :param schedule: the CompiledSchedule executed
+    :param wall_times: the wall time of each step, by name
+    :return: the longest chain of the step wall times, along their dependencies
+    """
+    finish = {}
+
+    def end(step):
+        if step not in finish:
+            finish[step] = wall_times.get(schedule.names[step], 0.0) + \
+                max([end(dep) for dep in schedule.dependencies[step]] or [0.0])
+        return finish[step]
+
+    return max([end(step) for step in schedule.dependencies] or [0.0])
+
+
+if __name__ == "__main__":
+    import gflags
+    from fakes import FakeSolrHandler, FakeExtractorHandler, start_server
+
+    gflags.DEFINE_string('db_name', DEFAULT_DB_NAME, 'the postgres database to seed: its tables are dropped and '
+                                                     'created again, so never point it to a real one.')
+
+    gflags.DEFINE_string('sizes', DEFAULT_SIZES, 'the corpus sizes to run, as consultations:comments pairs.')
+
+    gflags.DEFINE_string('output', None, 'the json file to write the report to (else printed).')
+
+    gflags.DEFINE_integer('max_workers', 4, 'the max number of steps to execute concurrently.')
+
+    gflags.DEFINE_integer('max_in_flight', 8, 'the max number of concurrent word cloud extractor requests.')
+
+    gflags.DEFINE_float('solr_latency', 2.0, 'the duration (in seconds) of each import of the fake solr.')
+
+    gflags.DEFINE_integer('solr_documents', 1000, 'the documents processed by each import of the fake solr.')
+
+    gflags.DEFINE_float('extractor_latency', 0.05, 'the mean latency (in seconds) of the fake extractor.')
+
+    gflags.DEFINE_float('extractor_error_rate', 0.0, 'the fraction of the fake extractor requests that fail.')
+
+    gflags.DEFINE_float('java_cpu', 1.0, 'the cpu time (in seconds) each stub java process burns.')
+
+    gflags.DEFINE_float('java_sleep', 1.0, 'the time (in seconds) each stub java process sleeps.')
+
+    gflags.DEFINE_integer('java_memory_mb', 64, 'the memory (in MB) each stub java process allocates.')
+
+    gflags.DEFINE_bool('keep_work_dirs', False, 'keep the work directory (logs, journal, metrics) of each run.')
+
+    # set by the benchmark for the process of each run
+    gflags.DEFINE_string('run_size', None, 'internal: execute a single run of this size, in this process.')
+
+    gflags.DEFINE_string('run_result', None, 'internal: the json file to write the report of the single run to.')
+
+    gflags.DEFINE_string('solr_url', None, 'internal: the url of the fake solr.')
+
+    gflags.DEFINE_string('extractor_url', None, 'internal: the url of the fake extractor.')
+
+    FLAGS = gflags.FLAGS
+
+    try:
+        argv = FLAGS(sys.argv)
+        sizes = parse_sizes(FLAGS.run_size if FLAGS.run_size else FLAGS.sizes)
+    except (gflags.FlagsError, ValueError) as e:
+        print('%s\\nUsage: %s ARGS\\n%s' % (e, sys.argv[0], FLAGS))
+        sys.exit(1)
+
+    if FLAGS.run_size:
+        # the run files (journal, summaries) are stored in the parent of the working directory
+        report = run_size(sizes[0][0], sizes[0][1], os.path.dirname(os.getcwd()), FLAGS.solr_url,
+                          FLAGS.extractor_url, FLAGS.max_workers, FLAGS.max_in_flight)
+        with open(FLAGS.run_result, "w") as f:
+            json.dump(report, f)
+        sys.exit(0)
+
+    _, solr_url = start_server(FakeSolrHandler, import_latency=FLAGS.solr_latency,
+                               documents_per_import=FLAGS.solr_documents)
+    _, extractor_url = start_server(FakeExtractorHandler, latency=FLAGS.extractor_latency,
+                                    error_rate=FLAGS.extractor_error_rate)
+    env = dict(os.environ)
+    env.update({
+        "PYTHONPATH": BENCH_DIR + os.pathsep + SRC_DIR,
+        "democracit_db_name": FLAGS.db_name,
+        "BENCH_JAVA_CPU": str(FLAGS.java_cpu),
+        "BENCH_JAVA_SLEEP": str(FLAGS.java_sleep),
+        "BENCH_JAVA_MEMORY_MB": str(FLAGS.java_memory_mb)
+    })
+    runs = []
+    for consultations, comments in sizes:
+        work_dir = tempfile.mkdtemp(prefix="dit_bench_")
+        os.makedirs(os.path.join(work_dir, "cwd"))
+        os.makedirs(os.path.join(work_dir, "bin"))
+        env["PATH"] = write_java(os.path.join(work_dir, "bin")) + os.pathsep + os.environ.get("PATH", "")
+        result_file = os.path.join(work_dir, "result.json")
+        try:
+            subprocess.check_call([sys.executable, os.path.abspath(__file__),
+                                   "--run_size=%d:%d" % (consultations, comments), "--run_result=" + result_file,
+                                   "--solr_url=" + solr_url, "--extractor_url=" + extractor_url,
+                                   "--max_workers=%d" % FLAGS.max_workers,
+                                   "--max_in_flight=%d" % FLAGS.max_in_flight],
+                                  cwd=os.path.join(work_dir, "cwd"), env=env)
+            with open(result_file) as f:
+                runs.append(json.load(f))
+            print >> sys.stderr, "%d consultations, %d comments: %.1f secs (overhead %.1f secs)" \
+                % (consultations, comments, runs[-1]["wall_time"], runs[-1]["overhead_time"])
+        finally:
+            if FLAGS.keep_work_dirs:
+                print >> sys.stderr, "work directory: %s" % work_dir
+            else:
+                shutil.rmtree(work_dir, ignore_errors=True)
+    report = json.dumps({
+        "date": datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),
+        "settings": dict((name, getattr(FLAGS, name)) for name in (
+            "max_workers", "max_in_flight", "solr_latency", "solr_documents", "extractor_latency",
+            "extractor_error_rate", "java_cpu", "java_sleep", "java_memory_mb")),
+        "runs": runs
+    }, indent=2, sort_keys=True)
+    if FLAGS.output:
+        with open(FLAGS.output, "w") as f:
+            f.write(report + "\n")
+    else:
+        print report
@@ -0,0 +1,126 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import threading
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+# the item types a channel may be declared with, in the settings file
+CHANNEL_TYPES = {
+    'int': (int, long),
+    'float': (int, long, float),
+    'str': basestring,
+    'bool': bool,
+    'list': list,
+    'dict': dict,
+    'any': object
+}
+
+
+class ChannelClosedError(Exception):
+    """Raised when an item is put to a closed channel"""
+    pass
+
+
+class Channel:
+    """
+    A typed stream of items from the step that produces it to the steps that consume it, within a run.
+    Every consumer reads all the items, in order, as soon as they are put: it does not have to wait for the
+    producer to finish. The channel is closed when its producer ends (failed, if the producer failed or was
+    skipped), which ends the iteration of its consumers.
+    """
+
+    def __init__(self, name, item_type='any'):
+        """
+        :param item_type: the type name of the items, see CHANNEL_TYPES
+        """
+        if item_type not in CHANNEL_TYPES:
+            raise ValueError("channel '%s': unknown type '%s' (one of %s)"
+                             % (name, item_type, ", ".join(sorted(CHANNEL_TYPES))))
+        self.name = name
+        self.item_type = item_type
+        self.items = []
+        self.closed = False
+        self.failed = False
+        self.condition = threading.Condition()
+
+    def put(self, item):
+        self.extend([item])
+
+    def extend(self, items):
+        """
+        :raise TypeError: if any of the items is not of the channel type
+        :raise ChannelClosedError: if the channel is closed
+        """
+        items = list(items)
+        for item in items:
+            if not isinstance(item, CHANNEL_TYPES[self.item_type]):
+                raise TypeError("channel '%s' takes %s items, not %r" % (self.name, self.item_type, item))
+        with self.condition:
+            if self.closed:
+                raise ChannelClosedError("channel '%s' is closed" % self.name)
+            self.items.extend(items)
+            self.condition.notify_all()
+
+    def close(self, failed=False):
+        """
+        mark the end of the stream (no-op if already closed)
+        :param failed: whether the producer failed, so that the items may be incomplete
+        """
+        with self.condition:
+            if not self.closed:
+                self.closed = True
+                self.failed = failed
+                self.condition.notify_all()
+
+    def batches(self, max_size=None):
+        """
+        :param max_size: the max number of items per batch, if any
+        :return: a generator of the lists of items put since the previous batch, until the channel is closed
+        """
+        index = 0
+        while True:
+            with self.condition:
+                while index >= len(self.items) and not self.closed:
+                    self.condition.wait(1.0)  # timed, so that the wait can be interrupted
+                end = len(self.items) if not max_size else min(len(self.items), index + max_size)
+                batch = self.items[index:end]
+            if not batch:
+                return
+            index = end
+            yield batch
+
+    def __iter__(self):
+        for batch in self.batches():
+            for item in batch:
+                yield item
+
+    def __repr__(self):
+        return "Channel: %s (%s, %d items%s)" % (self.name, self.item_type, len(self.items),
+                                                 ", closed" if self.closed else "")
+
+
+class ChannelRegistry:
+    """The channels of a run, created from their declarations, and released once the run ends"""
+
+    def __init__(self, declarations):
+        """
+        :param declarations: a dict containing the item type of each channel
+        """
+        self.channels = dict((name, Channel(name, item_type)) for name, item_type in declarations.items())
+
+    def get(self, name):
+        return self.channels[name]
+
+    def close_all(self, failed=False):
+        for channel in self.channels.values():
+            channel.close(failed)
+
+    def release(self):
+        """
+        close all the channels, and drop their items
+        """
+        self.close_all(failed=True)
+        for channel in self.channels.values():
+            with channel.condition:
+                channel.items = []
+        self.channels = {}
@@ -0,0 +1,298 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import re
+import time
+import signal
+import resource
+import threading
+import subprocess
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+POLL_INTERVAL = 0.2  # seconds between checks of a running child
+KILL_GRACE_PERIOD = 10  # seconds between SIGTERM and SIGKILL
+READER_JOIN_TIMEOUT = 5  # seconds to wait for the output of an exited child to be drained
+DEFAULT_PROGRESS_INTERVAL = 30  # seconds between progress logs
+
+IONICE_CLASSES = {'realtime': 1, 'best-effort': 2, 'idle': 3}
+
+SIZE_UNITS = {'': 1, 'k': 1024, 'm': 1024 ** 2, 'g': 1024 ** 3, 't': 1024 ** 4}
+
+
+def parse_size(size):
+    """
+    :param size: a size in bytes, or a string with a unit suffix (e.g. 512m, 4g)
+    :return: the size in bytes
+    """
+    if size is None or isinstance(size, (int, long)):
+        return size
+    match = re.match(r'^\s*(\d+)\s*([kmgt]?)b?\s*$', str(size).lower())
+    if not match:
+        raise ValueError("invalid size '%s'" % size)
+    return int(match.group(1)) * SIZE_UNITS[match.group(2)]
+
+
+class ResourceLimits:
+    """
+    The limits of the child processes of a controller, as stated in its 'limits' param, e.g.
+        limits:
+            timeout: 7200           # wall clock seconds, then the child is terminated
+            max_memory: 8g          # address space (RLIMIT_AS), enforced by the kernel
+            max_rss: 4g             # resident memory, checked while running, then the child is terminated
+            nice: 10
+            ionice: idle            # or best-effort:7, realtime:0
+            cpu_affinity: [2, 3]
+            heavy: true             # whether the child takes one of the global heavy slots (default true)
+    Note that the JVM reserves far more address space than it uses: prefer max_rss (or -Xmx) for java children.
+    """
+
+    def __init__(self, timeout=None, max_memory=None, max_rss=None, nice=None, ionice=None, cpu_affinity=None,
+                 heavy=True):
+        self.timeout = timeout
+        self.max_memory = parse_size(max_memory)
+        self.max_rss = parse_size(max_rss)
+        self.nice = nice
+        self.ionice = ionice
+        self.cpu_affinity = cpu_affinity
+        self.heavy = heavy
+        self._ionice_args()  # validate
+
+    def wrap(self, command):
+        """
+        :param command: the command to execute
+        :return: the command, prefixed by ionice/taskset as required (both exec the command, keeping its pid)
+        """
+        prefix = []
+        if self.ionice is not None:
+            prefix += ["ionice"] + self._ionice_args()
+        if self.cpu_affinity:
+            prefix += ["taskset", "-c", ",".join(str(cpu) for cpu in self.cpu_affinity)]
+        return prefix + list(command)
+
+    def preexec(self):
+        """
+        applied in the child, before the command is executed
+        """
+        # own process group, so that the whole tree of the child can be signalled
+        os.setpgid(0, 0)
+        if self.nice:
+            os.nice(self.nice)
+        if self.max_memory:
+            resource.setrlimit(resource.RLIMIT_AS, (self.max_memory, self.max_memory))
+
+    def _ionice_args(self):
+        if self.ionice is None:
+            return []
+        io_class, _, level = str(self.ionice).partition(':')
+        if io_class not in IONICE_CLASSES:
+            raise ValueError("invalid ionice '%s', must be one of: %s (optionally followed by :level)"
+                             % (self.ionice, ", ".join(sorted(IONICE_CLASSES))))
+        return ["-c", str(IONICE_CLASSES[io_class])] + (["-n", level] if level else [])
+
+    def __repr__(self):
+        return "ResourceLimits: {}".format(self.__dict__)
+
+
+class ProgressTracker:
+    """
+    Extract progress counters from the output lines of a child, and log them periodically, with their rates.
+    Each pattern is a regex whose first group is the running total of its counter, e.g.
+        progress:
+            comments: 'processed (\d+) comments'
+    """
+
+    def __init__(self, patterns, tag, logger, interval=DEFAULT_PROGRESS_INTERVAL):
+        """
+        :param patterns: a dict containing the regex of each counter
+        :param tag: the tag of the log messages (e.g. the step name)
+        :param logger: the logger to report to
+        :param interval: the interval (in seconds) between progress logs
+        """
+        self.patterns = dict((name, re.compile(pattern)) for name, pattern in patterns.items())
+        self.tag = tag
+        self.logger = logger
+        self.interval = interval
+        self.values = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.last_logged, self.last_values = self.started, {}
+
+    def feed(self, line):
+        """
+        :param line: an output line of the child
+        """
+        for name, pattern in self.patterns.items():
+            match = pattern.search(line)
+            if match:
+                try:
+                    value = int(match.group(1).replace(",", ""))
+                except (IndexError, ValueError):
+                    continue
+                with self.lock:
+                    self.values[name] = value
+
+    def log(self, now=None, force=False):
+        """
+        log the counters, with their rate since the previous log and their overall rate, if the interval has passed
+        """
+        now = now if now else time.time()
+        if not force and now - self.last_logged < self.interval:
+            return
+        with self.lock:
+            values = dict(self.values)
+        if values:
+            since_last, overall = now - self.last_logged, now - self.started
+            self.logger.info("%s progress: %s" % (self.tag, ", ".join(
+                "%s=%d (%.1f/s, %.1f/s overall)" % (
+                    name, value,
+                    (value - self.last_values.get(name, 0)) / since_last if since_last else 0.0,
+                    value / overall if overall else 0.0)
+                for name, value in sorted(values.items()))))
+        self.last_logged, self.last_values = now, values
+
+
+class ChildProcessRunner:
+    """
+    Execute child processes within their resource limits, and account for their resource usage.
+    Heavy children (e.g. JVMs) share a global budget of slots: at most that many run at once, in the process.
+    """
+    _slots = None  # the semaphore of the heavy slots, None for unlimited
+    _slots_lock = threading.Lock()
+
+    def __init__(self, limits=None, logger=None, tag=None, progress=None, progress_interval=None):
+        """
+        :param limits: the ResourceLimits to apply
+        :param logger: the logger to report to. If set, the output of the child is captured
+        and forwarded to it, line by line (else the child writes to the output of the scheduler)
+        :param tag: the tag of the log messages (e.g. the step name)
+        :param progress: a dict containing the regex of each progress counter, see ProgressTracker
+        :param progress_interval: the interval (in seconds) between progress logs
+        """
+        self.limits = limits if limits else ResourceLimits()
+        self.logger = logger
+        self.tag = tag if tag else "child"
+        self.progress = ProgressTracker(progress, self.tag, logger,
+                                        progress_interval if progress_interval else DEFAULT_PROGRESS_INTERVAL) \
+            if progress and logger else None
+
+    @classmethod
+    def set_heavy_slots(cls, slots):
+        """
+        :param slots: the max number of heavy children running at once, or None for unlimited
+        """
+        with cls._slots_lock:
+            cls._slots = threading.BoundedSemaphore(slots) if slots else None
+
+    def run(self, command, cwd=None):
+        """
+        execute the command, and wait for it to finish (or to be terminated, if it exceeds its limits)
+        :param command: the command to execute
+        :param cwd: the working directory of the child
+        :return: a dict containing the report of the child: its returncode, whether (and why) it was killed,
+        and its wall, user and system time (secs) and max resident memory (KB), as accounted by getrusage
+        """
+        slots = ChildProcessRunner._slots if self.limits.heavy else None
+        if slots:
+            slots.acquire()
+        try:
+            return self._run(command, cwd)
+        finally:
+            if slots:
+                slots.release()
+
+    def _run(self, command, cwd):
+        started = time.time()
+        capture = subprocess.PIPE if self.logger else None
+        # close_fds: a child must not inherit the pipes of its siblings, else their readers would only
+        # get EOF once every sibling has exited
+        child = subprocess.Popen(self.limits.wrap(command), cwd=cwd, preexec_fn=self.limits.preexec,
+                                 stdout=capture, stderr=capture, close_fds=True)
+        readers = [self._start_reader(child.stdout, "out"), self._start_reader(child.stderr, "err")] \
+            if capture else []
+        killed, terminated_at = None, None
+        while True:
+            pid, status, usage = os.wait4(child.pid, os.WNOHANG)
+            if pid:
+                break
+            now = time.time()
+            if self.progress:
+                self.progress.log(now)
+            if not killed:
+                if self.limits.timeout and now - started > self.limits.timeout:
+                    killed = "timeout"
+                elif self.limits.max_rss and (self._get_rss(child.pid) or 0) > self.limits.max_rss:
+                    killed = "max_rss"
+                if killed:
+                    self._log_error("terminating %s (pid %d): exceeded %s" % (command[0], child.pid, killed))
+                    self._signal(child.pid, signal.SIGTERM)
+                    terminated_at = now
+            elif now - terminated_at > KILL_GRACE_PERIOD:
+                self._signal(child.pid, signal.SIGKILL)
+            time.sleep(POLL_INTERVAL)
+        # reaped by wait4: let Popen know
+        child.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        for reader in readers:
+            # a grandchild may still hold the pipe open: do not wait for it
+            reader.join(READER_JOIN_TIMEOUT)
+        report = {
+            "returncode": child.returncode,
+            "killed": killed,
+            "wall_time": round(time.time() - started, 3),
+            "user_time": round(usage.ru_utime, 3),
+            "system_time": round(usage.ru_stime, 3),
+            "max_rss_kb": usage.ru_maxrss
+        }
+        if self.progress:
+            self.progress.log(force=True)
+            report["progress"] = dict(self.progress.values)
+        return report
+
+    def _start_reader(self, stream, name):
+        """
+        forward the lines of the stream to the logger (and the progress tracker), as they are written
+        :param stream: the stdout or stderr pipe of the child
+        :param name: the stream name, to tag the lines with
+        :return: the reader thread
+        """
+        def read():
+            for line in iter(stream.readline, ''):
+                line = line.rstrip()
+                if line:
+                    self.logger.info("[%s:%s] %s" % (self.tag, name, line))
+                    if self.progress:
+                        self.progress.feed(line)
+            stream.close()
+
+        reader = threading.Thread(target=read, name="%s-%s" % (self.tag, name))
+        reader.daemon = True
+        reader.start()
+        return reader
+
+    @staticmethod
+    def _get_rss(pid):
+        """
+        :return: the resident memory of the process, in bytes (None if not available)
+        """
+        try:
+            with open("/proc/%d/status" % pid) as f:
+                for line in f:
+                    if line.startswith("VmRSS:"):
+                        return int(line.split()[1]) * 1024
+        except (IOError, ValueError):
+            pass
+        return None
+
+    @staticmethod
+    def _signal(pid, sig):
+        """
+        signal the process group of the child
+        """
+        try:
+            os.killpg(pid, sig)
+        except OSError:  # already exited
+            pass
+
+    def _log_error(self, message):
+        if self.logger:
+            self.logger.error(message)
@@ -0,0 +1,59 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import threading
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+
+class ClasspathResolver:
+    """
+    Resolve the classpath of a directory, i.e. all the jars under it (as 'find -iname *.jar' would),
+    and cache it per directory, for all the controllers of the process.
+    A cached classpath is valid as long as the mtimes of the directories walked and of the jars found
+    do not change (adding, removing or renaming a file changes the mtime of its directory).
+    """
+    _cache = {}  # directory -> (mtimes of the directories and jars, classpath)
+    _lock = threading.Lock()
+
+    @classmethod
+    def get_jars(cls, dir_name):
+        """
+        :param dir_name: the directory containing the jars
+        :return: the sorted list of the absolute paths of the jars under the directory
+        """
+        directory = os.path.abspath(os.path.expanduser(dir_name))
+        with cls._lock:
+            cached = cls._cache.get(directory)
+            if cached and cls._is_valid(cached[0]):
+                return cached[1]
+            mtimes, jars = cls._walk(directory)
+            cls._cache[directory] = (mtimes, jars)
+            return jars
+
+    @staticmethod
+    def _walk(directory):
+        """
+        :return: a tuple of the mtimes of all the directories and jars found, and the sorted list of jars
+        """
+        mtimes = {}
+        jars = []
+        for root, _, files in os.walk(directory):
+            mtimes[root] = os.stat(root).st_mtime
+            for name in files:
+                if name.lower().endswith('.jar'):
+                    path = os.path.join(root, name)
+                    mtimes[path] = os.stat(path).st_mtime
+                    jars.append(path)
+        return mtimes, sorted(jars)
+
+    @staticmethod
+    def _is_valid(mtimes):
+        """
+        :param mtimes: the mtimes of the directories and jars, when cached
+        :return: True if none of them has changed since
+        """
+        try:
+            return all(os.stat(path).st_mtime == mtime for path, mtime in mtimes.items())
+        except OSError:
+            return False
@@ -1,7 +1,11 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from datetime import datetime
+import json
+import atexit
 import logging
+import threading
+import Queue
 from logging.handlers import RotatingFileHandler
 
 from models import Schedule
@@ -9,33 +13,122 @@ from models import Schedule
 
 __author__ = 'George K. <gkiom@scify.org>'
 
+DEFAULT_MAX_BYTES = 10485760  # 10MB per file
+DEFAULT_BACKUP_COUNT = 10
+
+RECORD_FIELDS = ('step', 'consultation_id', 'duration', 'status')  # structured fields of the json records
+
+
+class JSONFormatter(logging.Formatter):
+    """ Format each record as a json line, including its structured fields (if any) """
+
+    def format(self, record):
+        entry = {
+            "time": self.formatTime(record, self.datefmt),
+            "level": record.levelname,
+            "message": record.getMessage()
+        }
+        for field in RECORD_FIELDS:
+            value = getattr(record, field, None)
+            if value is not None:
+                entry[field] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exception"] = record.exc_text
+        return json.dumps(entry)
+
+
+class QueueHandler(logging.Handler):
+    """ Put the records to a queue, to be written by a QueueListener: logging never blocks on file I/O """
+
+    def __init__(self, queue):
+        logging.Handler.__init__(self)
+        self.queue = queue
+
+    def emit(self, record):
+        try:
+            # format the message and traceback now: the args and the traceback may change until written
+            record.msg = record.getMessage()
+            record.args = None
+            if record.exc_info:
+                record.exc_text = logging.Formatter().formatException(record.exc_info)
+                record.exc_info = None
+            self.queue.put_nowait(record)
+        except Exception:
+            self.handleError(record)
+
+
+class QueueListener(threading.Thread):
+    """ Write the records of the queue to the handler, in the background """
+
+    def __init__(self, queue, handler):
+        threading.Thread.__init__(self, name="log-writer")
+        self.daemon = True
+        self.queue = queue
+        self.handler = handler
+
+    def run(self):
+        while True:
+            record = self.queue.get()
+            if record is None:
+                break
+            self.handler.handle(record)
+
+    def stop(self):
+        """ Write the records already queued, then stop """
+        self.queue.put(None)
+        self.join()
+        self.handler.close()
+
 
 class DITLogger:
 
     class __impl:
         """ Implementation of the singleton interface """
 
-        def __init__(self, level=None, filename=None):
-            formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s', datefmt='%d/%m/%Y %H:%M:%S')
+        def __init__(self, level=None, filename=None, max_bytes=None, backup_count=None, json_format=False):
+            if json_format:
+                formatter = JSONFormatter(datefmt='%Y-%m-%d %H:%M:%S')
+            else:
+                formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s',
+                                              datefmt='%d/%m/%Y %H:%M:%S')
             self.logger = logging.getLogger("DIT")
             self.logfile = filename
             self.level = level if level else logging.DEBUG
             self.logger.setLevel(self.level)
-            handler = RotatingFileHandler(self.logfile, maxBytes=1048576, backupCount=10)  # set to 1MB per file
+            handler = RotatingFileHandler(self.logfile,
+                                          maxBytes=max_bytes if max_bytes else DEFAULT_MAX_BYTES,
+                                          backupCount=backup_count if backup_count else DEFAULT_BACKUP_COUNT)
             handler.setFormatter(formatter)
-            self.logger.addHandler(handler)
+            # write to file in the background
+            queue = Queue.Queue()
+            self.listener = QueueListener(queue, handler)
+            self.listener.start()
+            self.logger.addHandler(QueueHandler(queue))
+            atexit.register(self.close)
+
+        def info(self, message, **fields):
+            """
+            :param fields: the structured fields of the record (step, consultation_id, duration, status)
+            """
+            self.logger.info(message, extra=fields)
 
-        def info(self, message):
-            self.logger.info(message)
+        def exception(self, ex, **fields):
+            self.logger.exception(ex, extra=fields)
 
-        def exception(self, ex):
-            self.logger.exception(ex)
+        def error(self, message, **fields):
+            self.logger.error(message, extra=fields)
 
-        def error(self, message):
-            self.logger.error(message)
+        def warn(self, message, **fields):
+            self.logger.warn(message, extra=fields)
 
-        def warn(self, message):
-            self.logger.warn(message)
+        def close(self):
+            """
+            write all the records queued, and stop the background writer
+            """
+            if self.listener.is_alive():
+                self.listener.stop()
 
         def _schedule_initialized(self, total_steps):
             """
@@ -67,12 +160,12 @@ class DITLogger:
     # storage for the instance reference
     __instance = None
 
-    def __init__(self, level=None, filename=None):
+    def __init__(self, level=None, filename=None, max_bytes=None, backup_count=None, json_format=False):
         """ Create singleton instance """
         # Check whether we already have an instance
         if DITLogger.__instance is None:
             # Create and remember instance
-            DITLogger.__instance = DITLogger.__impl(level, filename)
+            DITLogger.__instance = DITLogger.__impl(level, filename, max_bytes, backup_count, json_format)
 
         # Store instance reference as the only member in the handle
         self.__dict__['_Singleton__instance'] = DITLogger.__instance
@@ -0,0 +1,189 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import time
+import random
+import urlparse
+import threading
+
+from lazy_import import LazyModule
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+requests = LazyModule('requests')  # imported by the steps that make http requests only
+
+DEFAULT_CONNECT_TIMEOUT = 10  # seconds
+DEFAULT_READ_TIMEOUT = 60  # seconds
+DEFAULT_RETRIES = 2  # retries of an idempotent request, after the first attempt
+DEFAULT_BACKOFF = 1.0  # seconds, the base of the exponential backoff between retries
+MAX_BACKOFF = 30.0  # seconds
+DEFAULT_FAILURE_THRESHOLD = 5  # consecutive failures of an endpoint, after which its circuit opens
+DEFAULT_RESET_TIMEOUT = 60  # seconds an open circuit fails fast, before a trial request is let through
+
+RETRY_STATUS_CODES = (500, 502, 503, 504)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE')
+
+CIRCUIT_CLOSED = 'closed'
+CIRCUIT_OPEN = 'open'
+CIRCUIT_HALF_OPEN = 'half-open'
+
+
+class CircuitOpenError(Exception):
+    """Raised instead of calling an endpoint whose circuit is open"""
+    pass
+
+
+class CircuitBreaker:
+    """
+    The circuit of an endpoint (scheme, host and path of its urls), shared by all the clients of the process.
+    After failure_threshold consecutive failures (connection errors, timeouts and 5xx responses) the circuit
+    opens, and every request fails fast for reset_timeout seconds. Then a single trial request is let through
+    (half-open): the circuit closes if it succeeds, else it opens again.
+    """
+    _breakers = {}
+    _breakers_lock = threading.Lock()
+
+    def __init__(self, endpoint, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        self.endpoint = endpoint
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CIRCUIT_CLOSED
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @classmethod
+    def get(cls, url, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        """
+        :return: the breaker of the endpoint of the url (created on first call)
+        """
+        parts = urlparse.urlsplit(url)
+        endpoint = "%s://%s%s" % (parts.scheme, parts.netloc, parts.path)
+        with cls._breakers_lock:
+            if endpoint not in cls._breakers:
+                cls._breakers[endpoint] = CircuitBreaker(endpoint, failure_threshold, reset_timeout)
+            return cls._breakers[endpoint]
+
+    def allow(self):
+        """
+        :return: True if a request may be sent to the endpoint
+        """
+        with self.lock:
+            if self.state == CIRCUIT_CLOSED:
+                return True
+            if self.state == CIRCUIT_OPEN and time.time() - self.opened_at >= self.reset_timeout:
+                self.state = CIRCUIT_HALF_OPEN  # let this request through, as a trial
+                return True
+            return False
+
+    def record_success(self):
+        with self.lock:
+            self.state = CIRCUIT_CLOSED
+            self.failures = 0
+
+    def record_failure(self):
+        """
+        :return: True if the failure opened the circuit
+        """
+        with self.lock:
+            self.failures += 1
+            if self.state == CIRCUIT_HALF_OPEN or \
+                    (self.state == CIRCUIT_CLOSED and self.failures >= self.failure_threshold):
+                self.state = CIRCUIT_OPEN
+                self.opened_at = time.time()
+                return True
+            return False
+
+    def __repr__(self):
+        return "CircuitBreaker: {}".format(self.__dict__)
+
+
+class HTTPClient:
+    """
+    A keep-alive http client with connect and read timeouts, and jittered exponential backoff retries
+    of the idempotent requests that fail with a connection error, a timeout or a 5xx response.
+    Every request goes through the circuit breaker of its endpoint.
+    """
+
+    def __init__(self, timeout=DEFAULT_READ_TIMEOUT, connect_timeout=DEFAULT_CONNECT_TIMEOUT, retries=DEFAULT_RETRIES,
+                 backoff=DEFAULT_BACKOFF, pool_size=1, logger=None, metrics=None):
+        """
+        :param timeout: the read timeout (in seconds) of each request
+        :param connect_timeout: the connect timeout (in seconds) of each request
+        :param retries: the max number of retries of an idempotent request
+        :param backoff: the base (in seconds) of the backoff between retries
+        :param pool_size: the max number of connections kept open per host (i.e. of concurrent requests)
+        :param logger: the logger to report retries and open circuits to, if any
+        :param metrics: the StepMetrics to record every attempt (503 if no response), retry and rejected
+        request to, if any
+        """
+        self.timeout = (connect_timeout, timeout)
+        self.retries = retries
+        self.backoff = backoff
+        self.logger = logger
+        self.metrics = metrics
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def request(self, method, url, idempotent=None, **kwargs):
+        """
+        :param idempotent: whether the request may be retried (default: by its method)
+        :return: the response (of the last attempt)
+        :raise CircuitOpenError: if the circuit of the endpoint is open
+        :raise requests.RequestException: if the last attempt failed without a response
+        """
+        breaker = CircuitBreaker.get(url)
+        attempts = 1 + (self.retries if (method in IDEMPOTENT_METHODS if idempotent is None else idempotent) else 0)
+        for attempt in range(attempts):
+            if not breaker.allow():
+                if self.metrics:
+                    self.metrics.add_http_rejected()
+                raise CircuitOpenError("circuit of %s is open" % breaker.endpoint)
+            started = time.time()
+            try:
+                response = self.session.request(method, url, timeout=self.timeout, **kwargs)
+            except requests.RequestException, ex:
+                self._observe(started, 503)
+                self._record_failure(breaker)
+                if attempt == attempts - 1:
+                    raise
+                self._wait(attempt, url, ex)
+                continue
+            self._observe(started, response.status_code)
+            if response.status_code not in RETRY_STATUS_CODES:
+                breaker.record_success()
+                return response
+            self._record_failure(breaker)
+            if attempt == attempts - 1:
+                return response
+            self._wait(attempt, url, response.status_code)
+
+    def close(self):
+        self.session.close()
+
+    def _observe(self, started, status_code):
+        if self.metrics:
+            self.metrics.observe_http(time.time() - started, status_code)
+
+    def _record_failure(self, breaker):
+        if breaker.record_failure() and self.logger:
+            self.logger.error("circuit of %s opened after %d failures: failing fast for %d secs"
+                              % (breaker.endpoint, breaker.failures, breaker.reset_timeout))
+
+    def _wait(self, attempt, url, reason):
+        """
+        sleep before the next attempt: a random time up to the exponential backoff ('full jitter')
+        """
+        delay = random.uniform(0, min(MAX_BACKOFF, self.backoff * 2 ** attempt))
+        if self.metrics:
+            self.metrics.add_http_retry()
+        if self.logger:
+            self.logger.warn("request to %s failed (%s): retrying in %.1f secs" % (url, reason, delay))
+        time.sleep(delay)
@@ -0,0 +1,118 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import glob
+import hashlib
+import threading
+from distutils.spawn import find_executable
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+DEFAULT_CDS_DIR = os.path.abspath(os.path.join(os.getcwd(), os.pardir)) + "/cds"
+
+GC_OPTIONS = {
+    'serial': '-XX:+UseSerialGC',
+    'parallel': '-XX:+UseParallelGC',
+    'cms': '-XX:+UseConcMarkSweepGC',
+    'g1': '-XX:+UseG1GC',
+    'shenandoah': '-XX:+UseShenandoahGC',
+    'zgc': '-XX:+UseZGC',
+}
+
+
+class JVMProfile:
+    """
+    The JVM options of a java controller, as stated in its 'jvm' param, e.g.
+        jvm:
+            heap: 2g
+            min_heap: 512m
+            gc: g1
+            flags: [-XX:TieredStopAtLevel=1]
+            cds: true
+    With cds, a class data sharing archive is kept per set of jars (requires JDK 13+): the first execution
+    creates it at exit, and every later execution (of any step with the same jars) maps it at startup.
+    The archive is recreated if the jars (or the java executable) change.
+    """
+    _creating = set()  # archives being created by a running JVM
+    _lock = threading.Lock()
+
+    def __init__(self, heap=None, min_heap=None, gc=None, flags=None, cds=False, cds_dir=None):
+        if gc and gc.lower() not in GC_OPTIONS:
+            raise ValueError("unknown gc '%s', must be one of: %s" % (gc, ", ".join(sorted(GC_OPTIONS))))
+        self.heap = heap
+        self.min_heap = min_heap
+        self.gc = gc.lower() if gc else None
+        self.flags = flags if flags else []
+        self.cds = cds
+        self.cds_dir = os.path.expanduser(cds_dir) if cds_dir else DEFAULT_CDS_DIR
+
+    def get_options(self, directory, jars):
+        """
+        :param directory: the directory of the jars
+        :param jars: the classpath jars
+        :return: a tuple of the list of JVM options, and the archive the JVM creates at exit (if any),
+        to be passed to archive_done when the JVM exits
+        """
+        options = []
+        if self.min_heap:
+            options.append('-Xms%s' % self.min_heap)
+        if self.heap:
+            options.append('-Xmx%s' % self.heap)
+        if self.gc:
+            options.append(GC_OPTIONS[self.gc])
+        options.extend(self.flags)
+        if not self.cds or not jars:
+            return options, None
+        archive = self._get_archive(directory, jars)
+        with JVMProfile._lock:
+            if os.path.isfile(archive):
+                options.append('-XX:SharedArchiveFile=%s' % archive)
+                return options, None
+            if archive in JVMProfile._creating:
+                # another step is creating it: run without
+                return options, None
+            JVMProfile._creating.add(archive)
+        self._remove_stale_archives(archive)
+        options.append('-XX:ArchiveClassesAtExit=%s' % archive)
+        return options, archive
+
+    @staticmethod
+    def archive_done(archive):
+        """
+        :param archive: the archive created at exit
+        :return: True if the archive was created
+        """
+        with JVMProfile._lock:
+            JVMProfile._creating.discard(archive)
+        return os.path.isfile(archive)
+
+    def _get_archive(self, directory, jars):
+        """
+        :return: the archive path of the jars: <directory key>-<fingerprint of the jars and the java executable>.jsa
+        """
+        directory_key = hashlib.sha1(os.path.abspath(directory)).hexdigest()[:12]
+        fingerprint = hashlib.sha1()
+        java = find_executable("java")
+        for path in ([os.path.realpath(java)] if java else []) + list(jars):
+            stat = os.stat(path)
+            fingerprint.update("%s:%d:%d\n" % (path, stat.st_size, stat.st_mtime))
+        if not os.path.isdir(self.cds_dir):
+            try:
+                os.makedirs(self.cds_dir)
+            except OSError:
+                if not os.path.isdir(self.cds_dir):  # else created by a concurrent step
+                    raise
+        return os.path.join(self.cds_dir, "%s-%s.jsa" % (directory_key, fingerprint.hexdigest()[:16]))
+
+    @staticmethod
+    def _remove_stale_archives(archive):
+        """
+        remove the archives of previous versions of the same jars
+        """
+        directory_key = os.path.basename(archive).split("-")[0]
+        for stale in glob.glob(os.path.join(os.path.dirname(archive), directory_key + "-*.jsa")):
+            if stale != archive:
+                os.remove(stale)
+
+    def __repr__(self):
+        return "JVMProfile: {}".format(self.__dict__)
@@ -0,0 +1,32 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import importlib
+import threading
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+
+class LazyModule:
+    """
+    A module imported on first attribute access, so that the heavy dependencies (e.g. requests, psycopg2)
+    are only imported by the runs that use them. Submodules not imported by the package itself
+    (e.g. psycopg2.pool) are passed as well
+    """
+
+    def __init__(self, name, *submodules):
+        self.__dict__["_name"] = name
+        self.__dict__["_submodules"] = submodules
+        self.__dict__["_module"] = None
+        self.__dict__["_lock"] = threading.Lock()
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            with self._lock:
+                if self._module is None:
+                    for submodule in self._submodules:
+                        importlib.import_module(submodule)
+                    self.__dict__["_module"] = importlib.import_module(self._name)
+        return getattr(self._module, attr)
+
+    def __repr__(self):
+        return "LazyModule: %s" % self._name
@@ -1,93 +1,206 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from sqlalchemy import create_engine
-from sqlalchemy.exc import SQLAlchemyError
 
-from models import Schedule, Base
+from models import Base, ScheduleRun, ScheduleStep
 
+import os
 import sqlite3
+import threading
+from contextlib import contextmanager
 from datetime import datetime
-import traceback
 
 __author__ = 'George K. <gkiom@scify.org>'
 
+DEFAULT_HISTORY_DB = os.path.abspath(os.path.join(os.getcwd(), os.pardir)) + "/scheduler_history.db"
+DEFAULT_TRAILING_RUNS = 20  # the number of previous executions of a step to compute its statistics on
+MIN_HISTORY = 5  # the min number of previous executions of a step, to judge its duration against
+ANOMALY_FACTOR = 1.5  # a step is anomalous if it takes longer than this times its trailing p95
+
+
+def percentile(values, p):
+    """
+    :param values: a list of numbers
+    :param p: the percentile, in [0, 100]
+    :return: the nearest-rank percentile of the values (None if there are none)
+    """
+    if not values:
+        return None
+    ordered = sorted(values)
+    rank = max(int(round(p / 100.0 * len(ordered) + 0.5)) - 1, 0)
+    return ordered[min(rank, len(ordered) - 1)]
+
 
 class LocalDBAccess:
     """
-    @deprecated
+    The history of the schedules (each run, and the duration, status and items of each step),
+    in a local sqlite database
     """
-    db_name = ""
 
     def __init__(self, db_name=None):
         """
         :type db_name: String
         """
-        # if not db_name:
-        #     self.db_name = "democracit"
-        # else:
-        #     self.db_name = db_name
-        # self._init_tables()
-        pass
-
-    def _schedule_initialized(self, total_steps):
-        """ add a record to the DB to show that schedule is initialized
-        """
-        init_time_repr = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
-        schedule = Schedule(1, total_steps, init_time_repr)
-        print 'initiated new %s' % schedule
-
-    def schedule_step(self, step_num, total_steps, date_end=None):
-        """ add a record to the DB to show that schedule is initialized
-        """
-        if step_num == 1:
-            return self._schedule_initialized(total_steps)
-        # else proceed
-        init_time_repr = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
-        if not date_end:
-            schedule = Schedule(step_num, total_steps, init_time_repr)
-        else:
-            end_time_repr = datetime.strftime(date_end, '%Y-%m-%d %H:%M:%S')
-            schedule = Schedule(step_num, total_steps, init_time_repr, end_time_repr)
-        print 'step up %s' % schedule
-
-    def get_connection(self):
-        con = None
-        try:
+        self.db_name = db_name if db_name else DEFAULT_HISTORY_DB
+        self.lock = threading.Lock()  # the steps record their end concurrently
+        self._init_tables()
+
+    def start_run(self, date_start, total_steps, first=False, resumed=False):
+        """
+        add a record of a new schedule
+        :return: the ID of the run
+        """
+        with self.connection() as con:
+            cur = con.execute("INSERT INTO scheduler_runs (date_start, status, total_steps, first, resumed) "
+                              "VALUES (?, 'running', ?, ?, ?)",
+                              (_to_text(date_start), total_steps, first, resumed))
+            return cur.lastrowid
+
+    def end_run(self, run_id, status, date_end=None):
+        with self.connection() as con:
+            con.execute("UPDATE scheduler_runs SET status = ?, date_end = ? WHERE id = ?",
+                        (status, _to_text(date_end if date_end else datetime.now()), run_id))
+
+    def record_step(self, run_id, step_num, step_name, status, date_init=None, date_end=None, duration=None,
+                    cpu_time=None, items=None):
+        """
+        add a record of a step of the run
+        """
+        with self.connection() as con:
+            con.execute("INSERT INTO scheduler_steps (run_id, step_num, step_name, status, date_init, date_end, "
+                        "duration, cpu_time, items) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                        (run_id, step_num, step_name, status, _to_text(date_init), _to_text(date_end), duration,
+                         cpu_time, items))
+
+    def get_runs(self, limit=DEFAULT_TRAILING_RUNS):
+        """
+        :return: a list of the latest runs (latest first), each a dict of the run columns
+        """
+        with self.connection() as con:
+            cur = con.execute("SELECT * FROM scheduler_runs ORDER BY id DESC LIMIT ?", (limit,))
+            return [dict(row) for row in cur.fetchall()]
+
+    def get_run_steps(self, run_id):
+        """
+        :return: a list of the steps of the run, each a dict of the step columns
+        """
+        with self.connection() as con:
+            cur = con.execute("SELECT * FROM scheduler_steps WHERE run_id = ? ORDER BY id", (run_id,))
+            return [dict(row) for row in cur.fetchall()]
+
+    def get_step_durations(self, step_name, runs=DEFAULT_TRAILING_RUNS, before_run=None):
+        """
+        :param step_name: the step name
+        :param runs: the number of previous (successful) executions of the step
+        :param before_run: if set, only the executions of runs before this one
+        :return: the durations of the step, latest first
+        """
+        query = "SELECT duration FROM scheduler_steps " \
+                "WHERE step_name = ? AND status = 'done' AND duration IS NOT NULL "
+        args = (step_name,)
+        if before_run:
+            query += "AND run_id < ? "
+            args += (before_run,)
+        with self.connection() as con:
+            cur = con.execute(query + "ORDER BY id DESC LIMIT ?", args + (runs,))
+            return [row[0] for row in cur.fetchall()]
+
+    def get_duration_stats(self, step_names=None, runs=DEFAULT_TRAILING_RUNS, before_run=None):
+        """
+        :param step_names: the step names, or None for all the steps recorded
+        :param runs: the number of previous (successful) executions of each step
+        :param before_run: if set, only the executions of runs before this one
+        :return: a dict containing the count, mean, p50 and p95 of the durations of each step (with history)
+        """
+        if step_names is None:
+            with self.connection() as con:
+                step_names = [row[0] for row in con.execute("SELECT DISTINCT step_name FROM scheduler_steps")]
+        stats = {}
+        for step_name in step_names:
+            durations = self.get_step_durations(step_name, runs, before_run)
+            if durations:
+                stats[step_name] = {
+                    "count": len(durations),
+                    "mean": sum(durations) / len(durations),
+                    "p50": percentile(durations, 50),
+                    "p95": percentile(durations, 95)
+                }
+        return stats
+
+    def find_anomalies(self, run_id, runs=DEFAULT_TRAILING_RUNS, factor=ANOMALY_FACTOR):
+        """
+        :param run_id: the run to check
+        :return: a list of (step name, duration, trailing p95) of each step of the run that took longer
+        than factor times its p95 over the previous runs (steps with less than MIN_HISTORY executions are ignored)
+        """
+        steps = [step for step in self.get_run_steps(run_id) if step["duration"] is not None]
+        stats = self.get_duration_stats([step["step_name"] for step in steps], runs, before_run=run_id)
+        anomalies = []
+        for step in steps:
+            history = stats.get(step["step_name"])
+            if is_anomalous(step["duration"], history, factor):
+                anomalies.append((step["step_name"], step["duration"], history["p95"]))
+        return anomalies
+
+    @contextmanager
+    def connection(self):
+        """
+        yield a connection (rows accessible by column name), committed on success, and closed
+        """
+        with self.lock:
             con = sqlite3.connect(self.db_name)
-            return con
-        except sqlite3.Error, e:
-            if con:
-                con.rollback()
-            print 'Exception: %s :\n %s' % (e, traceback.format_exc())
+            con.row_factory = sqlite3.Row
+            try:
+                with con:
+                    yield con
+            finally:
+                con.close()
 
     def _init_tables(self):
-        con = None
-        try:
-            self.db = create_engine('sqlite:///' + self.db_name)
-            Base.metadata.create_all(self.db)
-            # get a db connection
-            con = self.get_connection()
-            # get a cursor
-            cur = con.cursor()
-            # query db (get latest comment ID)
-            cur.execute\
-                ("""
-                CREATE TABLE IF NOT EXISTS schedules(
-                   id INTEGER PRIMARY KEY   AUTOINCREMENT,
-                   start           LONG      NOT NULL,
-                   end            LONG       NULL
-                );""")
-            init_time_repr = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
-            cur.execute("INSERT INTO schedules start VALUES(%d)", (init_time_repr,))
-        except SQLAlchemyError, e:
-            if con:
-                con.rollback()
-            print 'Exception: %s :\n %s' % (e, traceback.format_exc())
-        finally:
-            if con:
-                con.close()
+        """
+        create the history tables (and their indexes), if they do not exist
+        """
+        db = create_engine('sqlite:///' + self.db_name)
+        Base.metadata.create_all(db, tables=[ScheduleRun.__table__, ScheduleStep.__table__])
+        db.dispose()
+
+
+def is_anomalous(duration, history, factor=ANOMALY_FACTOR):
+    """
+    :param duration: the duration of a step execution
+    :param history: the duration stats of the step, see get_duration_stats
+    :return: True if the duration is more than factor times the trailing p95 (given enough history)
+    """
+    return bool(history) and history["count"] >= MIN_HISTORY and duration > factor * history["p95"]
+
+
+def _to_text(date):
+    return datetime.strftime(date, '%Y-%m-%d %H:%M:%S') if date else None
 
 
 if __name__ == "__main__":
-    dba = LocalDBAccess()
-    print dba._init_tables()
\ No newline at end of file
+    import sys
+    import gflags
+
+    gflags.DEFINE_string('history_db', DEFAULT_HISTORY_DB, 'the sqlite database of the schedule history.')
+
+    gflags.DEFINE_integer('runs', DEFAULT_TRAILING_RUNS, 'the number of previous runs to compute statistics on.')
+
+    FLAGS = gflags.FLAGS
+
+    try:
+        argv = FLAGS(sys.argv)
+    except gflags.FlagsError as e:
+        print('%s\\nUsage: %s ARGS\\n%s' % (e, sys.argv[0], FLAGS))
+        sys.exit(1)
+
+    dba = LocalDBAccess(FLAGS.history_db)
+    print "%-40s %6s %10s %10s %10s" % ("step", "runs", "mean", "p50", "p95")
+    for name, stat in sorted(dba.get_duration_stats(runs=FLAGS.runs).items()):
+        print "%-40s %6d %10.1f %10.1f %10.1f" % (name, stat["count"], stat["mean"], stat["p50"], stat["p95"])
+    latest = dba.get_runs(limit=1)
+    if latest:
+        run = latest[0]
+        print "\nlatest run %d: started %s, %s" % (run["id"], run["date_start"], run["status"])
+        for name, duration, p95 in dba.find_anomalies(run["id"], runs=FLAGS.runs):
+            print "  %s took %.1f secs (p95 of previous runs: %.1f secs)" % (name, duration, p95)
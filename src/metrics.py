@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import time
+import json
+import resource
+import threading
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)  # seconds, of the http latency histograms
+
+METRIC_PREFIX = 'dit_scheduler'
+
+
+def _cpu_time():
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+class StepMetrics:
+    """
+    The metrics of a step execution: wall time, cpu time of the scheduler process while the step runs
+    (which includes any concurrent step) and of the step children, peak resident memory of the step children,
+    items processed, and count, errors, retries, requests rejected by an open circuit and latency histogram
+    of the http requests
+    """
+
+    def __init__(self, step):
+        self.step = step
+        self.status = None
+        self.wall_time = 0.0
+        self.cpu_time = 0.0
+        self.children_cpu_time = 0.0
+        self.children_max_rss_kb = 0
+        self.items = 0
+        self.http_requests = 0
+        self.http_errors = 0
+        self.http_retries = 0
+        self.http_rejected = 0
+        self.http_latency_sum = 0.0
+        self.http_latency_buckets = [0] * (len(LATENCY_BUCKETS) + 1)  # the last one is +Inf
+        self.lock = threading.Lock()
+        self._started = self._cpu_started = None
+
+    def start(self):
+        self._started, self._cpu_started = time.time(), _cpu_time()
+
+    def stop(self, status, child_reports=None):
+        """
+        :param status: the status of the step
+        :param child_reports: the reports of the child processes of the step, if any
+        """
+        self.status = status
+        self.wall_time = time.time() - self._started
+        self.cpu_time = _cpu_time() - self._cpu_started
+        for report in child_reports or []:
+            self.children_cpu_time += report["user_time"] + report["system_time"]
+            self.children_max_rss_kb = max(self.children_max_rss_kb, report["max_rss_kb"])
+
+    def add_items(self, count):
+        with self.lock:
+            self.items += count
+
+    def add_http_retry(self):
+        with self.lock:
+            self.http_retries += 1
+
+    def add_http_rejected(self):
+        with self.lock:
+            self.http_rejected += 1
+
+    def observe_http(self, latency, status_code):
+        """
+        :param latency: the duration of the request, in seconds
+        :param status_code: the response status code (an error if not 2xx)
+        """
+        with self.lock:
+            self.http_requests += 1
+            if not 200 <= status_code < 300:
+                self.http_errors += 1
+            self.http_latency_sum += latency
+            for index, bound in enumerate(LATENCY_BUCKETS):
+                if latency <= bound:
+                    self.http_latency_buckets[index] += 1
+                    break
+            else:
+                self.http_latency_buckets[-1] += 1
+
+    def as_dict(self):
+        with self.lock:
+            return {
+                "step": self.step,
+                "status": self.status,
+                "wall_time": round(self.wall_time, 3),
+                "cpu_time": round(self.cpu_time, 3),
+                "children_cpu_time": round(self.children_cpu_time, 3),
+                "children_max_rss_kb": self.children_max_rss_kb,
+                "items": self.items,
+                "http_requests": self.http_requests,
+                "http_errors": self.http_errors,
+                "http_retries": self.http_retries,
+                "http_rejected": self.http_rejected,
+                "http_latency_sum": round(self.http_latency_sum, 3),
+                "http_latency_buckets": dict(zip([str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"],
+                                                 self.http_latency_buckets))
+            }
+
+
+class MetricsRegistry:
+    """
+    The metrics of all the steps of a schedule, exported as a prometheus textfile (e.g. for the textfile
+    collector of node_exporter) and as a json summary
+    """
+
+    def __init__(self):
+        self.steps = {}
+        self.lock = threading.Lock()
+        self.started = time.time()
+
+    def step(self, name):
+        """
+        :return: the StepMetrics of the step (created on first call)
+        """
+        with self.lock:
+            if name not in self.steps:
+                self.steps[name] = StepMetrics(name)
+            return self.steps[name]
+
+    def as_dict(self):
+        return {
+            "date_start": time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(self.started)),
+            "wall_time": round(time.time() - self.started, 3),
+            "steps": [metrics.as_dict() for _, metrics in sorted(self.steps.items())]
+        }
+
+    def to_prometheus(self):
+        """
+        :return: the metrics, in the prometheus text exposition format
+        """
+        summary = self.as_dict()
+        lines = []
+
+        def metric(name, kind, description, samples):
+            lines.append("# HELP %s_%s %s" % (METRIC_PREFIX, name, description))
+            lines.append("# TYPE %s_%s %s" % (METRIC_PREFIX, name, kind))
+            for labels, value in samples:
+                label_text = ",".join('%s="%s"' % (key, _escape(val)) for key, val in labels)
+                lines.append("%s_%s%s %s" % (METRIC_PREFIX, name, "{%s}" % label_text if label_text else "", value))
+
+        steps = summary["steps"]
+        metric("run_timestamp_seconds", "gauge", "Start time of the last schedule.", [((), int(self.started))])
+        metric("run_wall_seconds", "gauge", "Wall time of the last schedule.", [((), summary["wall_time"])])
+        metric("step_success", "gauge", "1 if the step was done, else 0.",
+               [((("step", s["step"]),), 1 if s["status"] == "done" else 0) for s in steps])
+        for key, name, description in (
+                ("wall_time", "step_wall_seconds", "Wall time of the step."),
+                ("cpu_time", "step_cpu_seconds", "CPU time of the scheduler process while the step ran."),
+                ("children_cpu_time", "step_children_cpu_seconds", "CPU time of the step child processes."),
+                ("items", "step_items", "Items processed by the step."),
+                ("http_requests", "step_http_requests", "HTTP requests made by the step."),
+                ("http_errors", "step_http_errors", "HTTP requests of the step that failed."),
+                ("http_retries", "step_http_retries", "HTTP requests of the step that were retries."),
+                ("http_rejected", "step_http_rejected", "HTTP requests of the step rejected by an open circuit.")):
+            metric(name, "gauge", description, [((("step", s["step"]),), s[key]) for s in steps])
+        metric("step_children_max_rss_bytes", "gauge", "Peak resident memory of the step child processes.",
+               [((("step", s["step"]),), s["children_max_rss_kb"] * 1024) for s in steps])
+        name = "%s_step_http_request_duration_seconds" % METRIC_PREFIX
+        lines.append("# HELP %s Latency of the step HTTP requests." % name)
+        lines.append("# TYPE %s histogram" % name)
+        for s in steps:
+            step, cumulative = _escape(s["step"]), 0
+            for bound in [str(bound) for bound in LATENCY_BUCKETS] + ["+Inf"]:
+                cumulative += s["http_latency_buckets"][bound]
+                lines.append('%s_bucket{step="%s",le="%s"} %d' % (name, step, bound, cumulative))
+            lines.append('%s_sum{step="%s"} %s' % (name, step, s["http_latency_sum"]))
+            lines.append('%s_count{step="%s"} %d' % (name, step, s["http_requests"]))
+        return "\n".join(lines) + "\n"
+
+    def export(self, prometheus_file=None, json_file=None):
+        """
+        write the metrics to the files passed (each one replaced atomically)
+        """
+        if prometheus_file:
+            _write_atomically(prometheus_file, self.to_prometheus())
+        if json_file:
+            _write_atomically(json_file, json.dumps(self.as_dict(), indent=2, sort_keys=True))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def _write_atomically(path, content):
+    temp_path = path + ".tmp"
+    with open(temp_path, "w") as f:
+        f.write(content)
+    os.rename(temp_path, path)
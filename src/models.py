@@ -4,12 +4,12 @@
 __author__ = 'George K. <gkiom@scify.org>'
 
 from sqlalchemy.ext.declarative import declarative_base
-from sqlalchemy import Column, Integer, Date, ForeignKey
+from sqlalchemy import Column, Integer, String, Date, DateTime, Float, Boolean, ForeignKey, Index
 
 Base = declarative_base()
 
 
-class Schedule(Base):  # not used yet, in data model, but only for logging
+class Schedule(Base):  # not used yet, in data model, but only for logging (and the run journal)
     __tablename__ = 'schedules'
 
     id = Column(Integer, primary_key=True, nullable=False)
@@ -18,27 +18,143 @@ class Schedule(Base):  # not used yet, in data model, but only for logging
     total_steps = Column(Integer)
     date_init = Column(Date)
     date_end = Column(Date)
+    step_name = Column(String(255))  # the name of the step called
+    step_status = Column(String(16))  # running, done, failed or skipped
 
-    def __init__(self, status, total_steps, date_init, date_end=None):
+    def __init__(self, status, total_steps, date_init, date_end=None, step_name=None, step_status=None):
         self.status_step = status
         self.total_steps = total_steps
         self.date_init = date_init
         self.date_end = date_end
+        self.step_name = step_name
+        self.step_status = step_status
+
+    def as_dict(self):
+        return {"status_step": self.status_step, "total_steps": self.total_steps, "date_init": self.date_init,
+                "date_end": self.date_end, "step_name": self.step_name, "step_status": self.step_status}
 
     def __repr__(self):
         return "<Schedule:('%s', '%s', '%s', '%s')>" % (
             self.status_step, self.total_steps, self.date_init, self.date_end)
 
 
-class CommentsHistory(Base):
-    __tablename__ = 'comment_ids'
+class CommentsHistory(Base):  # the high-water mark of each incremental step of the pipeline
+    __tablename__ = 'scheduler_comment_ids'
+
+    step = Column(String(255), primary_key=True, nullable=False)  # the step name, e.g. ControllerWordCloud
+    last_comment_id = Column(Integer, nullable=False)  # the latest comment ID processed successfully by the step
+    date_updated = Column(DateTime)
+
+    def __init__(self, step, comment_id, date_updated=None):
+        self.step = step
+        self.last_comment_id = comment_id
+        self.date_updated = date_updated
+
+    def __repr__(self):
+        return "<CommentID:('%s', '%s', '%s')>" % (self.step, self.last_comment_id, self.date_updated)
+
+
+class ScheduleRun(Base):  # the history of the schedules, kept by LocalDBAccess
+    __tablename__ = 'scheduler_runs'
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    date_start = Column(DateTime, nullable=False, index=True)
+    date_end = Column(DateTime)
+    status = Column(String(16))  # running, completed or failed
+    total_steps = Column(Integer)
+    first = Column(Boolean)  # whether it was a first run
+    resumed = Column(Boolean)  # whether it resumed a previous schedule
+
+    def __init__(self, date_start, total_steps, first=False, resumed=False, status=None, date_end=None):
+        self.date_start = date_start
+        self.total_steps = total_steps
+        self.first = first
+        self.resumed = resumed
+        self.status = status
+        self.date_end = date_end
+
+    def __repr__(self):
+        return "<ScheduleRun:('%s', '%s', '%s', '%s')>" % (self.id, self.date_start, self.date_end, self.status)
+
+
+class ScheduleStep(Base):  # the history of the steps of each schedule, kept by LocalDBAccess
+    __tablename__ = 'scheduler_steps'
+    # the trailing durations of a step are read by (step_name, status), latest first
+    __table_args__ = (Index('ix_scheduler_steps_name_status_id', 'step_name', 'status', 'id'),)
 
-    pipeline_id = Column(Integer, ForeignKey('schedules.id'), primary_key=True)
-    last_commend_id = Column(Integer)
+    id = Column(Integer, primary_key=True, nullable=False)
+    run_id = Column(Integer, ForeignKey('scheduler_runs.id'), nullable=False, index=True)
+    step_num = Column(Integer)
+    step_name = Column(String(255), nullable=False)
+    status = Column(String(16), nullable=False)  # done, failed or skipped
+    date_init = Column(DateTime)
+    date_end = Column(DateTime)
+    duration = Column(Float)  # wall time, in seconds
+    cpu_time = Column(Float)  # cpu time of the step children, in seconds
+    items = Column(Integer)  # items processed by the step
+
+    def __init__(self, run_id, step_num, step_name, status, date_init=None, date_end=None, duration=None,
+                 cpu_time=None, items=None):
+        self.run_id = run_id
+        self.step_num = step_num
+        self.step_name = step_name
+        self.status = status
+        self.date_init = date_init
+        self.date_end = date_end
+        self.duration = duration
+        self.cpu_time = cpu_time
+        self.items = items
+
+    def __repr__(self):
+        return "<ScheduleStep:('%s', '%s', '%s', '%s')>" % (self.run_id, self.step_name, self.status, self.duration)
+
+
+class WordCloudFingerprint(Base):  # the state of each consultation, when its word cloud was last extracted
+    __tablename__ = 'scheduler_wordcloud_fingerprints'
+
+    consultation_id = Column(Integer, primary_key=True, nullable=False)
+    comment_count = Column(Integer, nullable=False)
+    last_comment_id = Column(Integer, nullable=False)
+    date_extracted = Column(DateTime, index=True)  # to evict the old ones by
+
+    def __init__(self, consultation_id, comment_count, last_comment_id, date_extracted=None):
+        self.consultation_id = consultation_id
+        self.comment_count = comment_count
+        self.last_comment_id = last_comment_id
+        self.date_extracted = date_extracted
+
+    def __repr__(self):
+        return "<WordCloudFingerprint:('%s', '%s', '%s', '%s')>" % (
+            self.consultation_id, self.comment_count, self.last_comment_id, self.date_extracted)
+
+
+class Job(Base):  # a job of the work queue, see work_queue.py
+    __tablename__ = 'scheduler_jobs'
+    # workers lease the oldest available job of their queue
+    __table_args__ = (Index('ix_scheduler_jobs_queue_status_id', 'queue', 'status', 'id'),)
+
+    id = Column(Integer, primary_key=True, nullable=False)
+    queue = Column(String(64), nullable=False)  # e.g. wordcloud
+    batch = Column(String(128), nullable=False, index=True)  # the step execution that enqueued the job
+    payload = Column(Integer, nullable=False)  # e.g. the consultation ID
+    status = Column(String(16), nullable=False)  # pending, leased, done, dead or cancelled
+    attempts = Column(Integer, nullable=False)
+    max_attempts = Column(Integer, nullable=False)
+    lease_time = Column(Integer, nullable=False)  # seconds
+    available_at = Column(Float)  # epoch seconds, after which a pending job may be leased
+    lease_owner = Column(String(255))  # the worker holding the lease
+    lease_expires = Column(Float)  # epoch seconds, after which the job may be leased again
+    result = Column(Integer)  # e.g. the response status code
+    error = Column(String)
 
-    def __init__(self, pipeline_id, comment_id):
-        self.pipeline_id = pipeline_id
-        self.last_commend_id = comment_id
+    def __init__(self, queue, batch, payload, max_attempts, lease_time, status='pending'):
+        self.queue = queue
+        self.batch = batch
+        self.payload = payload
+        self.max_attempts = max_attempts
+        self.lease_time = lease_time
+        self.status = status
+        self.attempts = 0
 
     def __repr__(self):
-        return "<CommentID:('%s', '%s')>" % (self.pipeline_id, self.last_commend_id)
\ No newline at end of file
+        return "<Job:('%s', '%s', '%s', '%s')>" % (self.id, self.queue, self.payload, self.status)
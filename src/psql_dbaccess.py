@@ -11,13 +11,126 @@ sudo pip install psycopg2
     sudo pip install psycopg2
 """
 
-import sys
 import os
+import re
+import time
 import traceback
-import psycopg2
+import threading
+from contextlib import contextmanager
+
+from lazy_import import LazyModule
+from models import CommentsHistory, WordCloudFingerprint
 
 __author__ = 'George K. <gkiom@scify.org>'
 
+psycopg2 = LazyModule('psycopg2', 'psycopg2.pool')  # imported on the first connection
+
+DEFAULT_POOL_MIN = 1
+DEFAULT_POOL_MAX = 10
+DEFAULT_CHECKOUT_TIMEOUT = 60  # seconds to wait for a pooled connection, while all are checked out
+DEFAULT_BATCH_SIZE = 1000  # rows fetched per round-trip by server side cursors
+EXPLAIN_WINDOW = 10000  # the number of latest comments the explained queries look after, by default
+
+# the latest comment ID (a single backward step on the comments primary key)
+LATEST_COMMENT_ID_QUERY = "SELECT max(id) FROM comments;"
+
+# the consultations commented after a comment ID, with their number of new comments and their latest comment ID,
+# most active first (most new comments, then latest activity)
+CONSULTATIONS_AFTER_QUERY = \
+    "SELECT articles.consultation_id, count(comments.id) AS new_comments, max(comments.id) AS latest_comment_id " \
+    "FROM comments " \
+    "INNER JOIN articles ON comments.article_id = articles.id " \
+    "WHERE comments.id > %s " \
+    "GROUP BY articles.consultation_id " \
+    "ORDER BY new_comments DESC, latest_comment_id DESC;"
+
+# the fingerprint (comment count and latest comment ID) of each consultation (of the ones passed, if any)
+# that differs from the one stored at its last extraction, computed in a single grouped query
+CHANGED_FINGERPRINTS_QUERY = \
+    "SELECT current.consultation_id, current.comment_count, current.last_comment_id " \
+    "FROM (" \
+    "SELECT articles.consultation_id, count(comments.id) AS comment_count, max(comments.id) AS last_comment_id " \
+    "FROM comments " \
+    "INNER JOIN articles ON comments.article_id = articles.id " \
+    "%s" \
+    "GROUP BY articles.consultation_id" \
+    ") AS current " \
+    "LEFT JOIN " + WordCloudFingerprint.__tablename__ + " AS stored " \
+    "ON stored.consultation_id = current.consultation_id " \
+    "WHERE stored.consultation_id IS NULL " \
+    "OR stored.comment_count <> current.comment_count " \
+    "OR stored.last_comment_id <> current.last_comment_id;"
+
+# the indexes the queries of the scheduler rely on: the table, the columns (the first one leading) and what for
+REQUIRED_INDEXES = (
+    ("comments", ("id", "article_id"), "an index only range scan of the comments after a comment ID"),
+    ("comments", ("article_id",), "the comments of the consultations checked for changed fingerprints"),
+    ("articles", ("id", "consultation_id"), "the consultation of each comment"),
+    ("articles", ("consultation_id",), "the articles of the consultations checked for changed fingerprints")
+)
+
+
+class DBAccessError(Exception):
+    """Base class for the errors raised by PSQLDBAccess"""
+    pass
+
+
+class DBConnectionError(DBAccessError):
+    """Raised when no (healthy) connection to the database can be established"""
+    pass
+
+
+class DBQueryError(DBAccessError):
+    """Raised when a query fails"""
+    pass
+
+
+class _ConnectionPool:
+    """
+    A thread safe connection pool, that blocks on checkout until a connection is available, or the timeout
+    passes (instead of raising at once, as psycopg2.pool does when exhausted)
+    """
+
+    def __init__(self, min_size, max_size, **connection_args):
+        self.pool = psycopg2.pool.ThreadedConnectionPool(min_size, max_size, **connection_args)
+        self.available = max_size
+        self.condition = threading.Condition()
+        self.max_size = max_size
+
+    def getconn(self, timeout=None):
+        """
+        :param timeout: the max time (in seconds) to wait for a connection, if any
+        :raise DBConnectionError: if no connection was returned to the pool within the timeout
+        """
+        deadline = time.time() + timeout if timeout else None
+        with self.condition:
+            while not self.available:
+                remaining = deadline - time.time() if deadline else None
+                if remaining is not None and remaining <= 0:
+                    raise DBConnectionError("no connection available within %g secs: all %d connections of the "
+                                            "pool are in use (see democracit_db_pool_max)" % (timeout, self.max_size))
+                self.condition.wait(remaining)
+            self.available -= 1
+        try:
+            return self.pool.getconn()
+        except Exception:
+            self._release()
+            raise
+
+    def putconn(self, con, close=False):
+        try:
+            self.pool.putconn(con, close=close)
+        finally:
+            self._release()
+
+    def _release(self):
+        with self.condition:
+            self.available += 1
+            self.condition.notify()
+
+    def closeall(self):
+        self.pool.closeall()
+
 
 class PSQLDBAccess:
     db_host = ""
@@ -25,59 +138,400 @@ class PSQLDBAccess:
     db_pw = ""
     db_name = ""
 
-    def __init__(self, db_host=None, db_user=None, db_pw=None, db_name=None):
+    _pools = {}  # process-wide connection pools, shared by all instances, per database
+    _pools_lock = threading.Lock()
+    _held = threading.local()  # the connection checked out by the current thread, per pool
+    _watermarks_table_created = False
+    _fingerprints_table_created = False
+
+    def __init__(self, db_host=None, db_user=None, db_pw=None, db_name=None, pool_min=None, pool_max=None,
+                 checkout_timeout=None):
+        """
+        :param pool_min: the number of connections opened when the pool is created
+        (default: $democracit_db_pool_min, or 1)
+        :param pool_max: the max number of connections kept open (default: $democracit_db_pool_max, or 10)
+        :param checkout_timeout: the max time (in seconds) to wait for a connection of the pool
+        (default: $democracit_db_checkout_timeout, or 60)
+        """
         if not db_name:
-            self.db_name = "democracit"
+            self.db_name = os.getenv("democracit_db_name", "democracit")
         else:
             self.db_name = db_name
+        self.pool_min = pool_min if pool_min else int(os.getenv("democracit_db_pool_min", DEFAULT_POOL_MIN))
+        self.pool_max = pool_max if pool_max else int(os.getenv("democracit_db_pool_max", DEFAULT_POOL_MAX))
+        self.checkout_timeout = checkout_timeout if checkout_timeout else \
+            float(os.getenv("democracit_db_checkout_timeout", DEFAULT_CHECKOUT_TIMEOUT))
         # get variables (local)
         # self._get_variables(db_host, db_user, db_pw)
 
     def get_updated_consultations(self, prev_comment_id):
         """
-        get a set of consultations to run
+        get the consultations to run, most active first
+        :return: a list of consultation IDs
         """
-        return self._get_consultation_ids_after(prev_comment_id)
+        return [each[0] for each in self._get_consultation_ids_after(prev_comment_id)]
+
+    def iter_updated_consultations(self, prev_comment_id, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        stream the consultations to run in batches, using a server side cursor, so that they are not
+        all loaded in memory, and the first batch is available before the query is exhausted
+        :param batch_size: the max number of consultation IDs per batch
+        :return: a generator of lists of consultation IDs, most active first
+        """
+        with self.connection() as con:
+            # get a named (server side) cursor
+            cur = con.cursor(name="consultation_ids_after")
+            cur.itersize = batch_size
+            # query db (get consultations required)
+            cur.execute(CONSULTATIONS_AFTER_QUERY, (prev_comment_id,))
+            while True:
+                # get the next batch of results
+                consultations = cur.fetchmany(batch_size)
+                if not consultations:
+                    break
+                yield [each[0] for each in consultations]
+            cur.close()
+
+    def get_consultation_activity(self, prev_comment_id):
+        """
+        get the consultations commented after the comment ID passed, with their latest comment
+        :return: a dict containing the latest comment ID of each consultation
+        """
+        return dict((consultation_id, latest_comment_id)
+                    for consultation_id, _, latest_comment_id in self._get_consultation_ids_after(prev_comment_id))
 
     def get_latest_comment_id(self):
         """
         return the latest comment inserted by the crawler
         call this before crawler initiation
         """
-        con = None
-        try:
-            # get a db connection
-            con = self.get_connection()
+        with self.connection() as con:
             # get a cursor
             cur = con.cursor()
             # query db (get latest comment ID)
-            cur.execute("SELECT id from comments ORDER BY id DESC LIMIT 1;")
-            # get results
-            prev_comment = cur.fetchall()
-            # get response
-            return prev_comment[0][0] if isinstance(prev_comment, list) else prev_comment[0] \
-                if isinstance(prev_comment, tuple) else prev_comment
+            cur.execute(LATEST_COMMENT_ID_QUERY)
+            # get response (NULL if there are no comments)
+            prev_comment = cur.fetchone()
+            return prev_comment[0] if prev_comment and prev_comment[0] is not None else 0
+
+    def get_step_watermark(self, step):
+        """
+        :param step: the step name
+        :return: the latest comment ID processed by the step, or None if the step has never completed
+        """
+        self._create_watermarks_table()
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute("SELECT last_comment_id FROM " + CommentsHistory.__tablename__ + " WHERE step = %s;",
+                        (step,))
+            watermark = cur.fetchone()
+            return watermark[0] if watermark else None
+
+    def set_step_watermark(self, step, comment_id):
+        """
+        store the latest comment ID processed by the step (in a single transaction)
+        :param step: the step name
+        :param comment_id: the comment ID
+        """
+        self._create_watermarks_table()
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute("UPDATE " + CommentsHistory.__tablename__ + " SET last_comment_id = %s, date_updated = now() "
+                        "WHERE step = %s;", (comment_id, step))
+            if cur.rowcount == 0:
+                cur.execute("INSERT INTO " + CommentsHistory.__tablename__ + " (step, last_comment_id, date_updated) "
+                            "VALUES (%s, %s, now());", (step, comment_id))
+
+    def get_changed_fingerprints(self, consultation_ids=None):
+        """
+        :param consultation_ids: the consultations to check, or None for all the consultations
+        :return: a dict containing the (comment count, latest comment ID) fingerprint of each consultation
+        that has changed since its last extraction (or has never been extracted)
+        """
+        self._create_fingerprints_table()
+        if consultation_ids is not None and not consultation_ids:
+            return {}
+        with self.connection() as con:
+            cur = con.cursor()
+            if consultation_ids is None:
+                cur.execute(CHANGED_FINGERPRINTS_QUERY % "")
+            else:
+                cur.execute(CHANGED_FINGERPRINTS_QUERY % "WHERE articles.consultation_id = ANY(%s) ",
+                            (list(consultation_ids),))
+            return dict((row[0], (row[1], row[2])) for row in cur.fetchall())
+
+    def set_fingerprints(self, fingerprints):
+        """
+        store the fingerprints of the consultations extracted (in a single transaction)
+        :param fingerprints: a dict containing the (comment count, latest comment ID) of each consultation
+        """
+        if not fingerprints:
+            return
+        self._create_fingerprints_table()
+        with self.connection() as con:
+            cur = con.cursor()
+            for consultation_id, (comment_count, last_comment_id) in fingerprints.items():
+                cur.execute("UPDATE " + WordCloudFingerprint.__tablename__ + " SET comment_count = %s, "
+                            "last_comment_id = %s, date_extracted = now() WHERE consultation_id = %s;",
+                            (comment_count, last_comment_id, consultation_id))
+                if cur.rowcount == 0:
+                    cur.execute("INSERT INTO " + WordCloudFingerprint.__tablename__ + " (consultation_id, "
+                                "comment_count, last_comment_id, date_extracted) VALUES (%s, %s, %s, now());",
+                                (consultation_id, comment_count, last_comment_id))
+
+    def invalidate_fingerprints(self, consultation_ids=None):
+        """
+        drop the fingerprints of the consultations passed (or all), so that they are extracted again
+        :return: the number of fingerprints dropped
+        """
+        self._create_fingerprints_table()
+        with self.connection() as con:
+            cur = con.cursor()
+            if consultation_ids is None:
+                cur.execute("DELETE FROM " + WordCloudFingerprint.__tablename__ + ";")
+            else:
+                cur.execute("DELETE FROM " + WordCloudFingerprint.__tablename__ + " WHERE consultation_id = ANY(%s);",
+                            (list(consultation_ids),))
+            return cur.rowcount
+
+    def evict_fingerprints(self, max_age_days):
+        """
+        drop the fingerprints older than max_age_days, so that every word cloud is refreshed at least that often
+        :return: the number of fingerprints dropped
+        """
+        self._create_fingerprints_table()
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute("DELETE FROM " + WordCloudFingerprint.__tablename__ +
+                        " WHERE date_extracted < now() - %s * interval '1 day';", (max_age_days,))
+            return cur.rowcount
+
+    def acquire_advisory_lock(self, key):
+        """
+        take the (session level) advisory lock, if no other session holds it
+        :param key: the lock key
+        :return: the connection holding the lock, to release it with, or None if the lock is held by another session
+        """
+        con = self.get_connection()
+        try:
+            cur = con.cursor()
+            cur.execute("SELECT pg_try_advisory_lock(%s);", (key,))
+            locked = cur.fetchone()[0]
+            con.commit()
         except psycopg2.DatabaseError, e:
-            if con:
-                con.rollback()
-            print 'Exception: %s :\n %s' % (e, traceback.format_exc())
+            con.close()
+            raise DBQueryError('%s :\n %s' % (e, traceback.format_exc()))
+        if not locked:
+            con.close()
+            return None
+        return con
+
+    @staticmethod
+    def release_advisory_lock(con, key):
+        """
+        :param con: the connection holding the lock, as returned by acquire_advisory_lock
+        :param key: the lock key
+        """
+        try:
+            if not con.closed:
+                cur = con.cursor()
+                cur.execute("SELECT pg_advisory_unlock(%s);", (key,))
+                con.commit()
+        except psycopg2.Error:
+            pass  # the lock is released with the session anyway
         finally:
-            if con:
-                con.close()
+            con.close()
+
+    @contextmanager
+    def connection(self):
+        """
+        check out a (healthy) connection from the shared pool, and return it to the pool when done.
+        The transaction is committed if the block succeeds, else rolled back.
+        A block nested in another one of the same thread (e.g. while a server side cursor is streamed) reuses
+        its connection, within its transaction, so that a thread never waits for a second connection.
+        usage:
+            with self.connection() as con:
+                cur = con.cursor()
+        :raise DBConnectionError: if no connection can be established, or none is available within the timeout
+        :raise DBQueryError: if a database error occurs in the block
+        """
+        pool = self._get_pool()
+        held = self._held_connections()
+        if pool in held:
+            try:
+                yield held[pool]
+            except psycopg2.DatabaseError, e:
+                raise DBQueryError('%s :\n %s' % (e, traceback.format_exc()))
+            return
+        con = held[pool] = self._checkout(pool)
+        try:
+            yield con
+            con.commit()
+        except psycopg2.DatabaseError, e:
+            self._rollback(con)
+            raise DBQueryError('%s :\n %s' % (e, traceback.format_exc()))
+        except:
+            # including GeneratorExit, when a generator holding the connection is closed early
+            self._rollback(con)
+            raise
+        finally:
+            del held[pool]
+            pool.putconn(con, close=bool(con.closed))
 
     def get_connection(self):
-        con = None
+        """
+        :return: a new connection, not managed by the pool
+        :raise DBConnectionError: if the connection can not be established
+        """
         try:
-            con = psycopg2.connect(host=os.getenv("democracit_db_host", self.db_host),
-                                   dbname=self.db_name,
-                                   user=os.getenv("democracit_db_user", self.db_user),
-                                   password=os.getenv("democracit_db_pw", self.db_pw))
-            return con
+            return psycopg2.connect(**self._connection_args())
         except psycopg2.DatabaseError, e:
-            if con:
+            raise DBConnectionError('%s :\n %s' % (e, traceback.format_exc()))
+
+    @classmethod
+    def close_all(cls):
+        """
+        close all the pooled connections of the process
+        """
+        with cls._pools_lock:
+            for pool in cls._pools.values():
+                pool.closeall()
+            cls._pools.clear()
+
+    def _connection_args(self):
+        return dict(host=os.getenv("democracit_db_host", self.db_host),
+                    dbname=self.db_name,
+                    user=os.getenv("democracit_db_user", self.db_user),
+                    password=os.getenv("democracit_db_pw", self.db_pw))
+
+    def _get_pool(self):
+        """
+        :return: the process-wide pool of this database, created on first use
+        """
+        args = self._connection_args()
+        key = (args["host"], args["dbname"], args["user"])
+        with PSQLDBAccess._pools_lock:
+            if key not in PSQLDBAccess._pools:
+                try:
+                    PSQLDBAccess._pools[key] = _ConnectionPool(self.pool_min, self.pool_max, **args)
+                except psycopg2.DatabaseError, e:
+                    raise DBConnectionError('%s :\n %s' % (e, traceback.format_exc()))
+            return PSQLDBAccess._pools[key]
+
+    def _checkout(self, pool):
+        """
+        get a connection from the pool, discarding the broken ones (e.g. closed by a database restart)
+        """
+        for _ in range(pool.max_size + 1):
+            try:
+                con = pool.getconn(self.checkout_timeout)
+            except psycopg2.Error, e:
+                raise DBConnectionError('%s :\n %s' % (e, traceback.format_exc()))
+            if self._is_healthy(con):
+                return con
+            pool.putconn(con, close=True)
+        raise DBConnectionError("no healthy connection available in the pool")
+
+    @staticmethod
+    def _held_connections():
+        """
+        :return: a dict containing the connection checked out by the current thread, of each pool
+        """
+        if not hasattr(PSQLDBAccess._held, "connections"):
+            PSQLDBAccess._held.connections = {}
+        return PSQLDBAccess._held.connections
+
+    def _create_watermarks_table(self):
+        """
+        create the step watermarks table, if not already created by this process
+        """
+        if PSQLDBAccess._watermarks_table_created:
+            return
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute("CREATE TABLE IF NOT EXISTS " + CommentsHistory.__tablename__ + " ("
+                        "step varchar(255) PRIMARY KEY, "
+                        "last_comment_id integer NOT NULL, "
+                        "date_updated timestamp);")
+        PSQLDBAccess._watermarks_table_created = True
+
+    def _create_fingerprints_table(self):
+        """
+        create the word cloud fingerprints table, if not already created by this process
+        """
+        if PSQLDBAccess._fingerprints_table_created:
+            return
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute("CREATE TABLE IF NOT EXISTS " + WordCloudFingerprint.__tablename__ + " ("
+                        "consultation_id integer PRIMARY KEY, "
+                        "comment_count integer NOT NULL, "
+                        "last_comment_id integer NOT NULL, "
+                        "date_extracted timestamp);")
+            cur.execute("CREATE INDEX IF NOT EXISTS " + WordCloudFingerprint.__tablename__ + "_date_extracted "
+                        "ON " + WordCloudFingerprint.__tablename__ + " (date_extracted);")
+        PSQLDBAccess._fingerprints_table_created = True
+
+    def explain_queries(self, prev_comment_id=None):
+        """
+        run EXPLAIN ANALYZE on the queries of the scheduler (they are executed, but only read)
+        :param prev_comment_id: the comment ID to query the comments after (default: the latest comment ID,
+        less EXPLAIN_WINDOW)
+        :return: a list of (query name, plan) tuples, each plan a list of lines
+        """
+        if prev_comment_id is None:
+            prev_comment_id = max(self.get_latest_comment_id() - EXPLAIN_WINDOW, 0)
+        self._create_fingerprints_table()
+        sample = self.get_updated_consultations(prev_comment_id)[:DEFAULT_BATCH_SIZE]
+        queries = [
+            ("latest comment ID", LATEST_COMMENT_ID_QUERY, None),
+            ("consultations commented after %d" % prev_comment_id, CONSULTATIONS_AFTER_QUERY, (prev_comment_id,)),
+            ("changed fingerprints of all the consultations", CHANGED_FINGERPRINTS_QUERY % "", None),
+            ("changed fingerprints of %d consultations" % len(sample),
+             CHANGED_FINGERPRINTS_QUERY % "WHERE articles.consultation_id = ANY(%s) ", (sample,))
+        ]
+        plans = []
+        with self.connection() as con:
+            cur = con.cursor()
+            for name, query, args in queries:
+                cur.execute("EXPLAIN (ANALYZE, BUFFERS) " + query, args)
+                plans.append((name, [row[0] for row in cur.fetchall()]))
+        return plans
+
+    def get_missing_indexes(self):
+        """
+        :return: a list of the REQUIRED_INDEXES (table, columns, what for) that no index of the current schema
+        covers: led by the first column, with the rest among its key or included columns
+        """
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute("SELECT tablename, indexdef FROM pg_indexes "
+                        "WHERE schemaname = ANY(current_schemas(false)) AND tablename = ANY(%s);",
+                        (sorted(set(table for table, _, _ in REQUIRED_INDEXES)),))
+            indexes = [(table, _index_columns(indexdef)) for table, indexdef in cur.fetchall()]
+        return [(table, columns, reason) for table, columns, reason in REQUIRED_INDEXES
+                if not any(other == table and key[:1] == list(columns[:1]) and set(columns) <= set(key + included)
+                           for other, (key, included) in indexes)]
+
+    @staticmethod
+    def _is_healthy(con):
+        if con.closed:
+            return False
+        try:
+            cur = con.cursor()
+            cur.execute("SELECT 1;")
+            con.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    @staticmethod
+    def _rollback(con):
+        if not con.closed:
+            try:
                 con.rollback()
-            print 'Exception: %s :\n %s' % (e, traceback.format_exc())
-            sys.exit(1)
+            except psycopg2.Error:
+                pass
 
     def _get_variables(self, db_host, db_user, db_pw):
         """
@@ -106,34 +560,29 @@ class PSQLDBAccess:
 
     def _get_consultation_ids_after(self, prev_comment_id):
         """
-        return a set of consultation IDs
+        return the consultations commented after the comment ID passed, most active first
+        :return: a list of (consultation ID, number of new comments, latest comment ID) tuples
         """
-        con = None
-        try:
-            # get a db connection
-            con = self.get_connection()
+        with self.connection() as con:
             # get a cursor
             cur = con.cursor()
             # query db (get consultations required)
-            cur.execute(
-                "SELECT distinct(consultation.id) "
-                "FROM consultation "
-                "INNER JOIN articles ON articles.consultation_id = consultation.id "
-                "INNER JOIN comments ON comments.article_id = articles.id "
-                "WHERE comments.id > %s "
-                "ORDER BY consultation.id DESC;", (prev_comment_id,))
+            cur.execute(CONSULTATIONS_AFTER_QUERY, (prev_comment_id,))
             # get all results at once
-            consultations = cur.fetchall()
-            # get a set of all the consultation IDs
-            return {each[0] for each in consultations if isinstance(each, tuple)}
-        except psycopg2.DatabaseError, e:
-            if con:
-                con.rollback()
-            print 'Exception: %s :\n %s' % (e, traceback.format_exc())
-            sys.exit(1)
-        finally:
-            if con:
-                con.close()
+            return [tuple(each) for each in cur.fetchall()]
+
+
+def _index_columns(indexdef):
+    """
+    :param indexdef: an index definition, as in pg_indexes, e.g.
+    CREATE INDEX comments_idx ON public.comments USING btree (id, article_id) INCLUDE (date_added)
+    :return: the key columns and the included columns of the index (expressions are left as they are)
+    """
+    match = re.search(r"USING \w+ \((.*?)\)(?: INCLUDE \((.*?)\))?(?: WHERE .*)?$", indexdef)
+    if not match:
+        return [], []
+    return [[column.strip().split(" ")[0].strip('"') for column in columns.split(",")] if columns else []
+            for columns in match.groups()]
 
 
 if __name__ == "__main__":
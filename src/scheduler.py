@@ -1,236 +1,1476 @@
 #!/usr/bin/python
 # -*- coding: utf-8 -*-
 from datetime import datetime
-import subprocess
+import time
 import os
 import re
 import importlib
-import requests
-import yaml
+import itertools
+import threading
+import Queue
+from multiprocessing.pool import ThreadPool
 import json
-from psql_dbaccess import PSQLDBAccess
-from dit_logger import DITLogger
+import urlparse
+import urllib
+from psql_dbaccess import PSQLDBAccess, DBAccessError, DEFAULT_BATCH_SIZE
+from local_dbaccess import LocalDBAccess, DEFAULT_HISTORY_DB, ANOMALY_FACTOR, is_anomalous
+from dit_logger import DITLogger, DEFAULT_MAX_BYTES as DEFAULT_LOG_MAX_BYTES, \
+    DEFAULT_BACKUP_COUNT as DEFAULT_LOG_BACKUP_COUNT
+from models import Schedule
+from classpath import ClasspathResolver
+from jvm_profile import JVMProfile
+from child_process import ChildProcessRunner, ResourceLimits
+from scheduler_daemon import SchedulerDaemon, RunLock, CronExpression, DEFAULT_LOCK_FILE
+from work_queue import get_work_queue, JOB_PENDING, JOB_LEASED, JOB_DONE, DEFAULT_QUEUE_NAME, DEFAULT_LEASE_TIME, \
+    DEFAULT_MAX_ATTEMPTS
+from metrics import MetricsRegistry
+from channels import ChannelRegistry, CHANNEL_TYPES
+from http_client import HTTPClient, CircuitOpenError, DEFAULT_CONNECT_TIMEOUT, DEFAULT_RETRIES
 
 __author__ = 'George K. <gkiom@scify.org>'
 
 CLASS_LABEL = 'class'
 PACKAGE_LABEL = 'package'
 PARAM_LABEL = 'params'
+NAME_LABEL = 'name'
+DEPENDS_LABEL = 'depends_on'
+STAGE_LABEL = 'stage'
+STEPS_LABEL = 'steps'
+TRIGGERS_LABEL = 'triggers'
+INPUTS_LABEL = 'inputs'
+OUTPUTS_LABEL = 'outputs'
+
+CONSULTATIONS_OUTPUT = 'consultations'  # the output of the consultations updated by the crawler
+
+STATUS_RUNNING = 'running'
+STATUS_DONE = 'done'
+STATUS_FAILED = 'failed'
+STATUS_SKIPPED = 'skipped'
+STATUS_COMPLETED = 'completed'  # the whole schedule is done
+
+DEFAULT_MAX_WORKERS = 4
 
 DEFAULT_LOG_FILE = os.path.abspath(os.path.join(os.getcwd(), os.pardir)) + "/scheduler.log"
-LOCAL_TEMP_FILE = os.path.abspath(os.path.join(os.getcwd(), os.pardir)) + "/tmp.json"
+RUN_JOURNAL_FILE = os.path.abspath(os.path.join(os.getcwd(), os.pardir)) + "/run_journal.json"
+WORDCLOUD_SUMMARY_FILE = os.path.abspath(os.path.join(os.getcwd(), os.pardir)) + "/wordcloud_summary.json"
+METRICS_FILE = os.path.abspath(os.path.join(os.getcwd(), os.pardir)) + "/scheduler_metrics.json"
+SCHEDULE_CACHE_FILE = os.path.abspath(os.path.join(os.getcwd(), os.pardir)) + "/schedules_cache.json"
+SCHEDULE_CACHE_VERSION = 2  # the version of the compiled schedule format, part of the cache key
+
+DEFAULT_HTTP_TIMEOUT = 60  # seconds
+DEFAULT_IMPORT_POLL_INTERVAL = 5  # seconds
+DEFAULT_IMPORT_DEADLINE = 3600  # seconds
+DEFAULT_TAIL_POLL_INTERVAL = 60  # seconds
+DEFAULT_TAIL_QUIET_PERIOD = 300  # seconds
+DEFAULT_DRAIN_POLL_INTERVAL = 5  # seconds
+
+INDEX_MODE_FULL = 'full'
+INDEX_MODE_DELTA = 'delta'
+
+
+class StepFailedError(Exception):
+    """Raised by a controller to mark its step as failed, so that the steps depending on it are skipped"""
+    pass
+
+
+class RunContext:
+    """The storage and the logger of the process, shared by the scheduler and all its controllers"""
+    _current = None
+    _lock = threading.Lock()
+
+    def __init__(self, log_file=None):
+        self.psql = PSQLDBAccess()
+        self.logger = DITLogger(filename=log_file if log_file else DEFAULT_LOG_FILE)
+
+    @classmethod
+    def get(cls, log_file=None):
+        """
+        :return: the context of the process (created on first call)
+        """
+        with cls._lock:
+            if cls._current is None:
+                cls._current = RunContext(log_file)
+            return cls._current
 
 
 class Scheduler:
     """Main scheduler implementation"""
     total = 0  # total controllers
-    results = {}  # results of each module, if any
     prev_comment_id = 0  # comment ID from previous schedule
     date_start = 0  # start date of schedule
+    first = False  # whether this is the first execution
+    incremental = False  # whether the controller keeps its own watermark (latest comment ID processed)
+    step_name = None  # the name of the step executing the controller
+    watermark = None  # the latest comment ID processed by the controller, on its previous successful execution
+    high_watermark = None  # the latest comment ID, when the controller was executed
+    child_reports = None  # the reports of the child processes started by the controller, if any
+    produces_comments = False  # whether the controller inserts comments, while executing
+    overlap_crawl = False  # whether the controller processes comments while they are inserted
+    metrics = None  # the StepMetrics of the controller, while executed in a schedule
+    inputs = None  # the channels the controller consumes (by name), while executed in a schedule
+    outputs = None  # the channels the controller produces (by name), while executed in a schedule
 
-    def __init__(self, log_file=None, schedules=None):
-        # init storage
-        self.psql = PSQLDBAccess()
-        # init logger
-        self.logger = DITLogger(filename=log_file if log_file else DEFAULT_LOG_FILE)
-        # schedules file
+    def __init__(self, log_file=None, schedules=None, max_workers=None, heavy_slots=None, metrics_file=None,
+                 prometheus_file=None, history_db=None, schedule_cache=None):
+        # init storage and logger (shared by the scheduler and the controllers)
+        context = RunContext.get(log_file)
+        self.psql = context.psql
+        self.logger = context.logger
+        # schedules file, and the cache of its compiled form
         self.schedule_settings_file = schedules
+        self.schedule_cache = schedule_cache
+        # max number of steps executed concurrently
+        self.max_workers = max_workers if max_workers else DEFAULT_MAX_WORKERS
+        # max number of heavy child processes (e.g. JVMs) running concurrently, for all steps
+        if heavy_slots:
+            ChildProcessRunner.set_heavy_slots(heavy_slots)
+        # the json summary and the prometheus textfile of the metrics of each schedule
+        self.metrics_file = metrics_file if metrics_file else METRICS_FILE
+        self.prometheus_file = prometheus_file
+        # the history of the schedules, and the trailing duration stats of each step
+        self.history_db = history_db
+        self.history = None  # created when a schedule starts
+        self.run_id = None
+        self.duration_stats = {}
 
-    def execute_pipeline(self, first=False):
+    def execute_pipeline(self, first=False, resume=False):
         """
         Execute the schedule, as stated in the yaml file
         :param first: flag to define first execution
+        :param resume: if the previous schedule did not complete, skip the steps it has already done
+        (feeding their stored outputs to the rest), instead of starting a new schedule
         """
         # mark started
         self.date_start = datetime.now()
-        # get all modules to execute
-        modules = Scheduler.get_modules(self.schedule_settings_file)
-        self.total = len(modules)
-        # get previous comment ID
-        if not first:
-            self.prev_comment_id = self.psql.get_latest_comment_id()
-        else:
-            self.prev_comment_id = 0
-        self._store({"prev_comment_id": self.prev_comment_id}, LOCAL_TEMP_FILE)
+        self.first = first
+        # get all steps to execute, and the steps each one waits for: their controllers are built lazily
+        self.schedule = CompiledSchedule.load(self.schedule_settings_file, self.schedule_cache)
+        names = self.names = self.schedule.names
+        dependencies = self.schedule.dependencies
+        self.modules = {}  # the controllers built so far
+        self.modules_lock = threading.Lock()
+        self.total = len(names)
+        self.registry = MetricsRegistry()
+        # the channels between the steps, released when the schedule ends
+        self.channels = ChannelRegistry(self.schedule.get_channel_types())
+        done = self._resume_journal() if resume else []
+        if not done:
+            # get previous comment ID
+            if not first:
+                self.prev_comment_id = self.psql.get_latest_comment_id()
+            else:
+                self.prev_comment_id = 0
+            self._new_journal()
+        self._start_history(names, resumed=bool(done))
         # log initialization
         self.logger.info("Initializing schedule for %d modules. "
                          "Last comment id: %d" % (self.total, self.prev_comment_id))
         # execute pipeline
-        for step, controller in modules.items():
-            self._execute_controller(step, controller)
+        statuses = self._execute_graph(dependencies, done)
+        for step, status in statuses.items():
+            metrics = self.registry.step(names[step])
+            if metrics.status is None:  # resumed, skipped, or not built
+                metrics.status = status
+                if step not in done:
+                    self._call_history("record_step", step, names[step], status)
+        for step in sorted(statuses):
+            if statuses[step] != STATUS_DONE:
+                self.logger.error("step %d (%s) %s" % (step, names[step], statuses[step]))
+        completed = all(status == STATUS_DONE for status in statuses.values())
+        self._journal_end(STATUS_COMPLETED if completed else STATUS_FAILED)
+        self._call_history("end_run", STATUS_COMPLETED if completed else STATUS_FAILED)
+        self._export_metrics()
+        self.channels.release()
+        self.modules = {}
 
         # finalized
-        self.logger.schedule_step(step_num=step, total_steps=self.total, date_start=self.date_start,
+        self.logger.schedule_step(step_num=self.total, total_steps=self.total, date_start=self.date_start,
                                   date_end=datetime.now())
 
+    def _new_journal(self):
+        """
+        start the journal of a new schedule
+        """
+        self.journal = {
+            "date_start": datetime.strftime(self.date_start, '%Y-%m-%d %H:%M:%S'),
+            "date_end": None,
+            "status": STATUS_RUNNING,
+            "first": self.first,
+            "prev_comment_id": self.prev_comment_id,
+            "steps": {}
+        }
+        self.journal_lock = threading.Lock()
+        self._store(self.journal, RUN_JOURNAL_FILE)
+
+    def _resume_journal(self):
+        """
+        continue the journal of the previous schedule, if it did not complete, restoring the channels
+        produced by the steps already done (a step whose child process exited with a nonzero code is done again)
+        :return: the list of steps already done
+        """
+        journal = self._load(RUN_JOURNAL_FILE)
+        if not journal or journal.get("status") == STATUS_COMPLETED:
+            self.logger.info("No incomplete schedule to resume: starting a new one")
+            return []
+        self.journal = journal
+        self.journal["status"] = STATUS_RUNNING
+        self.journal_lock = threading.Lock()
+        self.first = journal["first"]
+        self.prev_comment_id = journal["prev_comment_id"]
+        done = []
+        for step, name in self.names.items():
+            entry = journal["steps"].get(name)
+            if entry and entry["step_status"] == STATUS_DONE and not entry.get("returncode"):
+                done.append(step)
+                for output in self.schedule.steps[step][OUTPUTS_LABEL]:
+                    channel = self.channels.get(output)
+                    channel.extend(entry.get("channels", {}).get(output, []))
+                    channel.close()
+        self.logger.info("Resuming schedule started at %s: skipping %d steps already done (%s)"
+                         % (journal["date_start"], len(done), ", ".join(self.names[step] for step in sorted(done))))
+        self._store(self.journal, RUN_JOURNAL_FILE)
+        return done
+
+    def _journal_step(self, step, controller, status, date_init, date_end=None, output=None):
+        """
+        record the status (and the output, the channels produced and the child process reports, if any)
+        of the step to the journal, along with the exit code of its child processes (the first nonzero one,
+        else 0, or None if it started none)
+        """
+        entry = Schedule(step, self.total, datetime.strftime(date_init, '%Y-%m-%d %H:%M:%S'),
+                         datetime.strftime(date_end, '%Y-%m-%d %H:%M:%S') if date_end else None,
+                         step_name=controller.step_name, step_status=status).as_dict()
+        entry["output"] = output
+        if status == STATUS_DONE and controller.outputs:
+            entry["channels"] = dict((name, channel.items) for name, channel in controller.outputs.items())
+        entry["children"] = controller.child_reports
+        returncodes = [report["returncode"] for report in controller.child_reports or []]
+        entry["returncode"] = next((code for code in returncodes if code != 0), 0) if returncodes else None
+        with self.journal_lock:
+            self.journal["steps"][controller.step_name] = entry
+            self._store(self.journal, RUN_JOURNAL_FILE)
+
+    def _journal_end(self, status):
+        with self.journal_lock:
+            self.journal["status"] = status
+            self.journal["date_end"] = datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S')
+            self._store(self.journal, RUN_JOURNAL_FILE)
+
+    def _start_history(self, names, resumed=False):
+        """
+        record the new run to the history, and load the trailing duration stats of its steps
+        :param names: a dict containing the name of each step
+        :param resumed: whether the run resumes a previous schedule
+        """
+        try:
+            if not self.history:
+                self.history = LocalDBAccess(self.history_db)
+            self.run_id = self.history.start_run(self.date_start, self.total, self.first, resumed)
+            self.duration_stats = self.history.get_duration_stats(names.values())
+        except Exception, ex:  # the history never fails a schedule
+            self.logger.exception(ex)
+            self.run_id = None
+
+    def _call_history(self, method, *args):
+        """
+        record to the history of the current run, if any: errors are logged, and never fail the schedule
+        :param method: the LocalDBAccess method name, called with the run ID and the args passed
+        """
+        if self.run_id is None:
+            return
+        try:
+            getattr(self.history, method)(self.run_id, *args)
+        except Exception, ex:
+            self.logger.exception(ex)
+
+    def _export_metrics(self):
+        """
+        store the metrics of the schedule steps, as a json summary and as a prometheus textfile (if set)
+        """
+        try:
+            self.registry.export(prometheus_file=self.prometheus_file, json_file=self.metrics_file)
+        except (IOError, OSError), ex:
+            self.logger.exception(ex)
+
+    def _execute_graph(self, dependencies, done=()):
+        """
+        Execute the steps, each one as soon as all the steps it depends on are done (and the steps producing
+        its inputs have started). Independent steps run concurrently, in at most self.max_workers threads.
+        If a step fails, all the steps depending on it are skipped.
+        :param dependencies: a dict containing the set of steps that each step waits for
+        :param done: the steps already done, not to be executed
+        :return: a dict containing the status of each step
+        """
+        statuses = dict((step, STATUS_DONE) for step in done)
+        waiting = dict((step, set(deps)) for step, deps in dependencies.items() if step not in statuses)
+        finished = Queue.Queue()
+        running = {}  # the start time of each step running
+        while waiting or running:
+            for step in sorted(waiting):
+                deps = waiting[step]
+                if any(statuses.get(dep) in (STATUS_FAILED, STATUS_SKIPPED) for dep in deps):
+                    del waiting[step]
+                    statuses[step] = STATUS_SKIPPED
+                    self._close_outputs(step, failed=True)
+                elif len(running) < self.max_workers and all(statuses.get(dep) == STATUS_DONE for dep in deps) \
+                        and all(producer in running or producer in statuses
+                                for producer in self.schedule.get_producers(step)):
+                    del waiting[step]
+                    running[step] = time.time()
+                    self._start_worker(step, finished)
+            if running:
+                # wait for any of the running steps to finish
+                step, status = finished.get()
+                statuses[step] = status
+                del running[step]
+                if (waiting or running) and self.duration_stats:
+                    self.logger.info("estimated remaining time: %.0f secs"
+                                     % self._estimate_remaining(statuses, running, dependencies))
+        return statuses
+
+    def _estimate_remaining(self, statuses, running, dependencies):
+        """
+        :param statuses: the status of each step finished
+        :param running: the start time of each step running
+        :param dependencies: a dict containing the set of steps that each step waits for
+        :return: the estimated time (in seconds) until the schedule ends: the longest chain of the remaining
+        steps, each one taking its trailing median duration (less the time it has already run)
+        """
+        now = time.time()
+        finish = {}
+
+        def remaining(step):
+            if step not in finish:
+                own = 0.0
+                if step not in statuses:
+                    stats = self.duration_stats.get(self.names[step])
+                    own = stats["p50"] if stats else 0.0
+                    if step in running:
+                        own = max(own - (now - running[step]), 0.0)
+                finish[step] = own + max([remaining(dep) for dep in dependencies[step]] or [0.0])
+            return finish[step]
+
+        return max([remaining(step) for step in dependencies] or [0.0])
+
+    def _start_worker(self, step, finished):
+        """
+        Build and execute the controller of the step in a new thread, and put its (step, status)
+        to the finished queue when done
+        """
+        def work():
+            try:
+                controller = self._get_controller(step)
+            except Exception, ex:  # e.g. an unknown class, or invalid params
+                self.logger.exception(ex, step=self.names[step])
+                self._close_outputs(step, failed=True)
+                finished.put((step, STATUS_FAILED))
+                return
+            finished.put((step, self._execute_controller(step, controller)))
+
+        worker = threading.Thread(target=work, name="step-%d" % step)
+        worker.daemon = True
+        worker.start()
+
+    def _get_controller(self, step):
+        """
+        :return: the controller of the step, built on first call: just before the step runs (or before
+        the crawler runs, if the step overlaps the crawl)
+        """
+        with self.modules_lock:
+            if step not in self.modules:
+                setting = self.schedule.steps[step]
+                controller = self.schedule.build(step)
+                controller.metrics = self.registry.step(controller.step_name)
+                controller.inputs = dict((name, self.channels.get(name)) for name in setting[INPUTS_LABEL])
+                controller.outputs = dict((name, self.channels.get(name)) for name in setting[OUTPUTS_LABEL])
+                self.modules[step] = controller
+            return self.modules[step]
+
+    def _close_outputs(self, step, failed=False):
+        """
+        close the channels produced by the step, ending the iteration of their consumers
+        :param failed: whether the step failed (or was skipped)
+        """
+        for name in self.schedule.steps[step][OUTPUTS_LABEL]:
+            self.channels.get(name).close(failed)
+
     def _execute_controller(self, step, controller):
         """
-        Execute the controller passed, and if this controller returns smth, store it
+        Execute the controller passed, passing it its (first) input channel, if any, and journal
+        what it returns, if anything
+        :return: the status of the step
         """
         # log step
         self.logger.schedule_step(step_num=step, total_steps=self.total, date_start=self.date_start)
-        result = controller.execute(
-            self.results.get('ControllerCrawl')
-        )  # applied custom hack to pass consultations to wordcloud
-        if result:
-            self.results[repr(controller).split(":")[0]] = result
+        date_init = datetime.now()
+        self._journal_step(step, controller, STATUS_RUNNING, date_init)
+        if controller.metrics:
+            controller.metrics.start()
+        tailers = self._start_tailers() if controller.produces_comments else []
+        try:
+            if controller.incremental:
+                self._load_watermark(controller)
+            inputs = self.schedule.steps[step][INPUTS_LABEL]
+            result = controller.execute(self.channels.get(inputs[0]) if inputs else None)
+            if controller.incremental:
+                # the step succeeded: move its watermark
+                self.psql.set_step_watermark(controller.step_name, controller.high_watermark)
+        except Exception, ex:
+            self.logger.exception(ex, step=controller.step_name)
+            self._close_outputs(step, failed=True)
+            self._journal_step(step, controller, STATUS_FAILED, date_init, datetime.now())
+            self._log_step_end(step, controller, STATUS_FAILED, date_init)
+            return STATUS_FAILED
+        finally:
+            for tailer in tailers:
+                tailer.stop()
+            self._report_children(controller)
+        self._close_outputs(step)
+        self._journal_step(step, controller, STATUS_DONE, date_init, datetime.now(), result)
+        self._log_step_end(step, controller, STATUS_DONE, date_init)
+        return STATUS_DONE
+
+    def _log_step_end(self, step, controller, status, date_init):
+        if controller.metrics:
+            controller.metrics.stop(status, controller.child_reports)
+        date_end = datetime.now()
+        duration = (date_end - date_init).total_seconds()
+        self.logger.info("step %d (%s) %s in %.1f secs" % (step, controller.step_name, status, duration),
+                         step=controller.step_name, duration=duration, status=status)
+        metrics = controller.metrics.as_dict() if controller.metrics else {}
+        self._call_history("record_step", step, controller.step_name, status, date_init, date_end, duration,
+                           metrics.get("children_cpu_time"), metrics.get("items"))
+        history = self.duration_stats.get(controller.step_name)
+        if status == STATUS_DONE and is_anomalous(duration, history):
+            self.logger.warn("step %d (%s) took %.1f secs: over %.1f times the p95 (%.1f secs) of its last %d runs"
+                             % (step, controller.step_name, duration, ANOMALY_FACTOR, history["p95"],
+                                history["count"]), step=controller.step_name, duration=duration)
+
+    def emit(self, name, items):
+        """
+        stream the items to the output channel of the controller, if it is declared in the settings file
+        (else they are dropped)
+        :param name: the output name
+        :param items: an iterable of items, of the type of the channel
+        """
+        if self.outputs and name in self.outputs:
+            self.outputs[name].extend(items)
+
+    def _iter_delta(self, incoming, batch_size=DEFAULT_BATCH_SIZE):
+        """
+        stream the consultations commented after the watermark of the (incremental) controller, or after the
+        previous schedule's comment ID if it has none. They are read from the incoming channel as long as it
+        covers them, i.e. the watermark is not behind the previous schedule's comment ID (the channel streams
+        the consultations commented after that). If the producer of the channel failed (or was skipped),
+        the consultations it may have missed are queried
+        :param incoming: the channel of the consultations updated by the crawler, if any
+        :return: a generator of lists of consultation IDs
+        """
+        prev_comment_id = self.get_previous_comment_id()
+        after = self.watermark if self.watermark is not None else prev_comment_id
+        if incoming is None or after < prev_comment_id:
+            for batch in self.psql.iter_updated_consultations(prev_comment_id=after, batch_size=batch_size):
+                yield batch
+            return
+        streamed = set()
+        for batch in incoming.batches(batch_size):
+            streamed.update(batch)
+            yield batch
+        if incoming.failed:
+            self.logger.warn("%s: the producer of '%s' failed: querying the consultations commented after %d"
+                             % (self.step_name, incoming.name, after), step=self.step_name)
+            for batch in self.psql.iter_updated_consultations(prev_comment_id=after, batch_size=batch_size):
+                batch = [cons for cons in batch if cons not in streamed]
+                if batch:
+                    yield batch
+
+    def _count_items(self, count):
+        """
+        add the items processed by the controller to its metrics, if any
+        """
+        if self.metrics:
+            self.metrics.add_items(count)
+
+    def _start_tailers(self):
+        """
+        start tailing the new comments for every controller that overlaps the crawl
+        :return: the list of tailers started
+        """
+        tailers = []
+        for step, setting in sorted(self.schedule.steps.items()):
+            if not setting[PARAM_LABEL].get("overlap_crawl"):
+                continue
+            try:
+                consumer = self._get_controller(step)
+            except Exception, ex:  # the step fails when it runs
+                self.logger.exception(ex, step=self.names[step])
+                continue
+            if consumer.overlap_crawl:
+                tailer = CommentTailer(self.psql, self.prev_comment_id, consumer.extract_settled,
+                                       consumer.poll_interval, consumer.quiet_period, self.logger)
+                tailer.start()
+                tailers.append(tailer)
+        return tailers
+
+    def _report_children(self, controller):
+        """
+        log the exit status and resource usage of the child processes of the controller
+        """
+        for report in controller.child_reports or []:
+            message = "%s: child exited with %d (%s)" % (controller.step_name, report["returncode"], report)
+            if report["returncode"] != 0:
+                self.logger.error(message)
+            else:
+                self.logger.info(message)
+
+    def _load_watermark(self, controller):
+        """
+        set the delta of comments the (incremental) controller has to process: after its own watermark, up to
+        the latest comment. The watermark is left None on a first run, or if the step has never completed:
+        the controller then processes the comments after the comment ID of the previous schedule
+        """
+        controller.high_watermark = self.psql.get_latest_comment_id()
+        controller.watermark = None if self.first else self.psql.get_step_watermark(controller.step_name)
+        if controller.watermark is None:
+            self.logger.info("%s: no watermark, processing comments after %d (the previous schedule's), up to %d"
+                             % (controller.step_name, self.prev_comment_id, controller.high_watermark))
+        else:
+            self.logger.info("%s: processing comments after %d, up to %d"
+                             % (controller.step_name, controller.watermark, controller.high_watermark))
 
     def get_previous_comment_id(self):
-        return self._load(LOCAL_TEMP_FILE)["prev_comment_id"]
+        """
+        :return: the latest comment ID before the current schedule started (as stored in its journal)
+        """
+        return self._load(RUN_JOURNAL_FILE).get("prev_comment_id", 0)
 
     @staticmethod
-    def get_modules(schedules_file_path):
+    def get_triggers(schedules_file_path, cache_file=None):
+        """
+        :param schedules_file_path: the path to the yaml file
+        :return: the list of cron expressions to execute the pipeline on, in daemon mode
+        """
+        return CompiledSchedule.load(schedules_file_path, cache_file).triggers
+
+    @staticmethod
+    def get_modules(schedules_file_path, cache_file=None):
         """
         :param schedules_file_path: the path to the yaml file
         :return: a dict containing the instances to be executed
         """
-        modules = {}
-        # inject class instances, with parameters from settings file
-        with open(schedules_file_path, 'r') as inp:
-            scheduler_settings = yaml.load(inp)
-            for index, setting in enumerate(scheduler_settings):
-                cl_set = setting[CLASS_LABEL]
-                pack_set = setting[PACKAGE_LABEL]
-                params_set = setting[PARAM_LABEL]
-                pack = importlib.import_module(pack_set)
-                cl = getattr(pack, cl_set)
-                modules[index + 1] = cl(**params_set)
-        # print [k for k in modules.values()]  # debug
-        return modules
+        schedule = CompiledSchedule.load(schedules_file_path, cache_file)
+        return dict((step, schedule.build(step)) for step in schedule.steps)
+
+    @staticmethod
+    def get_step_names(scheduler_settings):
+        """
+        A step is named after the 'name' key of its settings. If missing, the class name is used, suffixed
+        with the step number when the same class is used by more than one step (e.g. ControllerFekAnnotator#4)
+        :param scheduler_settings: the list of step settings
+        :return: a dict containing the name of each step
+        """
+        classes = [setting[CLASS_LABEL] for setting in scheduler_settings]
+        names = {}
+        for index, setting in enumerate(scheduler_settings):
+            name = setting.get(NAME_LABEL)
+            if not name:
+                name = setting[CLASS_LABEL]
+                if classes.count(name) > 1:
+                    name = "%s#%d" % (name, index + 1)
+            if name in names.values():
+                raise ValueError("duplicate step name '%s'" % name)
+            names[index + 1] = name
+        return names
+
+    @staticmethod
+    def get_dependencies(scheduler_settings):
+        """
+        Resolve the steps each step waits for:
+         - 'depends_on': the names (or numbers) of the steps to wait for
+         - 'stage': wait for all steps of a lower stage, and for all the earlier steps with no stage
+         - none of the above: wait for all the earlier steps (i.e. run in file order)
+        :param scheduler_settings: the list of step settings
+        :return: a dict containing the set of steps that each step waits for
+        """
+        names = Scheduler.get_step_names(scheduler_settings)
+        steps = dict((name, step) for step, name in names.items())
+        dependencies = {}
+        for index, setting in enumerate(scheduler_settings):
+            step = index + 1
+            if DEPENDS_LABEL in setting:
+                depends_on = setting[DEPENDS_LABEL] or []
+                if not isinstance(depends_on, list):
+                    depends_on = [depends_on]
+                deps = set()
+                for dep in depends_on:
+                    if dep in steps:
+                        deps.add(steps[dep])
+                    elif dep in names:
+                        deps.add(dep)
+                    else:
+                        raise ValueError("step %d (%s) depends on unknown step '%s'" % (step, names[step], dep))
+            elif STAGE_LABEL in setting:
+                deps = set(other for other in names if other != step and (
+                    (STAGE_LABEL not in scheduler_settings[other - 1] and other < step) or
+                    scheduler_settings[other - 1].get(STAGE_LABEL, setting[STAGE_LABEL]) < setting[STAGE_LABEL]))
+            else:
+                deps = set(range(1, step))
+            dependencies[step] = deps
+        Scheduler._check_acyclic(dependencies, names)
+        return dependencies
+
+    @staticmethod
+    def _check_acyclic(dependencies, names):
+        """
+        :raise ValueError: if the steps can not be ordered, due to a circular dependency
+        """
+        remaining = dict((step, set(deps)) for step, deps in dependencies.items())
+        while remaining:
+            ready = [step for step, deps in remaining.items() if not deps & set(remaining)]
+            if not ready:
+                raise ValueError("circular dependency between steps: %s"
+                                 % ", ".join(names[step] for step in sorted(remaining)))
+            for step in ready:
+                del remaining[step]
 
     def _store(self, dict, storage):
         """
         store data to file: custom hack to override issue with class inheritance
+        the file is replaced atomically, so that it is never left half written
         :param storage: the file to store data
         """
-        if not os.path.isfile(storage):
-            with open(storage, mode='a') as f:
-                json.dump(dict, f)
-        else:
-            with open(storage, mode='w') as f:
-                json.dump(dict, f)
+        temp_storage = storage + ".tmp"
+        with open(temp_storage, mode='w') as f:
+            json.dump(dict, f, default=_to_json)
+            f.flush()
+            os.fsync(f.fileno())
+        os.rename(temp_storage, storage)
 
     def _load(self, storage):
         """
-
-        :param storage:
+        :param storage: the file to load data from
+        :return: the data stored, or an empty dict if none
         """
         if os.path.isfile(storage):
             with open(storage, mode='r') as f:
                 return json.load(f)
         # we do not want schedule to terminate
-        return {"prev_comment_id": 0}
+        return {}
+
+
+class CompiledSchedule:
+    """
+    The validated form of a settings file: the controller settings, name and dependencies of each step,
+    and the triggers of the daemon. It is cached as json, keyed by the path, mtime and size of the file
+    (and the format version), so that the yaml is only parsed (and validated) again once the file changes
+    """
+
+    def __init__(self, steps, names, dependencies, triggers=None):
+        """
+        :param steps: a dict containing the settings (package, class, params, inputs and outputs) of each step
+        :param names: a dict containing the name of each step
+        :param dependencies: a dict containing the set of steps that each step waits for
+        :param triggers: the cron expressions to execute the pipeline on, in daemon mode
+        """
+        self.steps = steps
+        self.names = names
+        self.dependencies = dependencies
+        self.triggers = triggers if triggers else []
+
+    def build(self, step):
+        """
+        :return: a new instance of the controller of the step, with its parameters from the settings file
+        """
+        setting = self.steps[step]
+        pack = importlib.import_module(setting[PACKAGE_LABEL])
+        controller = getattr(pack, setting[CLASS_LABEL])(**setting[PARAM_LABEL])
+        controller.step_name = self.names[step]
+        return controller
+
+    def get_channel_types(self):
+        """
+        :return: a dict containing the item type of each channel produced by any step
+        """
+        types = {}
+        for setting in self.steps.values():
+            types.update(setting[OUTPUTS_LABEL])
+        return types
+
+    def get_producers(self, step):
+        """
+        :return: the set of steps producing the inputs of the step
+        """
+        return set(producer for producer, setting in self.steps.items()
+                   if set(setting[OUTPUTS_LABEL]) & set(self.steps[step][INPUTS_LABEL]))
 
+    def as_dict(self):
+        return {
+            "steps": self.steps,
+            "names": self.names,
+            "dependencies": dict((step, sorted(deps)) for step, deps in self.dependencies.items()),
+            "triggers": self.triggers
+        }
 
-class ControllerCrawl(Scheduler):
-    def __init__(self, dir_name, java_exec, executable_class, config_file):
+    @staticmethod
+    def from_dict(data):
+        data = _to_str(data)
+        return CompiledSchedule(dict((int(step), setting) for step, setting in data["steps"].items()),
+                                dict((int(step), name) for step, name in data["names"].items()),
+                                dict((int(step), set(deps)) for step, deps in data["dependencies"].items()),
+                                data["triggers"])
+
+    @staticmethod
+    def compile(settings):
+        """
+        :param settings: the parsed settings file: either a list of steps, or a mapping with the steps
+        (and the triggers of the daemon)
+        :raise ValueError: if the settings are not valid (e.g. missing class, duplicate names,
+        unknown or circular dependencies, invalid triggers)
+        """
+        scheduler_settings = settings.get(STEPS_LABEL) if isinstance(settings, dict) else settings
+        triggers = (settings.get(TRIGGERS_LABEL) or []) if isinstance(settings, dict) else []
+        if not scheduler_settings or not isinstance(scheduler_settings, list):
+            raise ValueError("no steps in the settings file")
+        steps = {}
+        for index, setting in enumerate(scheduler_settings):
+            for label in (PACKAGE_LABEL, CLASS_LABEL):
+                if not setting.get(label):
+                    raise ValueError("step %d has no '%s'" % (index + 1, label))
+            params = setting.get(PARAM_LABEL) or {}
+            if not isinstance(params, dict):
+                raise ValueError("the '%s' of step %d are not a mapping" % (PARAM_LABEL, index + 1))
+            steps[index + 1] = {PACKAGE_LABEL: setting[PACKAGE_LABEL], CLASS_LABEL: setting[CLASS_LABEL],
+                                PARAM_LABEL: params, INPUTS_LABEL: _get_inputs(setting, index + 1),
+                                OUTPUTS_LABEL: _get_outputs(setting, index + 1)}
+        for trigger in triggers:
+            CronExpression(trigger)
+        names = Scheduler.get_step_names(scheduler_settings)
+        dependencies = Scheduler.get_dependencies(scheduler_settings)
+        CompiledSchedule._check_channels(steps, names, dependencies)
+        return CompiledSchedule(steps, names, dependencies, triggers)
+
+    @staticmethod
+    def _check_channels(steps, names, dependencies):
+        """
+        :raise ValueError: if a channel is produced by more than one step, or consumed but not produced,
+        or if the producer of a channel waits for (any step that waits for) a consumer of it
+        """
+        producers = {}
+        for step, setting in sorted(steps.items()):
+            for name in setting[OUTPUTS_LABEL]:
+                if name in producers:
+                    raise ValueError("channel '%s' is produced by both %s and %s"
+                                     % (name, names[producers[name]], names[step]))
+                producers[name] = step
+
+        def ancestors(step):
+            found, pending = set(), list(dependencies[step])
+            while pending:
+                dep = pending.pop()
+                if dep not in found:
+                    found.add(dep)
+                    pending.extend(dependencies[dep])
+            return found
+
+        for step, setting in sorted(steps.items()):
+            for name in setting[INPUTS_LABEL]:
+                if name not in producers:
+                    raise ValueError("step %d (%s) consumes channel '%s', which no step produces"
+                                     % (step, names[step], name))
+                if step in ancestors(producers[name]):
+                    raise ValueError("step %d (%s) consumes channel '%s', but its producer %s waits for it"
+                                     % (step, names[step], name, names[producers[name]]))
+
+    @staticmethod
+    def load(schedules_file_path, cache_file=None):
+        """
+        :param schedules_file_path: the path to the yaml file
+        :param cache_file: the json file to cache the compiled schedule in
+        :return: the compiled schedule, from the cache unless the file has changed since it was cached
+        """
+        path = os.path.abspath(os.path.expanduser(schedules_file_path))
+        stat = os.stat(path)
+        key = [SCHEDULE_CACHE_VERSION, path, stat.st_mtime, stat.st_size]
+        cache_file = cache_file if cache_file else SCHEDULE_CACHE_FILE
+        try:
+            with open(cache_file, 'r') as f:
+                cached = json.load(f)
+            if cached["key"] == key:
+                return CompiledSchedule.from_dict(cached["schedule"])
+        except (IOError, ValueError, KeyError, TypeError):
+            pass  # no cache, or a broken one: compile again
+        schedule = CompiledSchedule.compile(_parse_settings(path))
+        temp_file = cache_file + ".tmp"
+        try:
+            with open(temp_file, 'w') as f:
+                json.dump({"key": key, "schedule": schedule.as_dict()}, f)
+            os.rename(temp_file, cache_file)
+        except (IOError, OSError, TypeError, ValueError):
+            pass  # e.g. params not serializable as json: the schedule is compiled on every run
+        return schedule
+
+
+def _get_inputs(setting, step):
+    """
+    :return: the list of the channel names the step consumes: 'inputs' is a name, or a list of names
+    (the first one is passed to the execute method of the controller)
+    """
+    inputs = setting.get(INPUTS_LABEL) or []
+    inputs = inputs if isinstance(inputs, list) else [inputs]
+    if not all(isinstance(name, basestring) for name in inputs):
+        raise ValueError("the '%s' of step %d are not channel names" % (INPUTS_LABEL, step))
+    return inputs
+
+
+def _get_outputs(setting, step):
+    """
+    :return: a dict containing the item type of each channel the step produces: 'outputs' maps each name
+    to its type (see CHANNEL_TYPES), or is a name, or a list of names (of any type)
+    """
+    outputs = setting.get(OUTPUTS_LABEL) or {}
+    if not isinstance(outputs, dict):
+        outputs = dict((name, 'any') for name in (outputs if isinstance(outputs, list) else [outputs]))
+    for name, item_type in outputs.items():
+        if item_type not in CHANNEL_TYPES:
+            raise ValueError("output '%s' of step %d: unknown type '%s' (one of %s)"
+                             % (name, step, item_type, ", ".join(sorted(CHANNEL_TYPES))))
+    return outputs
+
+
+def _parse_settings(schedules_file_path):
+    """
+    :return: the parsed yaml file (yaml is imported on a cache miss only)
+    """
+    import yaml
+    with open(schedules_file_path, 'r') as inp:
+        return yaml.load(inp)
+
+
+def _to_str(obj):
+    """
+    :return: the json data passed, with its unicode strings encoded as utf-8 (as yaml loads the ascii ones),
+    e.g. to pass them as keyword arguments
+    """
+    if isinstance(obj, unicode):
+        return obj.encode('utf-8')
+    if isinstance(obj, list):
+        return [_to_str(item) for item in obj]
+    if isinstance(obj, dict):
+        return dict((_to_str(key), _to_str(value)) for key, value in obj.items())
+    return obj
+
+
+def _to_json(obj):
+    """
+    json serializer of the step outputs not supported by default (e.g. the set of consultations)
+    """
+    if isinstance(obj, (set, frozenset)):
+        return sorted(obj)
+    return repr(obj)
+
+
+class CommentTailer(threading.Thread):
+    """
+    While the crawler runs, poll the comments inserted after the previous comment ID, and pass the consultations
+    whose new comments have settled (i.e. no new comment for quiet_period secs) to the callback
+    """
+
+    def __init__(self, psql, prev_comment_id, callback, poll_interval, quiet_period, logger):
+        """
+        :param callback: called with a dict containing the latest comment ID of each settled consultation
+        """
+        threading.Thread.__init__(self, name="comment-tailer")
+        self.daemon = True
+        self.psql = psql
+        self.prev_comment_id = prev_comment_id
+        self.callback = callback
+        self.poll_interval = poll_interval
+        self.quiet_period = quiet_period
+        self.logger = logger
+        self.stopped = threading.Event()
+
+    def run(self):
+        last_seen = {}  # the latest comment ID of each consultation, and when it was first seen
+        dispatched = {}  # the latest comment ID of each consultation, when passed to the callback
+        while not self.stopped.wait(self.poll_interval):
+            try:
+                activity = self.psql.get_consultation_activity(self.prev_comment_id)
+                now = time.time()
+                for cons, comment_id in activity.items():
+                    if last_seen.get(cons, (None, None))[0] != comment_id:
+                        last_seen[cons] = (comment_id, now)
+                settled = dict((cons, comment_id) for cons, (comment_id, since) in last_seen.items()
+                               if now - since >= self.quiet_period and dispatched.get(cons) != comment_id)
+                if settled:
+                    self.logger.info("%d consultations settled while crawling" % len(settled))
+                    self.callback(settled)
+                    dispatched.update(settled)
+            except Exception, ex:
+                self.logger.exception(ex)
+
+    def stop(self):
+        """
+        stop polling, and wait for the callback in progress (if any) to finish
+        """
+        self.stopped.set()
+        self.join()
+
+
+class ControllerJava(Scheduler):
+    """Base of the controllers executing a java class, with all the jars of their directory in the classpath"""
+    dir_name = None
+    executable_class = None
+    jvm = None  # the JVMProfile, if any
+    limits = None  # the ResourceLimits of the java process, if any
+    progress = None  # the regex of each progress counter in the java process output, if any
+    progress_interval = None  # the interval (in seconds) between progress logs
+
+    def __init__(self, dir_name, java_exec, executable_class, config_file=None, jvm=None, limits=None, progress=None,
+                 progress_interval=None):
+        """
+        :param dir_name: the directory of the java class and its jars (the working directory of the process)
+        :param java_exec: the main jar
+        :param executable_class: the java class to execute
+        :param config_file: the configuration file passed to the class, if any
+        :param jvm: the JVM options (heap, min_heap, gc, flags, cds), see JVMProfile
+        :param limits: the resource limits of the java process (timeout, max_memory, max_rss, nice, ionice,
+        cpu_affinity, heavy), see ResourceLimits
+        :param progress: a dict containing the regex of each progress counter in the java process output,
+        whose first group is the running total of the counter (e.g. comments: 'processed (\d+) comments')
+        :param progress_interval: the interval (in seconds) between progress logs
+        """
         self.dir_name = dir_name
         self.java_exec = java_exec
         self.executable_class = executable_class
         self.config_file = config_file
+        self.jvm = JVMProfile(**jvm) if jvm else None
+        self.limits = ResourceLimits(**limits) if limits else None
+        self.progress = progress
+        self.progress_interval = progress_interval
         Scheduler.__init__(self)
 
+    def _call_java(self, *args):
+        """
+        execute the java class (os.subprocess), in the controller directory, within the controller limits
+        :param args: the arguments to pass to the class (None ones are omitted)
+        :return: the exit code of the subprocess
+        :raise StepFailedError: if java can not be started (e.g. no such directory), exits with a nonzero code,
+        or is killed for exceeding its limits
+        """
+        work_dir = os.path.expanduser(os.path.dirname(self.dir_name))
+        if not os.path.isdir(work_dir):
+            raise StepFailedError("no such directory: %s" % work_dir)
+        # find all dependencies (cached, per directory)
+        jars = ClasspathResolver.get_jars(work_dir)
+        options, archive = self.jvm.get_options(work_dir, jars) if self.jvm else ([], None)
+        runner = ChildProcessRunner(self.limits, self.logger, tag=self.step_name or self.__class__.__name__,
+                                    progress=self.progress, progress_interval=self.progress_interval)
+        try:
+            try:
+                report = runner.run(["java"] + options + ["-cp", ":".join(jars), self.executable_class] +
+                                    [os.path.expanduser(arg) for arg in args if arg], cwd=work_dir)
+            except (IOError, OSError), ex:
+                raise StepFailedError("could not execute %s in %s: %s" % (self.executable_class, work_dir, ex))
+            self.child_reports = (self.child_reports or []) + [report]
+            if report["killed"]:
+                raise StepFailedError("%s was killed (exceeded its %s), with exit code %d"
+                                      % (self.executable_class, report["killed"], report["returncode"]))
+            if report["returncode"] != 0:
+                raise StepFailedError("%s exited with %d" % (self.executable_class, report["returncode"]))
+            return report["returncode"]
+        finally:
+            if archive:
+                if JVMProfile.archive_done(archive):
+                    self.logger.info("created class data sharing archive %s" % archive)
+                else:
+                    self.logger.warn("class data sharing archive %s was not created" % archive)
+
+
+class ControllerCrawl(ControllerJava):
+    produces_comments = True
+
+    def __init__(self, dir_name, java_exec, executable_class, config_file, jvm=None, limits=None, progress=None,
+                 progress_interval=None):
+        ControllerJava.__init__(self, dir_name, java_exec, executable_class, config_file, jvm, limits, progress,
+                                progress_interval)
+
     def __repr__(self):
         return "ControllerCrawl: {}".format(self.__dict__)
 
     def execute(self, incoming):
         """
         will initiate the crawler (os.subprocess).
+        The consultations updated with new comments are streamed to the 'consultations' output, if declared
         :return the list of consultations updated with new comments
+        :raise StepFailedError: if the crawler failed, so that the steps depending on it are skipped
         """
-        try:
-            cur_work_dir = os.getcwd()
-            os.chdir(os.path.dirname(self.dir_name))
-            # find all dependencies
-            libs = subprocess.check_output(['find', '-iname', '*.jar'])
-            class_path = ":".join([os.path.join(os.getcwd(), k) for k in libs.split() if k.endswith('.jar')])
-            # start crawler
-            subprocess.call(["java", "-cp", class_path, self.executable_class, self.config_file])
-            # return the consultations updated by the crawler
-            found = self.psql.get_updated_consultations(self.get_previous_comment_id())
-            os.chdir(cur_work_dir)
-            return found if found else []
-        except Exception, ex:
-            self.logger.exception(ex)
-            return None
+        # start crawler
+        self._call_java(self.config_file)
+        # stream the consultations updated by the crawler, as they are fetched
+        found = []
+        for batch in self.psql.iter_updated_consultations(self.get_previous_comment_id()):
+            self.emit(CONSULTATIONS_OUTPUT, batch)
+            found.extend(batch)
+        self._count_items(len(found))
+        return found
 
 
 class ControllerIndex(Scheduler):
-    def __init__(self, urls=None):
+    incremental = True
+
+    def __init__(self, urls=None, mode=INDEX_MODE_FULL, poll_interval=DEFAULT_IMPORT_POLL_INTERVAL,
+                 deadline=DEFAULT_IMPORT_DEADLINE, timeout=DEFAULT_HTTP_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, retries=DEFAULT_RETRIES):
+        """
+        :param urls: the dataimport urls to call, one per solr core
+        :param mode: 'full' to call the urls as stated, or 'delta' to call a delta-import on the same cores,
+        for the consultations updated since the previous schedule only
+        :param poll_interval: the interval (in seconds) between import status requests
+        :param deadline: the max time (in seconds) to wait for all the imports to finish
+        :param timeout: the read timeout (in seconds) of each request
+        :param connect_timeout: the connect timeout (in seconds) of each request
+        :param retries: the max number of retries of a failed status request (the import trigger is never retried)
+        """
         self.urls = urls if urls else ["http://localhost/solr/dit_comments/etc"]  # just an example, urls MUST exist
+        self.mode = mode
+        self.poll_interval = poll_interval
+        self.deadline = deadline
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
         Scheduler.__init__(self)
 
     def execute(self, incoming):
         """
-        :return: None
+        trigger the import on all solr cores concurrently, and wait until every import has finished
+        :param incoming: the channel of the consultations updated by the crawler, if any
+        :return: a dict containing the import report (status, documents processed, elapsed seconds) of each core
+        :raise StepFailedError: if any import failed, or did not finish before the deadline
         """
-        for eachURL in self.urls:
-            self.logger.info('executing import on %s table: calling %s'
-                             % (re.findall('dit_(\w+)', eachURL)[0], eachURL))
-            try:
-                r = requests.get(eachURL)
-                response = r.status_code
-                self.logger.info("import completed with response code: %d " % response)
-            except Exception, ex:
-                self.logger.exception(ex)
+        urls, params = self.urls, None
+        if self.mode == INDEX_MODE_DELTA:
+            params = self._get_delta_params(incoming)
+            if params is not None and not params["consultation_ids"]:
+                self.logger.info("No consultations updated with new comments: skipping delta import")
+                return {}
+            if params:
+                urls = [self._delta_url(url) for url in self.urls]
+        deadline = time.time() + self.deadline
+        client = HTTPClient(self.timeout, self.connect_timeout, self.retries, pool_size=len(urls), logger=self.logger,
+                            metrics=self.metrics)
+        pool = ThreadPool(len(urls))
+        try:
+            reports = dict(pool.map(lambda url: self._import(url, client, deadline, params), urls))
+        finally:
+            pool.close()
+            pool.join()
+            client.close()
+        failed = sorted(core for core, report in reports.items() if report["status"] != "completed")
+        if failed:
+            raise StepFailedError("import did not complete on %s" % ", ".join(failed))
+        return reports
+
+    def _import(self, url, client, deadline, params=None):
+        """
+        trigger the import and poll the import status until the DataImportHandler reports idle
+        :param url: the dataimport url to call
+        :param client: the HTTPClient to use
+        :param deadline: the time until which to wait for the import to finish
+        :param params: the request parameters of a delta import, if any (posted, as they may be long)
+        :return: a tuple of the core name and its import report
+        """
+        core = self._core_name(url)
+        report = {"status": "failed", "documents": 0, "elapsed": 0.0}
+        started = time.time()
+        self.logger.info('executing import on %s table: calling %s' % (core, url))
+        try:
+            # a second trigger may start a second import, so it is not retried
+            if params:
+                r = client.post(url, data=params)
+            else:
+                r = client.get(url, idempotent=False)
+            self.logger.info("import on %s triggered with response code: %d " % (core, r.status_code))
+            if r.status_code != 200:
+                return core, report
+            status_url = self._status_url(url)
+            while True:
+                if time.time() + self.poll_interval > deadline:
+                    report["status"] = "timeout"
+                    self.logger.error("import on %s did not finish within %d secs" % (core, self.deadline))
+                    return core, report
+                time.sleep(self.poll_interval)
+                r = client.get(status_url)
+                status = r.json()
+                if status.get("status") == "idle":
+                    break
+            messages = status.get("statusMessages", {})
+            report["documents"] = int(messages.get("Total Documents Processed", 0))
+            self._count_items(report["documents"])
+            report["elapsed"] = round(time.time() - started, 3)
+            # e.g. {"Full Import failed": "<date>", "": "Indexing failed. Rolled back all changes."}
+            if any(key.lower().endswith("import failed") or str(value).startswith("Indexing failed")
+                   for key, value in messages.items()):
+                self.logger.error("import on %s failed: %s" % (core, messages))
+                return core, report
+            report["status"] = "completed"
+            self.logger.info("import on %s completed: %d documents processed in %.1f secs"
+                             % (core, report["documents"], report["elapsed"]))
+        except Exception, ex:
+            self.logger.exception(ex)
+        return core, report
+
+    def _get_delta_params(self, incoming):
+        """
+        The delta import parameters are available to the data-config.xml of each core as
+        ${dataimporter.request.consultation_ids} (comma separated) and ${dataimporter.request.prev_comment_id}
+        :param incoming: the channel of the consultations updated by the crawler, if any (see _iter_delta)
+        :return: the delta import request parameters, or None if a full import is required
+        """
+        prev_comment_id = self.watermark if self.watermark is not None else self.get_previous_comment_id()
+        if not prev_comment_id:
+            self.logger.info("No previous comment id: falling back to full import")
+            return None
+        consultations = set(itertools.chain.from_iterable(self._iter_delta(incoming)))  # the whole stream
+        self.logger.info("delta import for %d consultations updated after comment %d"
+                         % (len(consultations), prev_comment_id))
+        return {
+            "prev_comment_id": prev_comment_id,
+            "consultation_ids": ",".join(str(cons) for cons in sorted(consultations))
+        }
+
+    @staticmethod
+    def _delta_url(url):
+        """
+        :return: the delta-import url of the same dataimport handler (a delta import never cleans the index)
+        """
+        parts = urlparse.urlsplit(url)
+        query = [(key, value) for key, value in urlparse.parse_qsl(parts.query) if key not in ("command", "clean")]
+        query.append(("command", "delta-import"))
+        return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path, urllib.urlencode(query), ""))
+
+    @staticmethod
+    def _core_name(url):
+        """
+        :return: the solr core name of the url (e.g. dit_comments), or the url itself if not found
+        """
+        found = re.findall('/solr/([^/]+)/', url)
+        return found[0] if found else url
+
+    @staticmethod
+    def _status_url(url):
+        """
+        :return: the url of the import status of the same dataimport handler
+        """
+        parts = urlparse.urlsplit(url)
+        query = urllib.urlencode({"command": "status", "wt": "json"})
+        return urlparse.urlunsplit((parts.scheme, parts.netloc, parts.path, query, ""))
 
     def __repr__(self):
         return "ControllerIndex: {}".format(self.__dict__)
 
 
 class ControllerWordCloud(Scheduler):
-    consultations = set()
+    incremental = True
 
-    def __init__(self, url, consultations=None, fetchall=False):
+    def __init__(self, url, consultations=None, fetchall=False, max_in_flight=1, timeout=DEFAULT_HTTP_TIMEOUT,
+                 connect_timeout=DEFAULT_CONNECT_TIMEOUT, retries=DEFAULT_RETRIES, retry_failed=True,
+                 summary_file=None, batch_size=DEFAULT_BATCH_SIZE, overlap_crawl=False,
+                 poll_interval=DEFAULT_TAIL_POLL_INTERVAL, quiet_period=DEFAULT_TAIL_QUIET_PERIOD,
+                 skip_unchanged=False, fingerprint_max_age=None, time_budget=None, queue=None,
+                 queue_name=DEFAULT_QUEUE_NAME, lease_time=DEFAULT_LEASE_TIME, max_attempts=DEFAULT_MAX_ATTEMPTS,
+                 drain_timeout=None):
+        """
+        :param fetchall: if True and no consultations are passed, call the extractor for all consultations
+        :param max_in_flight: the max number of extractor requests running concurrently
+        :param timeout: the read timeout (in seconds) of each extractor request
+        :param connect_timeout: the connect timeout (in seconds) of each extractor request
+        :param retries: the max number of retries of a failed extractor request. Once the extractor keeps
+        failing, its circuit opens and the consultations left are deferred to the next run
+        :param retry_failed: if True, the consultations that failed in the previous run are called again
+        :param summary_file: the file to store the per-consultation results in
+        :param batch_size: the number of consultation IDs fetched at a time, when fetching all
+        :param overlap_crawl: if True, call the extractor while the crawler runs, for each consultation
+        whose new comments have settled
+        :param poll_interval: the interval (in seconds) between polls for new comments, while the crawler runs
+        :param quiet_period: the time (in seconds) without new comments, after which a consultation is settled
+        :param skip_unchanged: if True (and no consultations are passed), call the extractor for the consultations
+        whose fingerprint (comment count and latest comment ID) has changed since their last successful extraction,
+        instead of the ones with new comments
+        :param fingerprint_max_age: if set, the fingerprints older than that (in days) are dropped, so that
+        every word cloud is extracted again at least that often
+        :param time_budget: if set, the time (in seconds) after which no more extractor requests are started:
+        the consultations left are deferred to the next run (where they go first)
+        :param queue: if set, the work queue (postgres, or sqlite:///<path>) to enqueue a job per consultation in,
+        for the queue workers (see work_queue.py) to call the extractor, instead of calling it from this process
+        :param queue_name: the name of the queue
+        :param lease_time: the time (in seconds) a worker holds a job, before it is leased by another worker
+        :param max_attempts: the max number of attempts of each job, after which it is dead-lettered
+        :param drain_timeout: the max time (in seconds) to wait for the queue workers without any job changing
+        status (e.g. all workers down), after which the jobs left are cancelled, and deferred to the next run
+        (default: lease_time * max_attempts)
+        """
         self.url = url
-        if consultations:
-            self.consultations = consultations
+        self.consultations = consultations
         self.fetch_all_consultations = fetchall
+        self.max_in_flight = max(1, max_in_flight)
+        self.timeout = timeout
+        self.connect_timeout = connect_timeout
+        self.retries = retries
+        self.retry_failed = retry_failed
+        self.summary_file = summary_file if summary_file else WORDCLOUD_SUMMARY_FILE
+        self.batch_size = batch_size
+        self.overlap_crawl = overlap_crawl
+        self.poll_interval = poll_interval
+        self.quiet_period = quiet_period
+        self.extracted = {}  # the latest comment ID of each consultation extracted while the crawler was running
+        self.early_results = {}  # the response status code of each consultation extracted while crawling
+        self.skip_unchanged = skip_unchanged
+        self.fingerprint_max_age = fingerprint_max_age
+        self.fingerprints = {}  # the fingerprint of each changed consultation, stored once extracted
+        self.time_budget = time_budget
+        self.deferred = []  # the consultations left when the time budget ran out, or the extractor circuit opened
+        self.queue = queue
+        self.queue_name = queue_name
+        self.lease_time = lease_time
+        self.max_attempts = max_attempts
+        self.drain_timeout = drain_timeout if drain_timeout else lease_time * max_attempts
         Scheduler.__init__(self)
 
     def execute(self, incoming):
         """
-        :return: None
+        :param incoming: the channel of the consultations updated by the crawler, if any: read as long as it
+        covers the delta of the step (see _iter_delta), and no consultations are passed
+        :return: a dict containing the response status code for each consultation called
         """
-        if not self.consultations:
-            if incoming:
-                self.consultations = incoming
-            else:
-                if self.fetch_all_consultations:
-                    # if no crawler has run, then we must load all
-                    self.consultations = self.psql.get_updated_consultations(prev_comment_id=0)
-                    self.logger.info(self.__str__() + ": " + "No consultations passed: fetching all (%d total)"
-                                     % len(self.consultations))
-        # init procedure
-        results = {}
-        if len(self.consultations) == 0:
+        deadline = time.time() + self.time_budget if self.time_budget else None
+        if self.skip_unchanged and self.fingerprint_max_age:
+            evicted = self.psql.evict_fingerprints(self.fingerprint_max_age)
+            if evicted:
+                self.logger.info(self.__str__() + ": " + "dropped %d fingerprints older than %d days"
+                                 % (evicted, self.fingerprint_max_age))
+        if self.consultations:
+            batches = [self.consultations]
+        elif self.skip_unchanged:
+            # select by fingerprint, rather than by new comments (a consultation with new comments has always
+            # changed): every consultation changed since its last extraction, found in a single grouped query
+            batches = [self._get_changed_consultations()]
+        elif self.fetch_all_consultations and incoming is None and self.watermark is None:
+            # if no crawler has run, then we must load all: stream them in batches,
+            # so that the extractor is called as soon as the first batch arrives
+            self.logger.info(self.__str__() + ": " + "No consultations passed: fetching all (in batches of %d)"
+                             % self.batch_size)
+            batches = self.psql.iter_updated_consultations(prev_comment_id=0, batch_size=self.batch_size)
+        else:
+            # process own delta, streamed by the crawler if it covers it: the extractor is called as soon as
+            # the first consultations are streamed
+            batches = self._iter_delta(incoming, self.batch_size)
+        # the consultations deferred by the previous run (and the failed ones, if retried) go first
+        carried = self._get_previously_deferred()
+        if carried:
+            self.logger.info(self.__str__() + ": " + "resuming %d consultations deferred by the previous run"
+                             % len(carried))
+        if self.retry_failed:
+            failed = self._get_previously_failed()
+            if failed:
+                self.logger.info(self.__str__() + ": " + "retrying %d consultations failed in the previous run"
+                                 % len(failed))
+                carried.extend(cons for cons in sorted(failed) if cons not in carried)
+        if carried:
+            batches = itertools.chain([carried], batches)
+
+        if self.extracted:
+            # skip the consultations extracted while the crawler was running, and not commented since
+            activity = self.psql.get_consultation_activity(self.get_previous_comment_id())
+            batches = ([cons for cons in batch if cons not in self.extracted or
+                        self.extracted[cons] != activity.get(cons)] for batch in batches)
+
+        # call extractor for each consultation and keep result status code
+        results = dict(self.early_results)
+        results.update(self._enqueue(batches, deadline) if self.queue else self._dispatch(batches, deadline))
+        if self.deferred:
+            self.logger.info(self.__str__() + ": " + "deferred %d consultations to the next run (time budget "
+                             "exhausted, or extractor circuit open)" % len(self.deferred))
+        if len(results) == 0 and not self.deferred:
             self.logger.info("No new consultations, or no consultations updated with new comments!")
             return results
 
-        # for each consultation
-        for cons in self.consultations:
-            # call extractor and keep result status code
-            results[cons] = self._call_wordcloud_extractor(cons)
-
         for consultation_id, status_code in results.items():
             if status_code != 200:
                 self.logger.error(
                     "Error: Response status code for consultation ID %d: %d" % (consultation_id, status_code))
+        self._store_summary(results)
+        if self.skip_unchanged:
+            self.psql.set_fingerprints(dict((cons, fingerprint) for cons, fingerprint in self.fingerprints.items()
+                                            if results.get(cons) == 200))
+        return results
+
+    def extract_settled(self, activity):
+        """
+        call the extractor for the consultations settled while the crawler runs
+        :param activity: a dict containing the latest comment ID of each settled consultation
+        """
+        if self.skip_unchanged:
+            self.fingerprints.update(self.psql.get_changed_fingerprints(activity.keys()))
+        results = self._dispatch([activity.keys()])
+        # the consultations not called (the extractor circuit open) are left to the run after the crawler
+        del self.deferred[:]
+        self.early_results.update(results)
+        self.extracted.update((cons, activity[cons]) for cons, status_code in results.items() if status_code == 200)
+        self.logger.info(self.__str__() + ": " + "extracted %d consultations while crawling"
+                         % sum(1 for status_code in results.values() if status_code == 200))
 
-    def _call_wordcloud_extractor(self, cons):
+    def _get_changed_consultations(self):
+        """
+        find the consultations whose fingerprint has changed since their last successful extraction (or that
+        were never extracted), keeping their fingerprints, to store once extracted
+        :return: the list of the changed consultation IDs, most recently commented first
+        """
+        changed = self.psql.get_changed_fingerprints()
+        self.fingerprints.update(changed)
+        self.logger.info(self.__str__() + ": " + "%d consultations changed since their last extraction"
+                         % len(changed))
+        return sorted(changed, key=lambda cons: changed[cons][1], reverse=True)
+
+    def _dispatch(self, batches, deadline=None):
+        """
+        call the extractor for each consultation, in order, over a shared keep-alive client,
+        with at most self.max_in_flight requests running concurrently
+        :param batches: an iterable of consultation ID collections, dispatched one after the other
+        :param deadline: if set, the time after which the consultations left are deferred (to self.deferred).
+        The consultations left once the extractor circuit opens are deferred, too
+        :return: a dict containing the response status code for each consultation
+        """
+        def call(cons):
+            if deadline and time.time() > deadline:
+                return cons, None
+            try:
+                return cons, self._call_wordcloud_extractor(cons, client)
+            except CircuitOpenError:
+                return cons, None
+
+        results = {}
+        deferred = set()
+        client = self.get_http_client(self.max_in_flight)
+        pool = ThreadPool(self.max_in_flight)
+        try:
+            for batch in batches:
+                batch = [cons for cons in batch if cons not in results and cons not in deferred]
+                for cons, status_code in pool.imap_unordered(call, batch):
+                    if status_code is None:
+                        deferred.add(cons)
+                        self.deferred.append(cons)
+                    else:
+                        results[cons] = status_code
+        finally:
+            pool.close()
+            pool.join()
+            client.close()
+        return results
+
+    def _enqueue(self, batches, deadline=None):
+        """
+        enqueue a job per consultation, in order, and wait for the queue workers to finish them all
+        (done, or dead-lettered after max_attempts). If no job changes status for self.drain_timeout secs,
+        the jobs left (leased ones included) are cancelled, to self.deferred
+        :param batches: an iterable of consultation ID collections
+        :param deadline: if set, the time after which the pending jobs are cancelled (to self.deferred)
+        :return: a dict containing the response status code for each consultation
+        """
+        queue = get_work_queue(self.queue, self.queue_name)
+        batch_id = "%s:%s" % (self.step_name or self.__str__(), datetime.strftime(datetime.now(), '%Y%m%d%H%M%S%f'))
+        enqueued = set()
+        for batch in batches:
+            batch = [cons for cons in batch if cons not in enqueued]
+            queue.enqueue(batch_id, batch, self.lease_time, self.max_attempts)
+            enqueued.update(batch)
+        self.logger.info(self.__str__() + ": " + "enqueued %d jobs to %s (batch %s)" % (len(enqueued), queue, batch_id))
+        cancelled = False
+        last_counts, last_change = None, time.time()
+        while True:
+            counts = queue.get_counts(batch_id)
+            left = counts.get(JOB_PENDING, 0) + counts.get(JOB_LEASED, 0)
+            if not left:
+                break
+            if counts != last_counts:
+                last_counts, last_change = counts, time.time()
+            elif time.time() - last_change > self.drain_timeout:
+                self.logger.error(self.__str__() + ": " + "no job changed status for %d secs (are the queue workers "
+                                  "down?): deferring the %d jobs left" % (self.drain_timeout, left))
+                self.deferred.extend(queue.cancel(batch_id, leased=True))
+                break
+            if deadline and not cancelled and time.time() > deadline:
+                # let the leased jobs finish
+                self.deferred.extend(queue.cancel(batch_id))
+                cancelled = True
+            time.sleep(DEFAULT_DRAIN_POLL_INTERVAL)
+        results, deferred = {}, set(self.deferred)
+        for cons, (status, status_code) in queue.get_results(batch_id).items():
+            if status == JOB_DONE:
+                results[cons] = status_code
+            elif cons not in deferred:  # dead-lettered
+                results[cons] = status_code if status_code else 503
+        self._count_items(len(results))
+        return results
+
+    def get_http_client(self, pool_size=1):
+        """
+        :param pool_size: the max number of concurrent extractor requests
+        :return: a new HTTPClient for the extractor requests (to close once done)
+        """
+        return HTTPClient(self.timeout, self.connect_timeout, self.retries, pool_size=pool_size, logger=self.logger,
+                          metrics=self.metrics)
+
+    def _call_wordcloud_extractor(self, cons, client):
         """
         :param cons: a consultation ID
+        :param client: the HTTPClient to use
         :return the status_code response of the request
+        :raise CircuitOpenError: if the extractor circuit is open (the consultation is not called)
         """
-        self.logger.info("Calling word cloud extractor for consultation %d" % cons)
         # self.logger.info("imitating Calling word cloud extractor for consultation %d" % cons)
+        started = time.time()
         try:
-            r = requests.get(self.url + "?consultation_id=%d" % cons)
-            return r.status_code
+            r = client.get(self.url + "?consultation_id=%d" % cons)
+            status_code = r.status_code
             # return 200
+        except CircuitOpenError:
+            raise
         except Exception, ex:
-            self.logger.exception(ex)
-            return 503  # service unavailable
+            self.logger.exception(ex, step=self.step_name, consultation_id=cons)
+            status_code = 503  # service unavailable
+        duration = time.time() - started
+        self._count_items(1)
+        self.logger.info("Called word cloud extractor for consultation %d: %d in %.3f secs"
+                         % (cons, status_code, duration),
+                         step=self.step_name, consultation_id=cons, duration=duration, status=status_code)
+        return status_code
+
+    def _store_summary(self, results):
+        """
+        store the per-consultation results of this run, so that the failed (and deferred) ones can be retried
+        :param results: a dict containing the response status code for each consultation
+        """
+        summary = {
+            "date": datetime.strftime(datetime.now(), '%Y-%m-%d %H:%M:%S'),
+            "succeeded": sorted(cons for cons, status_code in results.items() if status_code == 200),
+            "failed": dict((str(cons), status_code) for cons, status_code in results.items() if status_code != 200),
+            "deferred": self.deferred
+        }
+        self._store(summary, self.summary_file)
+        self.logger.info(self.__str__() + ": " + "%d consultations succeeded, %d failed, %d deferred"
+                         % (len(summary["succeeded"]), len(summary["failed"]), len(summary["deferred"])))
+
+    def _get_previously_failed(self):
+        """
+        :return: the set of consultation IDs that failed in the previous run
+        """
+        return {int(cons) for cons in self._load(self.summary_file).get("failed", {})}
+
+    def _get_previously_deferred(self):
+        """
+        :return: the list of consultation IDs deferred by the previous run, in their order
+        """
+        return [int(cons) for cons in self._load(self.summary_file).get("deferred", [])]
 
     def __repr__(self):
         return "ControllerWordCloud: {}".format(self.__dict__)
@@ -239,33 +1479,15 @@ class ControllerWordCloud(Scheduler):
         return 'ControllerWordCloud'
 
 
-class ControllerFekAnnotator(Scheduler):
-    def __init__(self, dir_name, java_exec, executable_class, config_file=None):
-        self.dir_name = dir_name
-        self.java_exec = java_exec
-        self.executable_class = executable_class
-        self.config_file = config_file
-        Scheduler.__init__(self)
-
+class ControllerFekAnnotator(ControllerJava):
     def execute(self, incoming):
         """
         will initiate the annotator (os.subprocess)
         :return None
+        :raise StepFailedError: if the annotator failed
         """
-        try:
-            cur_work_dir = os.getcwd()
-            os.chdir(os.path.dirname(self.dir_name))
-            # find all dependencies
-            libs = subprocess.check_output(['find', '-iname', '*.jar'])
-            class_path = ":".join([os.path.join(os.getcwd(), k) for k in libs.split() if k.endswith('.jar')])
-            # call annotator extractor
-            if self.config_file:
-                subprocess.call(["java", "-cp", class_path, self.executable_class, self.config_file])
-            else:
-                subprocess.call(["java", "-cp", class_path, self.executable_class])
-            os.chdir(cur_work_dir)
-        except Exception, ex:
-            self.logger.exception(ex)
+        # call annotator extractor
+        self._call_java(self.config_file)
         return None
 
     def __repr__(self):
@@ -278,10 +1500,45 @@ if __name__ == "__main__":
 
     gflags.DEFINE_string('log_file', DEFAULT_LOG_FILE, 'The file to log.')
 
+    gflags.DEFINE_integer('log_max_bytes', DEFAULT_LOG_MAX_BYTES, 'the size of the log file, before it is rotated.')
+
+    gflags.DEFINE_integer('log_backups', DEFAULT_LOG_BACKUP_COUNT, 'the number of rotated log files to keep.')
+
+    gflags.DEFINE_bool('log_json', False, 'log json lines, with step, consultation_id, duration and status fields.')
+
     gflags.DEFINE_string('schedules', "../schedules.yaml", 'the settings file to load')
 
+    gflags.DEFINE_string('schedule_cache', SCHEDULE_CACHE_FILE, 'the file to cache the compiled settings file in.')
+
     gflags.DEFINE_bool('first_run', False, 'use this if running for first time.')
 
+    gflags.DEFINE_bool('resume', False, 'resume the previous schedule, if it did not complete.')
+
+    gflags.DEFINE_integer('max_workers', DEFAULT_MAX_WORKERS, 'the max number of steps to execute concurrently.')
+
+    gflags.DEFINE_integer('heavy_slots', None, 'the max number of heavy child processes (e.g. JVMs) to run at once.')
+
+    gflags.DEFINE_string('metrics_file', METRICS_FILE, 'the json file to store the metrics of each step in.')
+
+    gflags.DEFINE_string('history_db', DEFAULT_HISTORY_DB, 'the sqlite database to record the history of the '
+                                                           'schedules in.')
+
+    gflags.DEFINE_string('prometheus_file', None, 'the prometheus textfile to export the metrics of each step to '
+                                                  '(e.g. in the directory of the node_exporter textfile collector).')
+
+    gflags.DEFINE_string('invalidate_fingerprints', None, 'drop the word cloud fingerprints of the consultations '
+                                                          '(comma separated IDs, or all), and exit.')
+
+    gflags.DEFINE_bool('explain', False, 'print the EXPLAIN ANALYZE plans of the scheduler queries, warn about the '
+                                         'missing indexes they rely on, and exit.')
+
+    gflags.DEFINE_bool('daemon', False, 'stay resident, and execute the pipeline on the triggers of the settings file.')
+
+    gflags.DEFINE_string('lock_file', DEFAULT_LOCK_FILE, 'the lock file that prevents overlapping schedules.')
+
+    gflags.DEFINE_bool('advisory_lock', False, 'also hold a postgres advisory lock while executing, to prevent '
+                                               'overlapping schedules across hosts.')
+
     FLAGS = gflags.FLAGS
 
     try:
@@ -290,5 +1547,43 @@ if __name__ == "__main__":
         print('%s\\nUsage: %s ARGS\\n%s' % (e, sys.argv[0], FLAGS))
         sys.exit(1)
 
-    scheduler = Scheduler(log_file=FLAGS.log_file, schedules=FLAGS.schedules)
-    scheduler.execute_pipeline(first=FLAGS.first_run)
+    # init the (singleton) logger, shared by the scheduler and all the controllers
+    DITLogger(filename=FLAGS.log_file, max_bytes=FLAGS.log_max_bytes, backup_count=FLAGS.log_backups,
+              json_format=FLAGS.log_json)
+    scheduler = Scheduler(log_file=FLAGS.log_file, schedules=FLAGS.schedules, max_workers=FLAGS.max_workers,
+                          heavy_slots=FLAGS.heavy_slots, metrics_file=FLAGS.metrics_file,
+                          prometheus_file=FLAGS.prometheus_file, history_db=FLAGS.history_db,
+                          schedule_cache=FLAGS.schedule_cache)
+    if FLAGS.invalidate_fingerprints:
+        ids = None if FLAGS.invalidate_fingerprints == 'all' else \
+            [int(cons) for cons in FLAGS.invalidate_fingerprints.split(",")]
+        scheduler.logger.info("dropped %d word cloud fingerprints" % scheduler.psql.invalidate_fingerprints(ids))
+        PSQLDBAccess.close_all()
+        sys.exit(0)
+    if FLAGS.explain:
+        for name, plan in scheduler.psql.explain_queries():
+            print "%s:\n  %s\n" % (name, "\n  ".join(plan))
+        for table, columns, reason in scheduler.psql.get_missing_indexes():
+            message = "missing index on %s (%s), for %s: CREATE INDEX CONCURRENTLY ON %s (%s);" \
+                      % (table, ", ".join(columns), reason, table, ", ".join(columns))
+            scheduler.logger.warn(message)
+            print "WARNING: " + message
+        PSQLDBAccess.close_all()
+        sys.exit(0)
+    lock = RunLock(FLAGS.lock_file, scheduler.psql if FLAGS.advisory_lock else None)
+    try:
+        if FLAGS.daemon:
+            SchedulerDaemon(scheduler, Scheduler.get_triggers(FLAGS.schedules, FLAGS.schedule_cache), lock,
+                            first=FLAGS.first_run, resume=FLAGS.resume).run()
+        elif not lock.acquire():
+            scheduler.logger.warn("another schedule is running: exiting")
+        else:
+            try:
+                scheduler.execute_pipeline(first=FLAGS.first_run, resume=FLAGS.resume)
+            finally:
+                lock.release()
+    except DBAccessError, e:
+        scheduler.logger.exception(e)
+        sys.exit(1)
+    finally:
+        PSQLDBAccess.close_all()
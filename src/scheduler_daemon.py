@@ -0,0 +1,229 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import fcntl
+import signal
+import threading
+from datetime import datetime, timedelta
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+DEFAULT_LOCK_FILE = os.path.abspath(os.path.join(os.getcwd(), os.pardir)) + "/scheduler.lock"
+ADVISORY_LOCK_KEY = 0x44495453  # the postgres advisory lock key of the scheduler ('DITS')
+LOCK_RETRY_INTERVAL = 60  # seconds between attempts to take the lock, while another schedule is running
+MAX_SLEEP = 60  # seconds, so that the daemon follows clock changes
+
+CRON_ALIASES = {
+    '@hourly': '0 * * * *',
+    '@daily': '0 0 * * *',
+    '@midnight': '0 0 * * *',
+    '@weekly': '0 0 * * 0',
+    '@monthly': '0 0 1 * *',
+    '@yearly': '0 0 1 1 *',
+}
+
+CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day of month', 1, 31), ('month', 1, 12), ('day of week', 0, 7))
+
+
+class CronExpression:
+    """
+    A cron expression of 5 fields (minute, hour, day of month, month, day of week), each one a '*', a value,
+    a range (a-b), a step (*/n or a-b/n), or a comma separated list of those, e.g. '30 */6 * * 1-5'.
+    As in cron, if both the day of month and the day of week are restricted, either one may match.
+    """
+
+    def __init__(self, expression):
+        self.expression = expression
+        fields = CRON_ALIASES.get(expression.strip(), expression).split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError("invalid cron expression '%s': expected %d fields" % (expression, len(CRON_FIELDS)))
+        self.minutes, self.hours, self.days, self.months, self.weekdays = \
+            [self._parse(field, name, low, high) for field, (name, low, high) in zip(fields, CRON_FIELDS)]
+        self.weekdays = {day % 7 for day in self.weekdays}  # both 0 and 7 are sunday
+        self.any_day, self.any_weekday = fields[2] == '*', fields[4] == '*'
+
+    def next_after(self, date):
+        """
+        :return: the first minute after the date on which the expression fires
+        """
+        date = date.replace(second=0, microsecond=0) + timedelta(minutes=1)
+        limit = date + timedelta(days=366 * 5)
+        while date < limit:
+            if date.month not in self.months or not self._matches_day(date):
+                date = date.replace(hour=0, minute=0) + timedelta(days=1)
+            elif date.hour not in self.hours:
+                date = date.replace(minute=0) + timedelta(hours=1)
+            elif date.minute not in self.minutes:
+                date += timedelta(minutes=1)
+            else:
+                return date
+        raise ValueError("cron expression '%s' never fires" % self.expression)
+
+    def _matches_day(self, date):
+        day, weekday = date.day in self.days, (date.weekday() + 1) % 7 in self.weekdays
+        if self.any_day or self.any_weekday:
+            return day and weekday
+        return day or weekday
+
+    def _parse(self, field, name, low, high):
+        """
+        :return: the set of values of the field
+        """
+        values = set()
+        for part in field.split(','):
+            span, _, step = part.partition('/')
+            try:
+                step = int(step) if step else 1
+                if span == '*':
+                    start, end = low, high
+                elif '-' in span:
+                    start, end = [int(value) for value in span.split('-', 1)]
+                else:
+                    start = end = int(span)
+                    if step > 1:  # e.g. 5/15: from 5, every 15
+                        end = high
+            except ValueError:
+                raise ValueError("invalid %s '%s' in cron expression '%s'" % (name, part, self.expression))
+            if not low <= start <= end <= high or step < 1:
+                raise ValueError("invalid %s '%s' in cron expression '%s'" % (name, part, self.expression))
+            values.update(range(start, end + 1, step))
+        return values
+
+    def __repr__(self):
+        return "CronExpression: {}".format(self.expression)
+
+
+class RunLock:
+    """
+    An exclusive lock over the schedules, so that two schedules never overlap: a file lock (flock) for the
+    schedules of the same host, and optionally a postgres advisory lock for the schedules of any host
+    """
+
+    def __init__(self, lock_file=None, psql=None):
+        """
+        :param lock_file: the lock file
+        :param psql: the PSQLDBAccess to take the advisory lock with, if any
+        """
+        self.lock_file = lock_file if lock_file else DEFAULT_LOCK_FILE
+        self.psql = psql
+        self._file = None
+        self._con = None
+
+    def acquire(self):
+        """
+        :return: True if the lock was taken, False if another schedule holds it
+        """
+        f = open(self.lock_file, 'a+')
+        try:
+            fcntl.flock(f.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            f.close()
+            return False
+        if self.psql:
+            try:
+                self._con = self.psql.acquire_advisory_lock(ADVISORY_LOCK_KEY)
+            except Exception:
+                f.close()
+                raise
+            if not self._con:
+                f.close()
+                return False
+        # record the holder, for the operators
+        f.truncate(0)
+        f.write("%d\n" % os.getpid())
+        f.flush()
+        self._file = f
+        return True
+
+    def release(self):
+        if self._con:
+            self.psql.release_advisory_lock(self._con, ADVISORY_LOCK_KEY)
+            self._con = None
+        if self._file:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+            self._file.close()
+            self._file = None
+
+
+class SchedulerDaemon:
+    """
+    Keep the scheduler resident, and execute its pipeline whenever any of its cron triggers fires.
+    Each schedule runs under the RunLock. The triggers that fire while a schedule is running are merged
+    into a single follow-up schedule, started as soon as it ends.
+    """
+
+    def __init__(self, scheduler, triggers, lock, first=False, resume=False):
+        """
+        :param scheduler: the Scheduler to execute
+        :param triggers: the cron expressions to execute the pipeline on
+        :param lock: the RunLock to hold while executing
+        :param first: whether the first schedule is a first run
+        :param resume: whether the first schedule resumes the previous one, if it did not complete
+        """
+        if not triggers:
+            raise ValueError("no triggers: add a 'triggers' list of cron expressions to the schedules file")
+        self.scheduler = scheduler
+        self.logger = scheduler.logger
+        self.triggers = [CronExpression(trigger) for trigger in triggers]
+        self.lock = lock
+        self.first = first
+        self.resume = resume
+        self.stopped = threading.Event()
+
+    def run(self):
+        """
+        wait for the triggers and execute the pipeline, until stopped (SIGTERM or SIGINT)
+        """
+        signal.signal(signal.SIGTERM, self._on_signal)
+        signal.signal(signal.SIGINT, self._on_signal)
+        next_fire = self._next_fire(datetime.now())
+        pending = False
+        self.logger.info("Scheduler daemon started (pid %d): next schedule at %s" % (os.getpid(), next_fire))
+        while not self.stopped.is_set():
+            now = datetime.now()
+            if not pending:
+                if now < next_fire:
+                    self.stopped.wait(min((next_fire - now).total_seconds(), MAX_SLEEP))
+                    continue
+                pending, next_fire = True, self._next_fire(now)
+            if not self.lock.acquire():
+                self.logger.warn("another schedule is running: retrying in %d secs" % LOCK_RETRY_INTERVAL)
+                self.stopped.wait(LOCK_RETRY_INTERVAL)
+                continue
+            pending = False
+            try:
+                self.scheduler.execute_pipeline(first=self.first, resume=self.resume)
+            except Exception, ex:  # a failed schedule does not stop the daemon
+                self.logger.exception(ex)
+            finally:
+                self.lock.release()
+                self.first = self.resume = False
+            now = datetime.now()
+            if now >= next_fire:
+                fired = self._count_fires(next_fire, now)
+                self.logger.info("%d triggers fired while the schedule was running: merged into one follow-up "
+                                 "schedule" % fired)
+                pending, next_fire = True, self._next_fire(now)
+            else:
+                self.logger.info("next schedule at %s" % next_fire)
+        self.logger.info("Scheduler daemon stopped")
+
+    def stop(self):
+        self.stopped.set()
+
+    def _on_signal(self, signum, frame):
+        self.logger.info("received signal %d: stopping after the running schedule, if any" % signum)
+        self.stop()
+
+    def _next_fire(self, date):
+        return min(trigger.next_after(date) for trigger in self.triggers)
+
+    def _count_fires(self, since, until):
+        """
+        :return: the number of times the triggers fired from since until until
+        """
+        fired, date = 0, since
+        while date <= until:
+            fired += 1
+            date = self._next_fire(date)
+        return fired
@@ -0,0 +1,352 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import time
+import socket
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+from models import Job
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+JOB_PENDING = 'pending'
+JOB_LEASED = 'leased'
+JOB_DONE = 'done'
+JOB_DEAD = 'dead'  # failed max_attempts times: dead-lettered, to be inspected
+JOB_CANCELLED = 'cancelled'
+
+DEFAULT_QUEUE_NAME = 'wordcloud'
+DEFAULT_LEASE_TIME = 300  # seconds a worker holds a job, before it may be leased by another worker
+DEFAULT_MAX_ATTEMPTS = 3
+DEFAULT_RETRY_DELAY = 30  # seconds before the first retry of a failed job, doubled on every attempt
+DEFAULT_WORKER_POLL_INTERVAL = 5  # seconds between polls of an idle worker
+
+CREATE_TABLE = \
+    "CREATE TABLE IF NOT EXISTS " + Job.__tablename__ + " (" \
+    "id {serial} PRIMARY KEY, " \
+    "queue varchar(64) NOT NULL, " \
+    "batch varchar(128) NOT NULL, " \
+    "payload integer NOT NULL, " \
+    "status varchar(16) NOT NULL, " \
+    "attempts integer NOT NULL DEFAULT 0, " \
+    "max_attempts integer NOT NULL, " \
+    "lease_time integer NOT NULL, " \
+    "available_at double precision, " \
+    "lease_owner varchar(255), " \
+    "lease_expires double precision, " \
+    "result integer, " \
+    "error text);"
+
+CREATE_INDEXES = (
+    "CREATE INDEX IF NOT EXISTS ix_scheduler_jobs_queue_status_id ON " + Job.__tablename__ + " (queue, status, id);",
+    "CREATE INDEX IF NOT EXISTS ix_scheduler_jobs_batch ON " + Job.__tablename__ + " (batch);",
+)
+
+
+def get_work_queue(url, name=DEFAULT_QUEUE_NAME):
+    """
+    :param url: 'postgres' for the scheduler database, or sqlite:///<path> for a local database (e.g. for testing)
+    :param name: the queue name
+    :return: the WorkQueue
+    """
+    if url in ('postgres', 'postgresql'):
+        return PostgresWorkQueue(name)
+    if url.startswith('sqlite:///'):
+        return SQLiteWorkQueue(name, url[len('sqlite:///'):])
+    raise ValueError("invalid work queue '%s', must be postgres or sqlite:///<path>" % url)
+
+
+class WorkQueue:
+    """
+    A durable queue of jobs (each one an integer payload, e.g. a consultation ID), consumed by any number of
+    workers, on any host. A worker leases a job for its lease_time: if the job is not completed (or failed)
+    by then, e.g. because the worker crashed, it is leased again, and the late result of the first worker
+    is dropped. A failed job is retried after a backoff,
+    up to its max_attempts, and is then dead-lettered.
+    Subclasses provide the connection (a connection() context manager, committed if the block succeeds,
+    else rolled back), and the SQL dialect.
+    """
+    NOW = None  # the SQL expression of the current epoch seconds
+    SERIAL = None  # the SQL type of the auto increment ID
+    LOCK_CLAUSE = ""  # the SQL clause that locks the selected job, skipping the ones locked by other workers
+
+    def __init__(self, name=DEFAULT_QUEUE_NAME):
+        self.name = name
+        self._table_created = False
+
+    def enqueue(self, batch, payloads, lease_time=DEFAULT_LEASE_TIME, max_attempts=DEFAULT_MAX_ATTEMPTS):
+        """
+        :param batch: the batch ID of the jobs (e.g. the step execution enqueuing them)
+        :param payloads: the payload of each job, in the order they are to be leased
+        :return: the number of jobs enqueued
+        """
+        payloads = list(payloads)
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.executemany(self._sql("INSERT INTO {table} (queue, batch, payload, status, attempts, max_attempts, "
+                                      "lease_time, available_at) VALUES (%s, %s, %s, %s, 0, %s, %s, {now});"),
+                            [(self.name, batch, payload, JOB_PENDING, max_attempts, lease_time)
+                             for payload in payloads])
+        return len(payloads)
+
+    def lease(self, worker):
+        """
+        :param worker: the worker ID
+        :return: a tuple of the job ID, payload and attempt number of the next available job, or None if there is none
+        """
+        with self.connection() as con:
+            cur = con.cursor()
+            # dead-letter the jobs whose lease expired on their last attempt (e.g. their worker keeps crashing)
+            cur.execute(self._sql("UPDATE {table} SET status = %s, error = 'lease expired' "
+                                  "WHERE queue = %s AND status = %s AND lease_expires < {now} "
+                                  "AND attempts >= max_attempts;"), (JOB_DEAD, self.name, JOB_LEASED))
+            cur.execute(self._sql("SELECT id, payload, attempts FROM {table} "
+                                  "WHERE queue = %s AND ((status = %s AND available_at <= {now}) "
+                                  "OR (status = %s AND lease_expires < {now})) "
+                                  "ORDER BY id LIMIT 1" + self.LOCK_CLAUSE + ";"), (self.name, JOB_PENDING, JOB_LEASED))
+            job = cur.fetchone()
+            if not job:
+                return None
+            cur.execute(self._sql("UPDATE {table} SET status = %s, attempts = attempts + 1, lease_owner = %s, "
+                                  "lease_expires = {now} + lease_time WHERE id = %s;"), (JOB_LEASED, worker, job[0]))
+            return job[0], job[1], job[2] + 1
+
+    def complete(self, job_id, worker, result=None):
+        """
+        :param worker: the worker ID, holding the lease of the job
+        :return: False if the worker has lost the lease (it expired, and the job was leased again, or the job
+        was cancelled), so that the job was left as is
+        """
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute(self._sql("UPDATE {table} SET status = %s, result = %s, error = NULL "
+                                  "WHERE id = %s AND status = %s AND lease_owner = %s;"),
+                        (JOB_DONE, result, job_id, JOB_LEASED, worker))
+            return cur.rowcount > 0
+
+    def fail(self, job_id, worker, attempt, result=None, error=None):
+        """
+        put the job back to the queue, after a backoff, or dead-letter it if this was its last attempt
+        :param worker: the worker ID, holding the lease of the job
+        :param attempt: the attempt number of the job, as leased
+        :return: False if the worker has lost the lease, so that the job was left as is (see complete)
+        """
+        delay = DEFAULT_RETRY_DELAY * 2 ** (attempt - 1)
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute(self._sql("UPDATE {table} SET status = CASE WHEN attempts >= max_attempts THEN %s ELSE %s END, "
+                                  "result = %s, error = %s, available_at = {now} + %s, lease_expires = NULL "
+                                  "WHERE id = %s AND status = %s AND lease_owner = %s;"),
+                        (JOB_DEAD, JOB_PENDING, result, error, delay, job_id, JOB_LEASED, worker))
+            return cur.rowcount > 0
+
+    def cancel(self, batch, leased=False):
+        """
+        cancel the pending jobs of the batch (the leased ones are left to finish)
+        :param leased: cancel the leased jobs too (e.g. when their workers are gone)
+        :return: the payloads of the jobs cancelled, in their order
+        """
+        statuses = (JOB_PENDING, JOB_LEASED) if leased else (JOB_PENDING,)
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute(self._sql("SELECT id, payload FROM {table} WHERE batch = %s AND status IN (" +
+                                  ", ".join(["%s"] * len(statuses)) + ") ORDER BY id" + self.LOCK_CLAUSE + ";"),
+                        (batch,) + statuses)
+            jobs = cur.fetchall()
+            cur.executemany(self._sql("UPDATE {table} SET status = %s WHERE id = %s;"),
+                            [(JOB_CANCELLED, job[0]) for job in jobs])
+            return [job[1] for job in jobs]
+
+    def get_counts(self, batch):
+        """
+        :return: a dict containing the number of jobs of the batch in each status
+        """
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute(self._sql("SELECT status, count(*) FROM {table} WHERE batch = %s GROUP BY status;"), (batch,))
+            return dict(cur.fetchall())
+
+    def get_results(self, batch):
+        """
+        :return: a dict containing the (status, result) of each job of the batch, by payload
+        """
+        with self.connection() as con:
+            cur = con.cursor()
+            cur.execute(self._sql("SELECT payload, status, result FROM {table} WHERE batch = %s;"), (batch,))
+            return dict((payload, (status, result)) for payload, status, result in cur.fetchall())
+
+    def _create_table(self, con):
+        cur = con.cursor()
+        cur.execute(CREATE_TABLE.format(serial=self.SERIAL))
+        for statement in CREATE_INDEXES:
+            cur.execute(statement)
+
+    def _sql(self, query):
+        return query.format(table=Job.__tablename__, now=self.NOW)
+
+    def __repr__(self):
+        return "{}: {}".format(self.__class__.__name__, self.name)
+
+
+class PostgresWorkQueue(WorkQueue):
+    """The work queue in the scheduler database: concurrent workers skip the jobs locked by each other"""
+    NOW = "extract(epoch from now())"
+    SERIAL = "serial"
+    LOCK_CLAUSE = " FOR UPDATE SKIP LOCKED"
+
+    def __init__(self, name=DEFAULT_QUEUE_NAME, psql=None):
+        WorkQueue.__init__(self, name)
+        if not psql:
+            from psql_dbaccess import PSQLDBAccess
+            psql = PSQLDBAccess()
+        self.psql = psql
+
+    @contextmanager
+    def connection(self):
+        with self.psql.connection() as con:
+            if not self._table_created:
+                self._create_table(con)
+                self._table_created = True
+            yield con
+
+
+class SQLiteWorkQueue(WorkQueue):
+    """The work queue in a local sqlite database, for testing: each operation locks the whole database"""
+    NOW = "((julianday('now') - 2440587.5) * 86400.0)"
+    SERIAL = "integer"
+
+    def __init__(self, name=DEFAULT_QUEUE_NAME, path=None):
+        WorkQueue.__init__(self, name)
+        self.path = path
+
+    @contextmanager
+    def connection(self):
+        con = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+        try:
+            # take the write lock up front, so that two workers never select the same job
+            con.execute("BEGIN IMMEDIATE")
+        except sqlite3.Error:
+            con.close()
+            raise
+        try:
+            if not self._table_created:
+                self._create_table(con)
+                self._table_created = True
+            yield con
+            con.execute("COMMIT")
+        except:
+            con.execute("ROLLBACK")
+            raise
+        finally:
+            con.close()
+
+    def _sql(self, query):
+        return WorkQueue._sql(self, query).replace("%s", "?")
+
+
+class QueueWorker(threading.Thread):
+    """
+    Lease the jobs of the queue and process them, until stopped. A job whose handler returns a 200
+    (e.g. the response status code) is done, else it is failed (to be retried, or dead-lettered)
+    """
+
+    def __init__(self, queue, handler, logger, poll_interval=DEFAULT_WORKER_POLL_INTERVAL):
+        """
+        :param queue: the WorkQueue
+        :param handler: the function processing the payload of a job, returning its result code
+        :param logger: the logger to report to
+        :param poll_interval: the interval (in seconds) between polls, while the queue is empty
+        """
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = queue
+        self.handler = handler
+        self.logger = logger
+        self.poll_interval = poll_interval
+        self.worker_id = "%s:%d:%s" % (socket.gethostname(), os.getpid(), self.name)
+        self.stopped = threading.Event()
+
+    def run(self):
+        while not self.stopped.is_set():
+            try:
+                job = self.queue.lease(self.worker_id)
+            except Exception, ex:
+                self.logger.exception(ex)
+                job = None
+            if not job:
+                self.stopped.wait(self.poll_interval)
+                continue
+            job_id, payload, attempt = job
+            result, error = None, None
+            try:
+                result = self.handler(payload)
+            except Exception, ex:
+                error = str(ex)
+            try:
+                if result == 200:
+                    recorded = self.queue.complete(job_id, self.worker_id, result)
+                else:
+                    recorded = self.queue.fail(job_id, self.worker_id, attempt, result, error)
+                if not recorded:
+                    self.logger.warn("%s: lost the lease of job %d (payload %s): its result %s is dropped"
+                                     % (self.worker_id, job_id, payload, result))
+            except Exception, ex:  # the lease expires, and the job is leased again
+                self.logger.exception(ex)
+
+    def stop(self):
+        self.stopped.set()
+
+
+if __name__ == "__main__":
+    import sys
+    import signal
+    import gflags
+    from dit_logger import DITLogger
+    from scheduler import ControllerWordCloud, DEFAULT_HTTP_TIMEOUT, DEFAULT_LOG_FILE
+
+    gflags.DEFINE_string('queue_url', 'postgres', 'the work queue: postgres, or sqlite:///<path> for testing.')
+
+    gflags.DEFINE_string('queue_name', DEFAULT_QUEUE_NAME, 'the name of the queue to consume.')
+
+    gflags.DEFINE_string('url', None, 'the url of the word cloud extractor.')
+
+    gflags.DEFINE_integer('threads', 4, 'the number of jobs processed concurrently.')
+
+    gflags.DEFINE_integer('timeout', DEFAULT_HTTP_TIMEOUT, 'the timeout (in seconds) of each extractor request.')
+
+    gflags.DEFINE_string('log_file', DEFAULT_LOG_FILE, 'The file to log.')
+
+    FLAGS = gflags.FLAGS
+
+    try:
+        argv = FLAGS(sys.argv)
+        if not FLAGS.url:
+            raise gflags.FlagsError("--url is required")
+    except gflags.FlagsError as e:
+        print('%s\\nUsage: %s ARGS\\n%s' % (e, sys.argv[0], FLAGS))
+        sys.exit(1)
+
+    logger = DITLogger(filename=FLAGS.log_file)
+    extractor = ControllerWordCloud(FLAGS.url, timeout=FLAGS.timeout)
+    extractor.step_name = "worker"
+    client = extractor.get_http_client(FLAGS.threads)
+    work_queue = get_work_queue(FLAGS.queue_url, FLAGS.queue_name)
+    workers = [QueueWorker(work_queue, lambda cons: extractor._call_wordcloud_extractor(cons, client), logger)
+               for _ in range(FLAGS.threads)]
+
+    def stop(signum, frame):
+        logger.info("received signal %d: stopping after the running jobs" % signum)
+        for worker in workers:
+            worker.stop()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    logger.info("consuming %s with %d threads" % (work_queue, FLAGS.threads))
+    for worker in workers:
+        worker.start()
+    while any(worker.is_alive() for worker in workers):
+        time.sleep(1)
+    client.close()
+    logger.info("stopped consuming %s" % work_queue)
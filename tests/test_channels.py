@@ -0,0 +1,160 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import shutil
+import tempfile
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from channels import Channel, ChannelRegistry, ChannelClosedError
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+
+def produce(channel, batches, delay=0.01, failed=False):
+    """
+    put the batches to the channel from a new thread, one every delay secs, and close it
+    :return: the producer thread
+    """
+    def run():
+        for batch in batches:
+            time.sleep(delay)
+            channel.extend(batch)
+        channel.close(failed)
+
+    producer = threading.Thread(target=run)
+    producer.start()
+    return producer
+
+
+class ChannelTest(unittest.TestCase):
+
+    def test_consumer_reads_while_producer_runs(self):
+        channel = Channel("consultations", "int")
+        received = []
+        producer = produce(channel, [[1, 2], [3], [4, 5, 6]], delay=0.05)
+        for batch in channel.batches():
+            # the first batch arrives before the producer has put the rest
+            received.append((batch, channel.closed))
+        producer.join()
+        self.assertEqual([item for batch, _ in received for item in batch], [1, 2, 3, 4, 5, 6])
+        self.assertFalse(received[0][1])
+        self.assertFalse(channel.failed)
+
+    def test_every_consumer_reads_all_items_in_order(self):
+        channel = Channel("consultations", "int")
+        results = {}
+
+        def consume(name):
+            results[name] = list(channel)
+
+        consumers = [threading.Thread(target=consume, args=(name,)) for name in ("index", "wordcloud")]
+        for consumer in consumers:
+            consumer.start()
+        produce(channel, [[3, 1], [2]]).join()
+        for consumer in consumers:
+            consumer.join()
+        self.assertEqual(results, {"index": [3, 1, 2], "wordcloud": [3, 1, 2]})
+
+    def test_batches_are_bounded(self):
+        channel = Channel("consultations", "int")
+        channel.extend(range(5))
+        channel.close()
+        self.assertEqual(list(channel.batches(max_size=2)), [[0, 1], [2, 3], [4]])
+
+    def test_failed_producer_is_visible_after_iterating(self):
+        channel = Channel("consultations", "int")
+        produce(channel, [[1]], failed=True).join()
+        self.assertEqual(list(channel), [1])
+        self.assertTrue(channel.failed)
+
+    def test_items_are_type_checked(self):
+        channel = Channel("consultations", "int")
+        self.assertRaises(TypeError, channel.put, "12")
+        self.assertRaises(TypeError, channel.extend, [1, 2.5])
+        self.assertEqual(channel.items, [])
+        Channel("anything").put(object())
+
+    def test_unknown_type_is_rejected(self):
+        self.assertRaises(ValueError, Channel, "consultations", "integer")
+
+    def test_closed_channel_rejects_items(self):
+        channel = Channel("consultations", "int")
+        channel.close()
+        channel.close(failed=True)  # no-op: already closed
+        self.assertFalse(channel.failed)
+        self.assertRaises(ChannelClosedError, channel.put, 1)
+
+    def test_release_ends_consumers(self):
+        registry = ChannelRegistry({"consultations": "int"})
+        channel = registry.get("consultations")
+        channel.extend([1, 2])
+        registry.release()
+        self.assertTrue(channel.closed and channel.failed)
+        self.assertEqual(list(channel), [])
+        self.assertRaises(KeyError, registry.get, "consultations")
+
+
+class FakePSQL:
+    """The consultations commented after a comment ID, as queried by the consumers"""
+
+    def __init__(self, consultations):
+        self.consultations = consultations
+        self.queried = []
+
+    def iter_updated_consultations(self, prev_comment_id, batch_size=None):
+        self.queried.append(prev_comment_id)
+        yield list(self.consultations)
+
+
+class ConsumerTest(unittest.TestCase):
+    """The crawler channel, as read by ControllerWordCloud and ControllerIndex"""
+
+    @classmethod
+    def setUpClass(cls):
+        cls.work_dir = tempfile.mkdtemp()
+        from scheduler import RunContext
+        RunContext.get(os.path.join(cls.work_dir, "scheduler.log"))
+
+    @classmethod
+    def tearDownClass(cls):
+        shutil.rmtree(cls.work_dir, ignore_errors=True)
+
+    def controller(self, watermark, queried=(1, 2, 3)):
+        from scheduler import ControllerWordCloud
+        controller = ControllerWordCloud("http://localhost/extractor", consultations=None)
+        controller.psql = FakePSQL(queried)
+        controller.get_previous_comment_id = lambda: 50
+        controller.watermark = watermark
+        return controller
+
+    def test_channel_is_streamed_when_it_covers_the_delta(self):
+        for watermark in (None, 50):
+            controller = self.controller(watermark)
+            channel = Channel("consultations", "int")
+            producer = produce(channel, [[9], [4]])
+            self.assertEqual(list(controller._iter_delta(channel)), [[9], [4]])
+            producer.join()
+            self.assertEqual(controller.psql.queried, [])
+
+    def test_delta_is_queried_when_the_watermark_is_behind(self):
+        controller = self.controller(10)
+        channel = Channel("consultations", "int")
+        channel.close()
+        self.assertEqual(list(controller._iter_delta(channel)), [[1, 2, 3]])
+        self.assertEqual(controller.psql.queried, [10])
+
+    def test_failed_producer_falls_back_to_the_query(self):
+        controller = self.controller(None, queried=(3, 9, 7))
+        channel = Channel("consultations", "int")
+        produce(channel, [[9]], failed=True)
+        self.assertEqual(list(controller._iter_delta(channel)), [[9], [3, 7]])
+        self.assertEqual(controller.psql.queried, [50])
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,62 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import time
+import threading
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from child_process import ChildProcessRunner, ResourceLimits
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+
+class FakeLogger:
+    """Collects the lines of the children"""
+
+    def __init__(self):
+        self.lines = []
+
+    def info(self, message):
+        self.lines.append(message)
+
+    def error(self, message):
+        self.lines.append(message)
+
+
+class ChildProcessRunnerTest(unittest.TestCase):
+
+    def test_output_is_forwarded_and_usage_reported(self):
+        logger = FakeLogger()
+        report = ChildProcessRunner(logger=logger, tag="echo").run(["sh", "-c", "echo done; exit 3"])
+        self.assertEqual(report["returncode"], 3)
+        self.assertIsNone(report["killed"])
+        self.assertEqual(logger.lines, ["[echo:out] done"])
+
+    def test_child_exceeding_its_timeout_is_killed(self):
+        report = ChildProcessRunner(ResourceLimits(timeout=0.5)).run(["sleep", "10"])
+        self.assertEqual(report["killed"], "timeout")
+        self.assertNotEqual(report["returncode"], 0)
+        self.assertLess(report["wall_time"], 5)
+
+    def test_child_does_not_inherit_the_pipes_of_its_siblings(self):
+        # the pipe of a sibling being started by another thread, whose write end the parent still holds
+        read_end, write_end = os.pipe()
+        slow = threading.Thread(target=ChildProcessRunner().run, args=(["sleep", "3"],))
+        slow.start()
+        time.sleep(0.5)
+        os.close(write_end)  # the sibling exited: its reader gets EOF, unless the slow child holds a copy
+        reader = threading.Thread(target=os.read, args=(read_end, 1))
+        reader.daemon = True
+        reader.start()
+        reader.join(1)
+        eof = not reader.is_alive()
+        slow.join()
+        os.close(read_end)
+        self.assertTrue(eof)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+import http_client
+from http_client import CircuitBreaker, CIRCUIT_CLOSED, CIRCUIT_OPEN, CIRCUIT_HALF_OPEN
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+
+class FakeClock:
+    """Replaces the time module of http_client, so that the reset timeout elapses instantly"""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class CircuitBreakerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = FakeClock()
+        self.time, http_client.time = http_client.time, self.clock
+        self.breaker = CircuitBreaker("http://localhost/extractor", failure_threshold=3, reset_timeout=60)
+
+    def tearDown(self):
+        http_client.time = self.time
+
+    def open(self):
+        for _ in range(self.breaker.failure_threshold):
+            self.breaker.record_failure()
+
+    def test_opens_after_consecutive_failures(self):
+        self.assertFalse(self.breaker.record_failure())
+        self.assertFalse(self.breaker.record_failure())
+        self.assertTrue(self.breaker.allow())
+        self.assertTrue(self.breaker.record_failure())
+        self.assertEqual(self.breaker.state, CIRCUIT_OPEN)
+        self.assertFalse(self.breaker.allow())
+
+    def test_success_resets_the_failures(self):
+        self.breaker.record_failure()
+        self.breaker.record_failure()
+        self.breaker.record_success()
+        self.assertFalse(self.breaker.record_failure())
+        self.assertEqual(self.breaker.state, CIRCUIT_CLOSED)
+
+    def test_single_trial_after_reset_timeout(self):
+        self.open()
+        self.clock.now += 59
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 1
+        self.assertTrue(self.breaker.allow())
+        self.assertEqual(self.breaker.state, CIRCUIT_HALF_OPEN)
+        self.assertFalse(self.breaker.allow())  # the trial is in flight
+
+    def test_successful_trial_closes_the_circuit(self):
+        self.open()
+        self.clock.now += 60
+        self.breaker.allow()
+        self.breaker.record_success()
+        self.assertEqual(self.breaker.state, CIRCUIT_CLOSED)
+        self.assertTrue(self.breaker.allow())
+
+    def test_failed_trial_opens_the_circuit_again(self):
+        self.open()
+        self.clock.now += 60
+        self.breaker.allow()
+        self.assertTrue(self.breaker.record_failure())
+        self.assertFalse(self.breaker.allow())
+        self.clock.now += 60
+        self.assertTrue(self.breaker.allow())
+
+    def test_one_breaker_per_endpoint(self):
+        breaker = CircuitBreaker.get("http://localhost:8983/solr/dit_comments/dataimport?command=status")
+        self.assertIs(CircuitBreaker.get("http://localhost:8983/solr/dit_comments/dataimport?command=full-import"),
+                      breaker)
+        self.assertIsNot(CircuitBreaker.get("http://localhost:8983/solr/dit_articles/dataimport"), breaker)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,56 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from scheduler import Scheduler
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+
+def step(cls, **settings):
+    settings.update({"package": "scheduler", "class": cls})
+    return settings
+
+
+class DependenciesTest(unittest.TestCase):
+
+    def test_steps_run_in_file_order_by_default(self):
+        settings = [step("ControllerCrawl"), step("ControllerIndex"), step("ControllerWordCloud")]
+        self.assertEqual(Scheduler.get_dependencies(settings), {1: set(), 2: {1}, 3: {1, 2}})
+
+    def test_stage_waits_for_lower_stages_and_earlier_steps_with_no_stage(self):
+        settings = [step("ControllerCrawl"), step("ControllerIndex", stage=2), step("ControllerWordCloud", stage=2),
+                    step("ControllerFekAnnotator", stage=3), step("ControllerFekAnnotator", stage=1)]
+        self.assertEqual(Scheduler.get_dependencies(settings), {1: set(), 2: {1, 5}, 3: {1, 5}, 4: {1, 2, 3, 5},
+                                                               5: {1}})
+
+    def test_depends_on_names_or_numbers(self):
+        settings = [step("ControllerCrawl", name="crawl"), step("ControllerIndex", depends_on="crawl"),
+                    step("ControllerWordCloud", depends_on=[1, "ControllerIndex"]),
+                    step("ControllerFekAnnotator", depends_on=None)]
+        self.assertEqual(Scheduler.get_dependencies(settings), {1: set(), 2: {1}, 3: {1, 2}, 4: set()})
+
+    def test_unknown_dependency_is_rejected(self):
+        settings = [step("ControllerCrawl"), step("ControllerIndex", depends_on="crawl")]
+        self.assertRaises(ValueError, Scheduler.get_dependencies, settings)
+
+    def test_circular_dependency_is_rejected(self):
+        settings = [step("ControllerCrawl", depends_on="ControllerIndex"), step("ControllerIndex")]
+        self.assertRaises(ValueError, Scheduler.get_dependencies, settings)
+        settings = [step("ControllerIndex", depends_on="ControllerIndex")]
+        self.assertRaises(ValueError, Scheduler.get_dependencies, settings)
+
+    def test_step_names(self):
+        settings = [step("ControllerFekAnnotator"), step("ControllerFekAnnotator"), step("ControllerIndex")]
+        self.assertEqual(Scheduler.get_step_names(settings), {1: "ControllerFekAnnotator#1",
+                                                              2: "ControllerFekAnnotator#2", 3: "ControllerIndex"})
+        settings = [step("ControllerCrawl", name="index"), step("ControllerIndex", name="index")]
+        self.assertRaises(ValueError, Scheduler.get_step_names, settings)
+
+
+if __name__ == "__main__":
+    unittest.main()
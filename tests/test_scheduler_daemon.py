@@ -0,0 +1,66 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import unittest
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from scheduler_daemon import CronExpression
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+
+class CronExpressionTest(unittest.TestCase):
+
+    def assertNext(self, expression, date, expected):
+        self.assertEqual(CronExpression(expression).next_after(date), expected)
+
+    def test_next_minute_is_strictly_after(self):
+        self.assertNext("* * * * *", datetime(2026, 3, 10, 10, 7, 30), datetime(2026, 3, 10, 10, 8))
+        self.assertNext("7 * * * *", datetime(2026, 3, 10, 10, 7), datetime(2026, 3, 10, 11, 7))
+
+    def test_steps_ranges_and_lists(self):
+        self.assertNext("*/15 * * * *", datetime(2026, 3, 10, 10, 7), datetime(2026, 3, 10, 10, 15))
+        self.assertNext("30 */6 * * *", datetime(2026, 3, 10, 7, 0), datetime(2026, 3, 10, 12, 30))
+        self.assertNext("0 9-17/4 * * *", datetime(2026, 3, 10, 13, 1), datetime(2026, 3, 10, 17, 0))
+        self.assertNext("5,45 * * * *", datetime(2026, 3, 10, 10, 5), datetime(2026, 3, 10, 10, 45))
+        self.assertNext("5/20 * * * *", datetime(2026, 3, 10, 10, 26), datetime(2026, 3, 10, 10, 45))
+
+    def test_rolls_over_day_month_and_year(self):
+        self.assertNext("0 0 * * *", datetime(2026, 12, 31, 23, 59), datetime(2027, 1, 1, 0, 0))
+        self.assertNext("0 0 1 1 *", datetime(2026, 6, 1), datetime(2027, 1, 1, 0, 0))
+
+    def test_month_is_respected(self):
+        self.assertNext("0 0 * 2 *", datetime(2026, 3, 5), datetime(2027, 2, 1, 0, 0))
+        self.assertNext("0 12 15 6,12 *", datetime(2026, 6, 15, 12, 0), datetime(2026, 12, 15, 12, 0))
+
+    def test_day_of_week(self):
+        # 2026-03-10 is a tuesday: both 0 and 7 are sunday
+        self.assertNext("0 0 * * 0", datetime(2026, 3, 10), datetime(2026, 3, 15, 0, 0))
+        self.assertNext("0 0 * * 7", datetime(2026, 3, 10), datetime(2026, 3, 15, 0, 0))
+        self.assertNext("0 8 * * 1-5", datetime(2026, 3, 13, 9, 0), datetime(2026, 3, 16, 8, 0))
+
+    def test_day_of_month_or_day_of_week(self):
+        # as in cron, either one matches when both are restricted: the 13th (a friday), or any monday
+        self.assertNext("0 0 13 * 1", datetime(2026, 3, 10), datetime(2026, 3, 13, 0, 0))
+        self.assertNext("0 0 13 * 1", datetime(2026, 3, 13, 1, 0), datetime(2026, 3, 16, 0, 0))
+
+    def test_aliases(self):
+        self.assertNext("@hourly", datetime(2026, 3, 10, 10, 7), datetime(2026, 3, 10, 11, 0))
+        self.assertNext("@daily", datetime(2026, 3, 10, 10, 7), datetime(2026, 3, 11, 0, 0))
+        self.assertNext("@weekly", datetime(2026, 3, 10), datetime(2026, 3, 15, 0, 0))
+        self.assertNext("@monthly", datetime(2026, 3, 10), datetime(2026, 4, 1, 0, 0))
+
+    def test_invalid_expressions_are_rejected(self):
+        for expression in ("* * * *", "* * * * * *", "", "60 * * * *", "* 24 * * *", "* * 0 * *", "* * * 13 *",
+                           "* * * * 8", "*/0 * * * *", "5-1 * * * *", "a * * * *", "1-b * * * *", "@never"):
+            self.assertRaises(ValueError, CronExpression, expression)
+
+    def test_expression_that_never_fires(self):
+        self.assertRaises(ValueError, CronExpression("0 0 31 2 *").next_after, datetime(2026, 3, 10))
+
+
+if __name__ == "__main__":
+    unittest.main()
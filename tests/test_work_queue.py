@@ -0,0 +1,63 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, "src"))
+
+from work_queue import SQLiteWorkQueue, JOB_PENDING, JOB_LEASED, JOB_DONE, JOB_DEAD, JOB_CANCELLED
+
+__author__ = 'George K. <gkiom@scify.org>'
+
+
+class WorkQueueTest(unittest.TestCase):
+
+    def setUp(self):
+        self.work_dir = tempfile.mkdtemp()
+        self.queue = SQLiteWorkQueue(path=os.path.join(self.work_dir, "queue.db"))
+
+    def tearDown(self):
+        shutil.rmtree(self.work_dir, ignore_errors=True)
+
+    def status(self, payload):
+        return self.queue.get_results("batch")[payload][0]
+
+    def test_leased_job_is_completed_or_failed_by_its_owner(self):
+        self.queue.enqueue("batch", [1, 2])
+        job_id, payload, attempt = self.queue.lease("a")
+        self.assertEqual((payload, attempt), (1, 1))
+        self.assertTrue(self.queue.complete(job_id, "a", 200))
+        self.assertEqual(self.queue.get_results("batch")[1], (JOB_DONE, 200))
+        job_id, _, attempt = self.queue.lease("a")
+        self.assertTrue(self.queue.fail(job_id, "a", attempt, 500, "server error"))
+        self.assertEqual(self.status(2), JOB_PENDING)
+
+    def test_last_failed_attempt_is_dead_lettered(self):
+        self.queue.enqueue("batch", [1], max_attempts=1)
+        job_id, _, attempt = self.queue.lease("a")
+        self.assertTrue(self.queue.fail(job_id, "a", attempt))
+        self.assertEqual(self.status(1), JOB_DEAD)
+
+    def test_result_of_an_expired_lease_is_dropped(self):
+        self.queue.enqueue("batch", [1], lease_time=-1)  # the lease expires as soon as it is taken
+        job_id, _, _ = self.queue.lease("a")
+        self.assertEqual(self.queue.lease("b")[:2], (job_id, 1))
+        self.assertFalse(self.queue.fail(job_id, "a", 1, 500))
+        self.assertFalse(self.queue.complete(job_id, "a", 200))
+        self.assertEqual(self.status(1), JOB_LEASED)
+        self.assertTrue(self.queue.complete(job_id, "b", 200))
+        self.assertEqual(self.status(1), JOB_DONE)
+
+    def test_cancelled_job_is_not_completed(self):
+        self.queue.enqueue("batch", [1])
+        job_id, _, _ = self.queue.lease("a")
+        self.assertEqual(self.queue.cancel("batch", leased=True), [1])
+        self.assertFalse(self.queue.complete(job_id, "a", 200))
+        self.assertEqual(self.status(1), JOB_CANCELLED)
+
+
+if __name__ == "__main__":
+    unittest.main()